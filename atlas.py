@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+import cv2
+import numpy as np
+
+from component_cache import TrimmedLayer, trim_layer
+from file_util import create_temp_file
+from lsfInfo import LSFFile
+
+# 组件图集：把解包目录中的lsf文件与组件PNG打包为一个文件，组件以裁掉透明边框后的原始像素保存，
+# 打开时用mmap映射，读取组件不需要解码也不需要复制
+# 文件头：魔数(8字节)、版本(u32)、保留(u32)、索引偏移(u64)、索引长度(u64)；索引为文件末尾的JSON
+ATLAS_MAGIC = b'ESCATLAS'
+ATLAS_VERSION = 1
+ATLAS_HEADER = struct.Struct('<8sIIQQ')
+ATLAS_ALIGN = 64
+ATLAS_SUFFIX = '.escatlas'
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib'
+
+
+def is_atlas_path(path):
+    return os.path.isfile(path) and path.endswith(ATLAS_SUFFIX)
+
+
+class AtlasWriter:
+    def __init__(self, file):
+        self.file = file
+        self.file.write(b'\0' * ATLAS_HEADER.size)
+        self.offset = ATLAS_HEADER.size
+
+    def write(self, data):
+        # 每段数据按ATLAS_ALIGN对齐，映射出的NumPy数组起始地址对齐
+        padding = -self.offset % ATLAS_ALIGN
+        self.file.write(b'\0' * padding)
+        self.offset += padding
+        start = self.offset
+        self.file.write(data)
+        self.offset += len(data)
+        return start, len(data)
+
+    def finish(self, index):
+        data = json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        offset, size = self.write(data)
+        self.file.seek(0)
+        self.file.write(ATLAS_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, 0, offset, size))
+
+
+def pack_directory(dir_path, atlas_path, compression=COMPRESSION_NONE, progress=None):
+    # 打包目录下所有lsf文件与PNG图片，先写临时文件再重命名；返回(lsf数量, 组件数量)
+    lsf_names = sorted(os.path.splitext(f)[0] for f in os.listdir(dir_path) if f.endswith('.lsf'))
+    png_names = sorted(os.path.splitext(f)[0] for f in os.listdir(dir_path) if f.endswith('.png'))
+    index = {'lsf': {}, 'components': {}, 'compression': compression}
+    out_dir = os.path.dirname(os.path.abspath(atlas_path))
+    fd, tmp_path = create_temp_file(out_dir, ATLAS_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            writer = AtlasWriter(file)
+            for name in lsf_names:
+                with open(os.path.join(dir_path, name + '.lsf'), 'rb') as lsf_file:
+                    index['lsf'][name] = writer.write(lsf_file.read())
+            for i, name in enumerate(png_names):
+                path = os.path.join(dir_path, name + '.png')
+                image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                if image is None or image.ndim != 3:
+                    print(f"无法读取{name}.png，已跳过")
+                    continue
+                st = os.stat(path)
+                layer = trim_layer(image)
+                data = layer.pixels.tobytes()
+                if compression == COMPRESSION_ZLIB:
+                    data = zlib.compress(data, 1)
+                offset, size = writer.write(data)
+                # 记录PNG文件的大小与修改时间，与散文件目录生成相同的持久化缓存键
+                index['components'][name] = {
+                    'offset': offset, 'size': size, 'shape': list(layer.pixels.shape),
+                    'dx': layer.dx, 'dy': layer.dy, 'width': layer.width, 'height': layer.height,
+                    'spans': layer.spans, 'png': [st.st_size, st.st_mtime_ns],
+                }
+                if progress is not None:
+                    progress(i + 1, len(png_names))
+            writer.finish(index)
+        os.replace(tmp_path, atlas_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(index['lsf']), len(index['components'])
+
+
+class Atlas:
+    # 只读的组件图集，可以代替解包目录传给synthesis、LayerCompositor与ComponentCache
+    # 同时提供与Catalog相同的list_lsf与load_lsf，GUI可以直接用它列出与读取lsf文件
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self.stamp = (st.st_size, st.st_mtime_ns)
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, index_offset, index_size = ATLAS_HEADER.unpack_from(self._mmap, 0)
+        if magic != ATLAS_MAGIC or version != ATLAS_VERSION:
+            self._mmap.close()
+            raise ValueError(f"不是有效的组件图集: {path}")
+        index = json.loads(bytes(self._mmap[index_offset:index_offset + index_size]).decode('utf-8'))
+        self.compression = index['compression']
+        self.mapped = self.compression == COMPRESSION_NONE
+        self.lsf_entries = index['lsf']
+        self.components = index['components']
+        self._layers = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'Atlas({self.path!r})'
+
+    def __reduce__(self):
+        # 传给子进程时只传路径，由子进程重新映射
+        return Atlas, (self.path,)
+
+    def close(self):
+        # 已返回的组件数组仍引用映射，只在没有其他引用时才真正解除映射
+        self._layers.clear()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def refresh(self, check_components=True):
+        return []
+
+    def list_lsf(self):
+        return sorted(self.lsf_entries)
+
+    def lsf_bytes(self, name):
+        offset, size = self.lsf_entries[name]
+        return self._mmap[offset:offset + size]
+
+    def load_lsf(self, name):
+        return LSFFile.from_bytes(os.path.join(self.path, name + '.lsf'), self.lsf_bytes(name))
+
+    def lsf_digest(self, lsf_path):
+        # 与disk_cache.lsf_digest相同：lsf文件内容的sha256
+        name = os.path.splitext(os.path.basename(lsf_path))[0]
+        digest = self._digests.get(name)
+        if digest is None:
+            digest = hashlib.sha256(self.lsf_bytes(name)).hexdigest()
+            self._digests[name] = digest
+        return digest
+
+    def fingerprint(self, name):
+        entry = self.components.get(name)
+        return tuple(entry['png']) if entry is not None else None
+
+    def layer(self, name):
+        # 返回映射自图集文件的只读TrimmedLayer；未压缩时不复制像素并记住结果，压缩时每次解压由调用方缓存
+        layer = self._layers.get(name)
+        if layer is not None:
+            return layer
+        entry = self.components.get(name)
+        if entry is None:
+            return None
+        shape = tuple(entry['shape'])
+        if self.mapped:
+            pixels = np.frombuffer(self._mmap, dtype=np.uint8, count=entry['size'],
+                                   offset=entry['offset']).reshape(shape)
+        else:
+            data = zlib.decompress(self._mmap[entry['offset']:entry['offset'] + entry['size']])
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+        spans = [tuple(span) for span in entry['spans']]
+        layer = TrimmedLayer(pixels, entry['dx'], entry['dy'], entry['width'], entry['height'], spans)
+        if self.mapped:
+            with self._lock:
+                layer = self._layers.setdefault(name, layer)
+        return layer
+
+    def image(self, name):
+        # 还原完整大小的组件图片，透明边框以0填充（预乘alpha后与原图一致，缩小结果相同）
+        layer = self.layer(name)
+        if layer is None:
+            return None
+        h, w, c = layer.pixels.shape
+        if (layer.dx, layer.dy, w, h) == (0, 0, layer.width, layer.height):
+            return layer.pixels
+        image = np.zeros((layer.height, layer.width, c), dtype=np.uint8)
+        image[layer.dy:layer.dy + h, layer.dx:layer.dx + w] = layer.pixels
+        image.setflags(write=False)
+        return image
+
+
+def print_progress(done, total):
+    sys.stderr.write(f"\r打包进度: {done}/{total}")
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='组件图集工具')
+    sub_parsers = parser.add_subparsers(dest='command', required=True)
+    pack_parser = sub_parsers.add_parser('pack', help='把解包目录打包为组件图集')
+    pack_parser.add_argument('input', help='解包的lsf文件与素材图片所在目录')
+    pack_parser.add_argument('-o', '--output', help=f'输出的图集文件，默认为<目录名>{ATLAS_SUFFIX}')
+    pack_parser.add_argument('--zlib', action='store_true', help='用zlib快速压缩组件像素（读取时需要解压，不再零复制）')
+    info_parser = sub_parsers.add_parser('info', help='显示图集内容')
+    info_parser.add_argument('atlas', help='图集文件')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        output = args.output or os.path.normpath(args.input) + ATLAS_SUFFIX
+        compression = COMPRESSION_ZLIB if args.zlib else COMPRESSION_NONE
+        lsf_count, component_count = pack_directory(args.input, output, compression, print_progress)
+        print(f"已打包 {lsf_count} 个lsf文件与 {component_count} 个组件到 {output}"
+              f"（{os.path.getsize(output) / 1024 / 1024:.1f}MB）")
+    else:
+        atlas = Atlas(args.atlas)
+        pixels = sum(entry['size'] for entry in atlas.components.values())
+        print(f"lsf文件: {len(atlas.lsf_entries)}，组件: {len(atlas.components)}，"
+              f"像素数据: {pixels / 1024 / 1024:.1f}MB，压缩: {atlas.compression}")
+        atlas.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from component_cache import ComponentCache
+from compositor import compose_batch
+from exporter import ExportSettings, EXPORT_FORMATS, encode_image
+from lsfInfo import LSFFile, PARSER_LEGACY, PARSER_NUMPY
+from synthesis_util import BLEND_FLOAT, BLEND_FIXED, CG_synthesis_opencv, synthesis
+from synthetic_data import add_spec_arguments, generate_dataset, spec_from_args, spec_layers
+from tiled import DEFAULT_TILE_SIZE, export_tiled
+
+BENCHMARK_VERSION = 1
+# 与基准结果比较时，中位数变慢超过该比例视为性能回退
+DEFAULT_TOLERANCE = 0.25
+
+
+def summarize(samples):
+    # 各阶段按单次操作统计，单位为毫秒
+    values = np.sort(np.asarray(samples, dtype=np.float64)) * 1000
+    return {
+        'n': len(values),
+        'min_ms': float(values[0]),
+        'median_ms': float(np.median(values)),
+        'mean_ms': float(values.mean()),
+        'p95_ms': float(np.percentile(values, 95)),
+        'max_ms': float(values[-1]),
+    }
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_parse(lsf_paths, repeat):
+    stages = {}
+    for parser in (PARSER_NUMPY, PARSER_LEGACY):
+        samples = [timed(LSFFile, path, parser=parser)[0] for _ in range(repeat) for path in lsf_paths]
+        stages[f'parse.{parser}'] = summarize(samples)
+    return stages
+
+
+def plan_variants(lsf_files, variants_per_lsf):
+    # 每个lsf文件按格雷码顺序取前variants_per_lsf个组合，返回[(lsf, 底片, 人脸差分, 特效, 圣光)]
+    plans = []
+    for lsf in lsf_files:
+        for variant in itertools.islice(lsf.iter_variants(), variants_per_lsf):
+            plans.append((lsf, variant.bi, variant.fd, variant.fe, variant.hl))
+    return plans
+
+
+def bench_operation_blocks(plans, repeat):
+    # get_operation_blocks会补全传入的键，每次传入副本
+    samples = [timed(lsf.get_operation_blocks, bi, dict(fd), dict(fe), hl)[0]
+               for _ in range(repeat) for lsf, bi, fd, fe, hl in plans]
+    return {'operation_blocks': summarize(samples)}
+
+
+def bench_decode(dir_path, names, repeat):
+    # 冷读取：从磁盘读取并解码组件PNG
+    samples = [timed(cv2.imread, os.path.join(dir_path, name + '.png'), cv2.IMREAD_UNCHANGED)[0]
+               for _ in range(repeat) for name in names]
+    return {'decode': summarize(samples)}
+
+
+def bench_blend(dir_path, plans, repeat, cache):
+    # 组件已在缓存中，只统计CG_synthesis_opencv逐图层混合的耗时
+    stages = {}
+    for engine in (BLEND_FLOAT, BLEND_FIXED):
+        samples = []
+        for _ in range(repeat):
+            for lsf, bi, fd, fe, hl in plans:
+                image = np.zeros((lsf.y, lsf.x, 4), dtype=np.uint8)
+                for block in lsf.get_operation_blocks(bi, dict(fd), dict(fe), hl):
+                    elapsed, image = timed(CG_synthesis_opencv, image, block, dir_path, 1, cache, engine)
+                    samples.append(elapsed)
+        stages[f'blend.{engine}'] = summarize(samples)
+    return stages
+
+
+def bench_synthesis(dir_path, plans, repeat, cache):
+    # 完整的synthesis()：分配画布并依次混合全部图层；返回浮点引擎的合成结果供编码阶段使用
+    stages = {}
+    images = []
+    for engine in (BLEND_FLOAT, BLEND_FIXED):
+        samples = []
+        for i in range(repeat):
+            for lsf, bi, fd, fe, hl in plans:
+                blocks = lsf.get_operation_blocks(bi, dict(fd), dict(fe), hl)
+                elapsed, image = timed(synthesis, lsf.x, lsf.y, blocks, dir_path, cache, engine)
+                samples.append(elapsed)
+                if engine == BLEND_FLOAT and i == 0:
+                    images.append(image)
+        stages[f'synthesis.{engine}'] = summarize(samples)
+    return stages, images
+
+
+def bench_batch(dir_path, plans, repeat, cache):
+    # 同一lsf文件的组合一次合成为(N, H, W, 4)的数组，按每个组合的平均耗时统计，便于与synthesis.*比较
+    stages = {}
+    by_lsf = {}
+    for lsf, bi, fd, fe, hl in plans:
+        by_lsf.setdefault(id(lsf), (lsf, []))[1].append(lsf.get_operation_blocks(bi, dict(fd), dict(fe), hl))
+    for engine in (BLEND_FLOAT, BLEND_FIXED):
+        samples = []
+        for _ in range(repeat):
+            for lsf, block_lists in by_lsf.values():
+                elapsed, _ = timed(compose_batch, lsf.x, lsf.y, block_lists, dir_path, cache, engine)
+                samples.extend([elapsed / len(block_lists)] * len(block_lists))
+        stages[f'batch.{engine}'] = summarize(samples)
+    return stages
+
+
+def bench_tiled(dir_path, plans, repeat, cache, tile_size=DEFAULT_TILE_SIZE):
+    # 分块合成并逐行编码为PNG（写入临时目录），与synthesis加encode.png对比
+    samples = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'tiled.png')
+        for _ in range(repeat):
+            for lsf, bi, fd, fe, hl in plans:
+                blocks = lsf.get_operation_blocks(bi, dict(fd), dict(fe), hl)
+                elapsed, _ = timed(export_tiled, path, lsf.x, lsf.y, blocks, dir_path, ExportSettings(), cache,
+                                   BLEND_FLOAT, tile_size)
+                samples.append(elapsed)
+    return {'tiled.png': summarize(samples)}
+
+
+def bench_encode(images, repeat):
+    stages = {}
+    for fmt in EXPORT_FORMATS:
+        settings = ExportSettings(fmt)
+        samples = []
+        sizes = []
+        for _ in range(repeat):
+            for image in images:
+                elapsed, data = timed(encode_image, image, settings)
+                samples.append(elapsed)
+                sizes.append(len(data))
+        stages[f'encode.{fmt}'] = summarize(samples)
+        stages[f'encode.{fmt}']['mean_bytes'] = float(np.mean(sizes))
+    return stages
+
+
+def run_benchmark(dir_path, repeat=3, variants_per_lsf=8, encode_images=4):
+    lsf_paths = sorted(os.path.join(dir_path, f) for f in os.listdir(dir_path) if f.endswith('.lsf'))
+    if not lsf_paths:
+        raise ValueError(f"目录中没有lsf文件: {dir_path}")
+    lsf_files = [LSFFile(path) for path in lsf_paths]
+    plans = plan_variants(lsf_files, variants_per_lsf)
+    names = sorted({block.name for lsf in lsf_files for block in lsf.blocks
+                    if os.path.exists(os.path.join(dir_path, block.name + '.png'))})
+    cache = ComponentCache(max_bytes=1 << 40)
+
+    stages = {}
+    stages.update(bench_parse(lsf_paths, repeat))
+    stages.update(bench_operation_blocks(plans, repeat))
+    stages.update(bench_decode(dir_path, names, repeat))
+    stages.update(bench_blend(dir_path, plans, repeat, cache))
+    synthesis_stages, images = bench_synthesis(dir_path, plans, repeat, cache)
+    stages.update(synthesis_stages)
+    stages.update(bench_batch(dir_path, plans, repeat, cache))
+    stages.update(bench_tiled(dir_path, plans, repeat, cache))
+    stages.update(bench_encode(images[:encode_images], repeat))
+    return {'lsf_files': len(lsf_paths), 'variants': len(plans), 'components': len(names), 'stages': stages}
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(result, baseline, tolerance):
+    # 按各阶段中位数与基准结果比较，返回变慢超过tolerance的阶段
+    regressions = []
+    for name, stage in sorted(result['stages'].items()):
+        old = baseline.get('stages', {}).get(name)
+        if old is None or old['median_ms'] <= 0:
+            print(f"{name:24s} {stage['median_ms']:10.3f}ms  （基准中没有该阶段）")
+            continue
+        ratio = stage['median_ms'] / old['median_ms']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  变慢'
+            regressions.append(name)
+        print(f"{name:24s} {old['median_ms']:10.3f}ms -> {stage['median_ms']:10.3f}ms  {ratio:5.2f}x{flag}")
+    return regressions
+
+
+def print_result(result):
+    print(f"lsf文件: {result['lsf_files']}，组合: {result['variants']}，组件: {result['components']}")
+    for name, stage in result['stages'].items():
+        print(f"{name:24s} 中位数 {stage['median_ms']:10.3f}ms  p95 {stage['p95_ms']:10.3f}ms  n={stage['n']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='测量解析、差分计算、解码、混合、合成与编码各阶段的耗时')
+    parser.add_argument('--data', help='使用已有的解包目录，默认在临时目录中生成合成数据')
+    parser.add_argument('-n', '--count', type=int, default=2, help='生成的lsf文件数量')
+    parser.add_argument('--repeat', type=int, default=3, help='每个阶段的重复次数')
+    parser.add_argument('--variants', type=int, default=8, help='每个lsf文件测量的组合数')
+    parser.add_argument('--encode-images', type=int, default=4, help='测量编码的图片数')
+    parser.add_argument('-o', '--output', help='把结果写入该JSON文件')
+    parser.add_argument('--baseline', help='与之前保存的JSON结果比较，有阶段变慢时返回1')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='允许的变慢比例')
+    add_spec_arguments(parser)
+    args = parser.parse_args(argv)
+
+    result = {'version': BENCHMARK_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'environment': environment()}
+    if args.data:
+        result['data'] = os.path.abspath(args.data)
+        result.update(run_benchmark(args.data, args.repeat, args.variants, args.encode_images))
+    else:
+        spec = spec_from_args(args)
+        result['spec'] = dict(spec._asdict(), count=args.count, layers=spec_layers(spec))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            generate_dataset(tmp_dir, args.count, spec)
+            result.update(run_benchmark(tmp_dir, args.repeat, args.variants, args.encode_images))
+
+    print_result(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(result, file, ensure_ascii=False, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"性能回退: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
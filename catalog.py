@@ -0,0 +1,212 @@
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+
+from disk_cache import DEFAULT_DISK_CACHE_DIR
+from lsfInfo import LSFFile, BlockTable
+from profiler import span
+
+CATALOG_VERSION = 1
+
+CATEGORY_BASE = 'base'
+CATEGORY_FACE_DIFFERENCE = 'face_difference'
+CATEGORY_FACE_EFFECT = 'face_effect'
+CATEGORY_HOLY_LIGHT = 'holy_light'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS lsf_files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    x INTEGER,
+    y INTEGER,
+    type INTEGER
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    lsf TEXT,
+    idx INTEGER,
+    name TEXT,
+    x INTEGER,
+    y INTEGER,
+    type INTEGER,
+    id INTEGER,
+    mode INTEGER,
+    category TEXT,
+    grp INTEGER,
+    PRIMARY KEY (lsf, idx)
+);
+CREATE INDEX IF NOT EXISTS blocks_name ON blocks (name);
+CREATE TABLE IF NOT EXISTS components (
+    name TEXT PRIMARY KEY,
+    present INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    width INTEGER,
+    height INTEGER,
+    color_type INTEGER
+);
+"""
+
+
+def default_catalog_path(directory, cache_dir=DEFAULT_DISK_CACHE_DIR):
+    # 索引默认保存在缓存目录中，避免写入解包目录
+    digest = hashlib.sha256(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f'catalog-{digest}.sqlite3')
+
+
+def read_png_header(path):
+    # 只读取PNG的IHDR块获取宽高与颜色类型，不解码图片
+    with open(path, 'rb') as file:
+        header = file.read(26)
+    if len(header) < 26 or header[:8] != b'\x89PNG\r\n\x1a\n' or header[12:16] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', header[16:24])
+    return width, height, header[25]
+
+
+def block_categories(lsf):
+    # 按LSFFile的分类结果给每个信息块标注类别与组号
+    categories = {}
+    for blocks in lsf.base_images.values():
+        for block in blocks:
+            categories.setdefault(block.index, (CATEGORY_BASE, 0))
+    for n, group in lsf.face_differences.items():
+        for block in group.values():
+            categories[block.index] = (CATEGORY_FACE_DIFFERENCE, n)
+    for n, group in lsf.face_effects.items():
+        for block in group.values():
+            categories[block.index] = (CATEGORY_FACE_EFFECT, n)
+    for block in lsf.holy_light.values():
+        categories[block.index] = (CATEGORY_HOLY_LIGHT, 0)
+    return categories
+
+
+class Catalog:
+    # 目录索引：一次性解析目录下所有lsf文件并记录到SQLite中，之后按文件修改时间增量刷新
+    # 未指定db_path时保存在cache_dir中
+    def __init__(self, directory, db_path=None, cache_dir=DEFAULT_DISK_CACHE_DIR):
+        self.directory = directory
+        self.db_path = db_path or default_catalog_path(directory, cache_dir)
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or int(row[0]) != CATALOG_VERSION:
+                self._conn.executescript('DELETE FROM lsf_files; DELETE FROM blocks; DELETE FROM components;')
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CATALOG_VERSION),))
+
+    def close(self):
+        self._conn.close()
+
+    def refresh(self, check_components=True):
+        # 返回重新解析的lsf文件名列表
+        with self._lock:
+            indexed = {name: (size, mtime_ns) for name, size, mtime_ns in
+                       self._conn.execute('SELECT name, size, mtime_ns FROM lsf_files')}
+            present = {}
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.lsf'):
+                    try:
+                        st = os.stat(os.path.join(self.directory, filename))
+                    except OSError:
+                        continue
+                    present[os.path.splitext(filename)[0]] = (st.st_size, st.st_mtime_ns)
+
+            changed = [name for name, stamp in present.items() if indexed.get(name) != stamp]
+            removed = [name for name in indexed if name not in present]
+            with self._conn:
+                for name in removed:
+                    self._conn.execute('DELETE FROM lsf_files WHERE name = ?', (name,))
+                    self._conn.execute('DELETE FROM blocks WHERE lsf = ?', (name,))
+                for name in sorted(changed):
+                    self._index_lsf(name, present[name])
+                if check_components:
+                    self._refresh_components()
+            return sorted(changed)
+
+    def _index_lsf(self, name, stamp):
+        try:
+            lsf = LSFFile(os.path.join(self.directory, name + '.lsf'))
+        except (OSError, ValueError) as e:
+            # 删除旧的记录，修改后无法解析的文件不再按旧内容返回
+            print(f"解析{name}.lsf失败: {e}")
+            self._conn.execute('DELETE FROM lsf_files WHERE name = ?', (name,))
+            self._conn.execute('DELETE FROM blocks WHERE lsf = ?', (name,))
+            return
+        categories = block_categories(lsf)
+        self._conn.execute('INSERT OR REPLACE INTO lsf_files VALUES (?, ?, ?, ?, ?, ?)',
+                           (name, stamp[0], stamp[1], lsf.x, lsf.y, lsf.type))
+        self._conn.execute('DELETE FROM blocks WHERE lsf = ?', (name,))
+        self._conn.executemany(
+            'INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(name, block.index, block.name, block.x, block.y, block.type, block.id, block.mode)
+             + categories.get(block.index, (None, None)) for block in lsf.blocks])
+
+    def _refresh_components(self):
+        indexed = {name: (size, mtime_ns) for name, size, mtime_ns in
+                   self._conn.execute('SELECT name, size, mtime_ns FROM components')}
+        referenced = {name for (name,) in self._conn.execute('SELECT DISTINCT name FROM blocks')}
+        for name in referenced:
+            path = os.path.join(self.directory, name + '.png')
+            try:
+                st = os.stat(path)
+            except OSError:
+                if indexed.get(name) != (None, None):
+                    self._conn.execute('INSERT OR REPLACE INTO components VALUES (?, 0, NULL, NULL, NULL, NULL, NULL)',
+                                       (name,))
+                continue
+            if indexed.get(name) == (st.st_size, st.st_mtime_ns):
+                continue
+            header = read_png_header(path) or (None, None, None)
+            self._conn.execute('INSERT OR REPLACE INTO components VALUES (?, 1, ?, ?, ?, ?, ?)',
+                               (name, st.st_size, st.st_mtime_ns) + header)
+        for name in set(indexed) - referenced:
+            self._conn.execute('DELETE FROM components WHERE name = ?', (name,))
+
+    def list_lsf(self):
+        with self._lock:
+            return [name for (name,) in self._conn.execute('SELECT name FROM lsf_files ORDER BY name')]
+
+    def load_lsf(self, name):
+        # 从索引恢复LSFFile；lsf文件在索引之后被修改时重新解析并更新索引
+        with span('catalog.load'):
+            return self._load_lsf(name)
+
+    def _load_lsf(self, name):
+        file_path = os.path.join(self.directory, name + '.lsf')
+        st = os.stat(file_path)
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, x, y, type FROM lsf_files WHERE name = ?',
+                                     (name,)).fetchone()
+            if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+                with self._conn:
+                    self._index_lsf(name, (st.st_size, st.st_mtime_ns))
+                row = self._conn.execute('SELECT size, mtime_ns, x, y, type FROM lsf_files WHERE name = ?',
+                                         (name,)).fetchone()
+                if row is None:
+                    return LSFFile(file_path)
+            rows = self._conn.execute('SELECT name, x, y, type, id, mode FROM blocks WHERE lsf = ? ORDER BY idx',
+                                      (name,)).fetchall()
+        table = BlockTable([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows],
+                           [r[3] for r in rows], [r[4] for r in rows], [r[5] for r in rows])
+        return LSFFile.from_table(file_path, row[2], row[3], row[4], table)
+
+    def missing_components(self, lsf_name=None):
+        # 返回被lsf文件引用但不存在的组件名，lsf_name为None时返回所有lsf文件的
+        query = ('SELECT DISTINCT blocks.name FROM blocks JOIN components ON blocks.name = components.name '
+                 'WHERE components.present = 0')
+        params = ()
+        if lsf_name is not None:
+            query += ' AND blocks.lsf = ?'
+            params = (lsf_name,)
+        with self._lock:
+            return [name for (name,) in self._conn.execute(query + ' ORDER BY blocks.name', params)]
@@ -0,0 +1,296 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from catalog import read_png_header
+from profiler import span
+
+# 默认缓存上限，可通过环境变量ESCUDE_CACHE_MB调整（单位MB）
+DEFAULT_CACHE_BYTES = int(os.environ.get('ESCUDE_CACHE_MB', '512')) * 1024 * 1024
+
+# 裁剪后的组件按LAYER_TILE×LAYER_TILE的块划分为不透明区域与需要混合的区域
+LAYER_TILE = 64
+
+
+def preview_level(size, target):
+    # 返回使size >> level不小于target的最大level，level为0表示原始分辨率
+    level = 0
+    while target > 0 and (size >> (level + 1)) >= target:
+        level += 1
+    return level
+
+
+def downscale(image, level):
+    # 按2^level缩小组件图片，先预乘alpha再缩放，避免透明像素的颜色渗入边缘
+    with span('component.downscale'):
+        h, w = image.shape[:2]
+        size = (max(1, w >> level), max(1, h >> level))
+        if image.shape[2] != 4:
+            return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        premultiplied = image.astype(np.float32)
+        premultiplied[:, :, :3] *= premultiplied[:, :, 3:] / 255.0
+        resized = cv2.resize(premultiplied, size, interpolation=cv2.INTER_AREA)
+        alpha = resized[:, :, 3:]
+        np.divide(resized[:, :, :3] * 255.0, alpha, out=resized[:, :, :3], where=alpha > 0)
+        return np.clip(resized + 0.5, 0, 255).astype(np.uint8)
+
+
+class TrimmedLayer:
+    # 裁掉透明边框后的组件：pixels为alpha包围盒内的像素，(dx, dy)为其在原图中的位置，
+    # width与height为原图大小（用于越界判断）；spans为[(y0, y1, x0, x1, 是否完全不透明)]，
+    # 坐标相对于pixels，完全透明的块不在其中
+    __slots__ = ('pixels', 'dx', 'dy', 'width', 'height', 'spans')
+
+    def __init__(self, pixels, dx, dy, width, height, spans):
+        self.pixels = pixels
+        self.dx = dx
+        self.dy = dy
+        self.width = width
+        self.height = height
+        self.spans = spans
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes
+
+
+def layer_spans(alpha, tile=LAYER_TILE):
+    # 按块统计alpha的最小值与最大值，同一行中相邻的同类块合并为一个区域
+    h, w = alpha.shape
+    ys = np.arange(0, h, tile)
+    xs = np.arange(0, w, tile)
+    tile_max = np.maximum.reduceat(np.maximum.reduceat(alpha, ys, axis=0), xs, axis=1)
+    tile_min = np.minimum.reduceat(np.minimum.reduceat(alpha, ys, axis=0), xs, axis=1)
+    spans = []
+    for i, y0 in enumerate(ys):
+        y1 = min(y0 + tile, h)
+        run = None
+        for j, x0 in enumerate(xs):
+            kind = None if tile_max[i, j] == 0 else bool(tile_min[i, j] == 255)
+            if run is not None and (kind is None or kind != run[1]):
+                spans.append((int(y0), int(y1), run[0], int(x0), run[1]))
+                run = None
+            if kind is not None and run is None:
+                run = (int(x0), kind)
+        if run is not None:
+            spans.append((int(y0), int(y1), run[0], w, run[1]))
+    return spans
+
+
+def trim_layer(image, tile=LAYER_TILE):
+    # 计算alpha的紧包围盒，只保留包围盒内的像素；没有alpha通道的图片整体视为不透明
+    h, w = image.shape[:2]
+    if image.shape[2] != 4:
+        pixels = image
+        layer = TrimmedLayer(pixels, 0, 0, w, h, [(0, h, 0, w, True)])
+    else:
+        alpha = image[:, :, 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if len(rows) == 0:
+            pixels = image[:0, :0].copy()
+            layer = TrimmedLayer(pixels, 0, 0, w, h, [])
+        else:
+            cols = np.flatnonzero(alpha.any(axis=0))
+            dy, dx = int(rows[0]), int(cols[0])
+            pixels = np.ascontiguousarray(image[dy:rows[-1] + 1, dx:cols[-1] + 1])
+            layer = TrimmedLayer(pixels, dx, dy, w, h, layer_spans(pixels[:, :, 3], tile))
+    pixels.setflags(write=False)
+    return layer
+
+
+class ComponentCache:
+    # 已解码组件图片的LRU缓存，键为(目录, 块名, 文件修改时间, 缩小级别)
+    # 缩小级别为level的图片是原图按2^level缩小后的结果，用于预览与缩略图
+    # load_layer返回裁掉透明边框的TrimmedLayer，与完整图片分开缓存，合成时只缓存裁剪后的像素
+    # dir_path可以是解包目录，也可以是组件图集（atlas.Atlas），图集以其文件的大小与修改时间代替组件的修改时间
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(dir_path, block_name):
+        # 返回缓存键中的修改标记，组件不存在时返回None
+        if not isinstance(dir_path, str):
+            return dir_path.stamp if dir_path.fingerprint(block_name) is not None else None
+        try:
+            return os.stat(os.path.join(dir_path, block_name + '.png')).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read(dir_path, block_name):
+        if not isinstance(dir_path, str):
+            return dir_path.image(block_name)
+        # 读取文件与解码分开进行，便于分别统计磁盘读取与PNG解码的耗时，结果与cv2.imread相同
+        with span('component.read'):
+            try:
+                with open(os.path.join(dir_path, block_name + '.png'), 'rb') as file:
+                    data = file.read()
+            except OSError:
+                return None
+        if not data:
+            return None
+        with span('component.decode'):
+            return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def load(self, dir_path, block_name, level=0):
+        mtime = self._stamp(dir_path, block_name)
+        if mtime is None:
+            return None
+        key = (dir_path, block_name, mtime, level)
+        image = self._get(key)
+        if image is not None:
+            return image
+
+        if level == 0:
+            image = self._read(dir_path, block_name)
+        else:
+            # 只缓存缩小后的图片：原图已在缓存中时直接复用，否则读取后只用于缩小，不放入缓存
+            with self._lock:
+                image = self._items.get((dir_path, block_name, mtime, 0))
+            if image is None:
+                image = self._read(dir_path, block_name)
+            if image is not None:
+                image = downscale(image, level)
+        if image is None:
+            return None
+        # 缓存中的图片被多处共享，禁止原地修改
+        image.setflags(write=False)
+        self._put(key, image)
+        return image
+
+    def load_layer(self, dir_path, block_name, level=0):
+        atlas = not isinstance(dir_path, str)
+        if atlas and level == 0 and dir_path.mapped:
+            # 未压缩图集中的组件已经裁剪好并映射在内存中，不占用缓存
+            return dir_path.layer(block_name)
+        mtime = self._stamp(dir_path, block_name)
+        if mtime is None:
+            return None
+        key = (dir_path, block_name, mtime, ('layer', level))
+        layer = self._get(key)
+        if layer is not None:
+            return layer
+
+        if atlas and level == 0:
+            layer = dir_path.layer(block_name)
+            self._put(key, layer)
+            return layer
+
+        # 已缓存的完整图片直接复用，否则解码后只缓存裁剪结果；先缩小再裁剪，与完整图片的合成结果一致
+        with self._lock:
+            image = self._items.get((dir_path, block_name, mtime, level))
+        if image is None:
+            with self._lock:
+                image = self._items.get((dir_path, block_name, mtime, 0))
+            if image is None:
+                image = self._read(dir_path, block_name)
+            if image is not None and level > 0:
+                image = downscale(image, level)
+        if image is None:
+            return None
+        with span('component.trim'):
+            layer = trim_layer(image)
+        self._put(key, layer)
+        return layer
+
+    def has_layer(self, dir_path, block_name, level=0):
+        # 不读取文件，只判断load_layer能否直接返回；未压缩图集的原分辨率组件不需要缓存
+        if not isinstance(dir_path, str) and level == 0 and dir_path.mapped:
+            return True
+        mtime = self._stamp(dir_path, block_name)
+        with self._lock:
+            return (dir_path, block_name, mtime, ('layer', level)) in self._items
+
+    def _get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item
+            self.misses += 1
+        return None
+
+    def load_for_height(self, dir_path, block_name, height):
+        # 读取不低于height的最小缩小级别，用于缩略图；原图高度从PNG文件头或图集索引得到，不解码原图
+        full_height = self._height(dir_path, block_name)
+        if full_height is None:
+            return None
+        return self.load(dir_path, block_name, preview_level(full_height, height))
+
+    @staticmethod
+    def _height(dir_path, block_name):
+        if not isinstance(dir_path, str):
+            entry = dir_path.components.get(block_name)
+            return entry['height'] if entry is not None else None
+        try:
+            header = read_png_header(os.path.join(dir_path, block_name + '.png'))
+        except OSError:
+            return None
+        return header[1] if header is not None else None
+
+    @staticmethod
+    def _family(key):
+        return key[0], key[1], key[3]
+
+    def _put(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            # 文件被修改后旧版本不再可能命中，直接丢弃
+            stale_key = self._latest.get(self._family(key))
+            if stale_key is not None and stale_key != key:
+                self._remove(stale_key)
+            if key in self._items:
+                return
+            self._items[key] = image
+            self._latest[self._family(key)] = key
+            self.current_bytes += image.nbytes
+            while self.current_bytes > self.max_bytes:
+                old_key = next(iter(self._items))
+                self._remove(old_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        image = self._items.pop(key, None)
+        if image is not None:
+            self.current_bytes -= image.nbytes
+        if self._latest.get(self._family(key)) == key:
+            del self._latest[self._family(key)]
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._items and self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._latest.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._items),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+default_cache = ComponentCache()
@@ -0,0 +1,120 @@
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class CancelToken:
+    __slots__ = ('cancelled',)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object, object)
+
+
+class CompositeTask(QRunnable):
+    def __init__(self, func, token, with_token=False):
+        super().__init__()
+        self.func = func
+        self.token = token
+        self.with_token = with_token
+        self.signals = TaskSignals()
+
+    def run(self):
+        # 开始前已被取消的任务不再执行，结果仍通过信号返回以便调度器继续处理等待中的请求
+        # with_token为True时把取消令牌传给func，长任务可以在中途检查并提前结束
+        result = None
+        if not self.token.cancelled:
+            try:
+                result = self.func(self.token) if self.with_token else self.func()
+            except Exception as e:
+                print(f"后台合成失败: {e}")
+                self.token.cancel()
+        self.signals.finished.emit(self.token, result)
+
+
+class Channel:
+    __slots__ = ('running', 'pending')
+
+    def __init__(self):
+        self.running = None
+        self.pending = None
+
+
+class CompositeScheduler(QObject):
+    # 按通道调度后台合成任务：同一通道同时只运行一个任务，等待中的请求只保留最新的一个
+    # 被新请求取代的结果交给on_discard处理，其余结果通过信号回到UI线程交给on_result
+    def __init__(self, max_threads=2, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.channels = {}
+        # [(尚未结束的任务的取消令牌, callback)]
+        self.running_callbacks = []
+
+    def submit(self, channel_name, func, on_result, on_discard=None, with_token=False):
+        channel = self.channels.setdefault(channel_name, Channel())
+        if channel.pending is not None:
+            self._discard(channel.pending, None)
+        request = (CancelToken(), func, on_result, on_discard, with_token)
+        if channel.running is None:
+            self._start(channel_name, channel, request)
+        else:
+            channel.running[0].cancel()
+            channel.pending = request
+        return request[0]
+
+    def cancel_all(self):
+        for channel in self.channels.values():
+            if channel.running is not None:
+                channel.running[0].cancel()
+            channel.pending = None
+
+    def wait_for_done(self, msecs=-1):
+        return self.pool.waitForDone(msecs)
+
+    def after_running(self, callback):
+        # 当前已开始的任务全部结束后在UI线程中调用callback，之后提交的任务不影响调用时机
+        # 在cancel_all之后调用，用于释放仍可能被已取消的任务使用的资源
+        tokens = {channel.running[0] for channel in self.channels.values() if channel.running is not None}
+        if tokens:
+            self.running_callbacks.append((tokens, callback))
+        else:
+            callback()
+
+    def _start(self, channel_name, channel, request):
+        channel.pending = None
+        channel.running = request
+        task = CompositeTask(request[1], request[0], request[4])
+        task.signals.finished.connect(
+            lambda token, result, name=channel_name: self._on_finished(name, token, result))
+        self.pool.start(task)
+
+    def _on_finished(self, channel_name, token, result):
+        channel = self.channels[channel_name]
+        request = channel.running
+        channel.running = None
+        if token.cancelled:
+            self._discard(request, result)
+        else:
+            request[2](result)
+        if channel.pending is not None:
+            self._start(channel_name, channel, channel.pending)
+        else:
+            del self.channels[channel_name]
+        ready = []
+        for tokens, callback in self.running_callbacks:
+            tokens.discard(token)
+            if not tokens:
+                ready.append(callback)
+        self.running_callbacks = [entry for entry in self.running_callbacks if entry[0]]
+        for callback in ready:
+            callback()
+
+    @staticmethod
+    def _discard(request, result):
+        if request[3] is not None:
+            request[3](result)
@@ -0,0 +1,347 @@
+import os
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from component_cache import default_cache
+from profiler import span
+from synthesis_util import CG_synthesis_opencv, blend_layer, blend_layer_stack, place_layer
+
+# 前缀画布缓存上限，可通过环境变量ESCUDE_PREFIX_CACHE_MB调整（单位MB）
+DEFAULT_PREFIX_CACHE_BYTES = int(os.environ.get('ESCUDE_PREFIX_CACHE_MB', '256')) * 1024 * 1024
+# 批量合成时每批的组合数，可通过环境变量ESCUDE_BATCH_SIZE调整
+DEFAULT_BATCH_SIZE = int(os.environ.get('ESCUDE_BATCH_SIZE', '16'))
+
+
+def block_key(block):
+    return block.name, block.x, block.y
+
+
+class PrefixNode:
+    __slots__ = ('parent', 'key', 'children', 'canvas')
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        self.canvas = None
+
+
+class LayerCompositor:
+    # 以图层序列为键的前缀树缓存中间画布，新的组合只需混合与已缓存前缀不同的图层
+    # compose返回的画布被缓存共享，为只读数组；level大于0时以2^level缩小的分辨率合成
+    # token为composite_worker.CancelToken，每混合一层之前检查一次，被取消时返回None，已混合的前缀仍保留在缓存中
+    def __init__(self, x, y, dir_path, cache=None, engine=None, max_bytes=DEFAULT_PREFIX_CACHE_BYTES, level=0):
+        self.x = x
+        self.y = y
+        self.level = level
+        self.width = x >> level
+        self.height = y >> level
+        self.dir_path = dir_path
+        self.cache = cache if cache is not None else default_cache
+        self.engine = engine
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.blended_layers = 0
+        self.reused_layers = 0
+        self._root = PrefixNode(None, None)
+        self._root.canvas = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        self._root.canvas.setflags(write=False)
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compose(self, operation_blocks, token=None):
+        with span('compose'):
+            return self._compose(operation_blocks, token)
+
+    def _compose(self, operation_blocks, token=None):
+        with self._lock:
+            keys = [block_key(block) for block in operation_blocks]
+            node = self._root
+            best, depth = self._root, 0
+            for i, key in enumerate(keys):
+                node = node.children.get(key)
+                if node is None:
+                    break
+                if node.canvas is not None:
+                    best, depth = node, i + 1
+            self._touch(best)
+            self.reused_layers += depth
+            if depth == len(keys):
+                return best.canvas
+
+            node = best
+            image = best.canvas.copy()
+            for i in range(depth, len(keys)):
+                if token is not None and token.cancelled:
+                    return None
+                image = CG_synthesis_opencv(image, operation_blocks[i], self.dir_path, 1, self.cache, self.engine,
+                                            self.level)
+                self.blended_layers += 1
+                child = node.children.get(keys[i])
+                if child is None:
+                    child = PrefixNode(node, keys[i])
+                    node.children[keys[i]] = child
+                node = child
+                # 最后一层直接缓存结果本身，中间层缓存副本后继续在image上混合
+                canvas = image if i == len(keys) - 1 else image.copy()
+                canvas.setflags(write=False)
+                self._store(node, canvas)
+            return image
+
+    def cached_prefix(self, operation_blocks, limit):
+        # 返回前limit个图层内最长的已缓存前缀(深度, 画布)
+        with self._lock:
+            node = self._root
+            best, depth = self._root, 0
+            for i, block in enumerate(operation_blocks[:limit]):
+                node = node.children.get(block_key(block))
+                if node is None:
+                    break
+                if node.canvas is not None:
+                    best, depth = node, i + 1
+            self._touch(best)
+            return depth, best.canvas
+
+    def _touch(self, node):
+        if node in self._lru:
+            self._lru.move_to_end(node)
+
+    def _store(self, node, canvas):
+        if canvas.nbytes > self.max_bytes:
+            return
+        if node.canvas is not None:
+            self.current_bytes -= node.canvas.nbytes
+        node.canvas = canvas
+        self.current_bytes += canvas.nbytes
+        self._lru[node] = None
+        self._lru.move_to_end(node)
+        while self.current_bytes > self.max_bytes:
+            old_node, _ = self._lru.popitem(last=False)
+            self._drop(old_node)
+
+    def _drop(self, node):
+        self.current_bytes -= node.canvas.nbytes
+        node.canvas = None
+        # 没有画布也没有子节点的节点从前缀树中移除
+        while node.parent is not None and node.canvas is None and not node.children:
+            del node.parent.children[node.key]
+            node = node.parent
+
+    def clear(self):
+        with self._lock:
+            self._root.children.clear()
+            self._lru.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'blended_layers': self.blended_layers,
+                'reused_layers': self.reused_layers,
+                'entries': len(self._lru),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def union_rect(rects):
+    rects = [rect for rect in rects if rect is not None]
+    if not rects:
+        return None
+    x0 = min(rect[0] for rect in rects)
+    y0 = min(rect[1] for rect in rects)
+    x1 = max(rect[0] + rect[2] for rect in rects)
+    y1 = max(rect[1] + rect[3] for rect in rects)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class IncrementalCompositor:
+    # 保存当前画布与各图层的包围盒，切换差分时只重新合成变化图层新旧包围盒的并集区域
+    # update返回(画布, 脏矩形)，脏矩形为None表示画布没有变化；被token取消时返回None，画布保持不变
+    FULL_REDRAW_RATIO = 0.5
+
+    def __init__(self, compositor):
+        self.compositor = compositor
+        self.canvas = None
+        self.blocks = []
+        self.rects = {}
+
+    def layer_rect(self, block):
+        # 与CG_synthesis_opencv一致：缺失或越界的组件不参与合成；包围盒为裁掉透明边框后的区域
+        compositor = self.compositor
+        layer = compositor.cache.load_layer(compositor.dir_path, block.name, compositor.level)
+        if layer is None:
+            return None
+        x, y = block.x >> compositor.level, block.y >> compositor.level
+        if x + layer.width > compositor.width or y + layer.height > compositor.height:
+            return None
+        op_h, op_w = layer.pixels.shape[:2]
+        if op_h == 0:
+            return None
+        return x + layer.dx, y + layer.dy, op_w, op_h
+
+    def reset(self):
+        self.canvas = None
+        self.blocks = []
+        self.rects = {}
+
+    def update(self, operation_blocks, token=None):
+        with span('compose.incremental'):
+            return self._update(operation_blocks, token)
+
+    def _update(self, operation_blocks, token=None):
+        operation_blocks = list(operation_blocks)
+        new_keys = [block_key(block) for block in operation_blocks]
+        for block, key in zip(operation_blocks, new_keys):
+            if key not in self.rects:
+                if token is not None and token.cancelled:
+                    return None
+                self.rects[key] = self.layer_rect(block)
+
+        full_rect = (0, 0, self.compositor.width, self.compositor.height)
+        if self.canvas is None:
+            return self._redraw(operation_blocks, full_rect, token)
+
+        old_counts = Counter(block_key(block) for block in self.blocks)
+        new_counts = Counter(new_keys)
+        changed = {key for key in old_counts.keys() | new_counts.keys() if old_counts[key] != new_counts[key]}
+        if not changed:
+            self.blocks = operation_blocks
+            return self.canvas, None
+        dirty = union_rect(self.rects.get(key) for key in changed)
+        if dirty is None:
+            self.blocks = operation_blocks
+            return self.canvas, None
+        if dirty[2] * dirty[3] > self.FULL_REDRAW_RATIO * self.compositor.width * self.compositor.height:
+            return self._redraw(operation_blocks, full_rect, token)
+
+        # 从第一个变化图层之下已缓存的前缀画布开始，只混合与脏矩形相交的图层
+        first_changed = next((i for i, key in enumerate(new_keys) if key in changed), len(new_keys))
+        depth, base = self.compositor.cached_prefix(operation_blocks, first_changed)
+        dx, dy, dw, dh = dirty
+        region = base[dy:dy + dh, dx:dx + dw].copy()
+        for block, key in zip(operation_blocks[depth:], new_keys[depth:]):
+            if token is not None and token.cancelled:
+                return None
+            rect = self.rects[key]
+            if rect is None:
+                continue
+            x0, y0 = max(rect[0], dx), max(rect[1], dy)
+            x1, y1 = min(rect[0] + rect[2], dx + dw), min(rect[1] + rect[3], dy + dh)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            layer = self.compositor.cache.load_layer(self.compositor.dir_path, block.name, self.compositor.level)
+            if layer is None:
+                continue
+            # blend_layer会把超出脏矩形的部分裁掉
+            blend_layer(region, layer, rect[0] - dx, rect[1] - dy, self.compositor.engine)
+        self.canvas[dy:dy + dh, dx:dx + dw] = region
+        self.blocks = operation_blocks
+        return self.canvas, dirty
+
+    def _redraw(self, operation_blocks, full_rect, token=None):
+        canvas = self.compositor.compose(operation_blocks, token)
+        if canvas is None:
+            return None
+        self.canvas = canvas.copy()
+        self.blocks = operation_blocks
+        return self.canvas, full_rect
+
+
+def stream_composites(compositor, variants):
+    # 按顺序遍历variants（例如LSFFile.iter_variants的输出），产出(variant, compose)，compose()合成并返回该组合的画布
+    # 按格雷码顺序枚举时相邻组合只差一个图层，只需重新合成该图层新旧包围盒的区域；
+    # 没有调用compose的组合（已完成或缓存命中）不合成，之后的组合相对上一次实际合成的组合增量更新
+    # 画布会在下一次调用compose时被原地修改，调用方需要在此之前处理完或自行复制
+    incremental = IncrementalCompositor(compositor)
+    for variant in variants:
+        yield variant, lambda blocks=variant.blocks: incremental.update(blocks)[0]
+
+
+def common_prefix(key_lists):
+    if not key_lists:
+        return 0
+    depth = min(len(keys) for keys in key_lists)
+    for i in range(depth):
+        key = key_lists[0][i]
+        if any(keys[i] != key for keys in key_lists):
+            return i
+    return depth
+
+
+def member_index(members, n):
+    # 连续的下标用切片，混合时直接在stack上原地进行
+    if members[-1] - members[0] + 1 == len(members):
+        return slice(members[0], members[-1] + 1) if len(members) < n else slice(None)
+    return np.asarray(members)
+
+
+def compose_batch(x, y, block_lists, dir_path, cache=None, engine=None, level=0):
+    # 把同一lsf文件（相同画布大小）的多个组合一次合成为(N, H, W, 4)的数组，每张与synthesis()的结果逐像素一致
+    # 所有组合共有的图层前缀只合成一次再广播到每张画布；之后逐层处理，同一层上使用相同图层的组合一起混合
+    block_lists = [list(blocks) for blocks in block_lists]
+    width, height = x >> level, y >> level
+    n = len(block_lists)
+    stack = np.empty((n, height, width, 4), dtype=np.uint8)
+    if n == 0:
+        return stack
+    key_lists = [[block_key(block) for block in blocks] for blocks in block_lists]
+    depth = common_prefix(key_lists)
+    canvas = np.zeros((height, width, 4), dtype=np.uint8)
+    for block in block_lists[0][:depth]:
+        placed = place_layer(width, height, block, dir_path, cache, level)
+        if placed is not None:
+            blend_layer(canvas, placed[0], placed[1], placed[2], engine)
+    stack[:] = canvas
+    del canvas
+
+    placements = {}
+    for i in range(depth, max(len(keys) for keys in key_lists)):
+        # 同一层上的各组图层作用于互不相交的组合，处理顺序不影响结果
+        groups = {}
+        for index, keys in enumerate(key_lists):
+            if i < len(keys):
+                groups.setdefault(keys[i], []).append(index)
+        for key, members in groups.items():
+            if key not in placements:
+                placements[key] = place_layer(width, height, block_lists[members[0]][i], dir_path, cache, level)
+            placed = placements[key]
+            if placed is not None:
+                blend_layer_stack(stack, member_index(members, n), placed[0], placed[1], placed[2], engine)
+    return stack
+
+
+class BatchCompositor:
+    # 按batch_size个一批合成同一lsf文件的多个组合，get(i)在第一次请求第i个组合所在的批次时合成整批
+    # 返回的画布是批次数组中的只读视图，之后的批次重新分配数组，不影响已经返回的画布
+    def __init__(self, x, y, block_lists, dir_path, cache=None, engine=None, batch_size=DEFAULT_BATCH_SIZE,
+                 level=0):
+        self.x = x
+        self.y = y
+        self.block_lists = list(block_lists)
+        self.dir_path = dir_path
+        self.cache = cache
+        self.engine = engine
+        self.batch_size = max(1, batch_size)
+        self.level = level
+        self._start = None
+        self._stack = None
+
+    def __len__(self):
+        return len(self.block_lists)
+
+    def get(self, index):
+        start = index - index % self.batch_size
+        if start != self._start:
+            with span('compose.batch'):
+                stack = compose_batch(self.x, self.y, self.block_lists[start:start + self.batch_size],
+                                      self.dir_path, self.cache, self.engine, self.level)
+            stack.setflags(write=False)
+            self._start, self._stack = start, stack
+        return self._stack[index - start]
+
+    def __iter__(self):
+        for index in range(len(self.block_lists)):
+            yield self.get(index)
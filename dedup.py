@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from exporter import write_file
+
+# 去重模式：skip为不输出重复的组合，link为把重复的组合硬链接到已输出的图片
+DEDUP_SKIP = 'skip'
+DEDUP_LINK = 'link'
+DEDUP_MODES = (DEDUP_SKIP, DEDUP_LINK)
+DEDUP_MANIFEST = 'dedup_manifest.json'
+# 持久化缓存中与合成结果一起保存的像素哈希
+DIGEST_SUFFIX = '.digest'
+
+
+def blocks_signature(width, height, operation_blocks):
+    # 合成结果只由画布大小与按顺序混合的(组件, 偏移量)决定，lsf文件名与差分键不影响结果
+    layers = tuple((block.name, block.x, block.y) for block in operation_blocks)
+    return hashlib.sha1(repr((width, height, layers)).encode('utf-8')).hexdigest()
+
+
+def pixel_hasher(shape):
+    # 依次传入按行排列的像素，结果与对完整图片调用pixel_digest相同
+    return hashlib.blake2b(repr(tuple(shape)).encode('ascii'), digest_size=20)
+
+
+def pixel_digest(image):
+    digest = pixel_hasher(image.shape)
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+class Deduplicator:
+    # 记录本进程已输出图片的图层签名与像素哈希；entries按提交顺序保存(输出路径, 相同图片的路径, 签名, 像素哈希)，
+    # 相同图片的路径为None表示该组合实际输出了图片
+    def __init__(self):
+        self.signatures = {}
+        self.digests = {}
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def seed(self, signatures):
+        # 登记之前的运行已输出的图片{签名: 路径}，之后相同图层的组合直接对应到这些图片
+        # 不登记像素哈希：之前的图片可能在本次运行中因组件修改而重新输出，像素不再相同
+        with self._lock:
+            for signature, path in signatures.items():
+                self.signatures.setdefault(signature, path)
+
+    def claim(self, path, signature, digest=None):
+        # 返回已输出的相同图片路径，此时path不需要输出；digest为None时只按签名查找，未找到时不登记
+        with self._lock:
+            canonical = self.signatures.get(signature)
+            if canonical == path:
+                # 之前的运行输出的正是本组合，本次需要重新输出
+                canonical = None
+            if canonical is None and digest is not None:
+                canonical = self.digests.get(digest)
+            if canonical is not None:
+                self.signatures.setdefault(signature, canonical)
+                self.entries.append((path, canonical, signature, digest))
+                return canonical
+            if digest is not None:
+                self.signatures[signature] = path
+                self.digests[digest] = path
+                self.entries.append((path, None, signature, digest))
+            return None
+
+    def take_entries(self):
+        with self._lock:
+            entries, self.entries = self.entries, []
+        return entries
+
+
+def resolve_entries(entries):
+    # 合并各进程的记录：不同进程可能各自输出了相同的图片，按任务顺序保留第一张
+    # 返回{输出路径: 实际图片路径}，实际图片路径与输出路径不同的输出即为重复的组合
+    signatures = {}
+    digests = {}
+    manifest = {}
+    for path, canonical, signature, digest in entries:
+        if canonical is None:
+            canonical = signatures.get(signature) or digests.get(digest) or path
+        else:
+            canonical = manifest.get(canonical, canonical)
+        manifest[path] = canonical
+        signatures.setdefault(signature, canonical)
+        if digest is not None:
+            digests.setdefault(digest, canonical)
+    return manifest
+
+
+def link_file(source, path):
+    # 文件系统不支持硬链接时退回复制
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+def load_manifest(out_dir):
+    # 读取输出目录中之前写出的去重清单，不存在或无法解析时返回空的清单
+    try:
+        with open(os.path.join(out_dir, DEDUP_MANIFEST), 'r', encoding='utf-8') as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def previous_signatures(out_dir, settings):
+    # 返回之前的运行以相同设置（混合引擎与导出格式）输出且仍然存在的图片{签名: 路径}
+    data = load_manifest(out_dir)
+    if data.get('settings') != settings:
+        return {}
+    signatures = {}
+    for signature, canonical in data.get('signatures', {}).items():
+        path = os.path.join(out_dir, canonical)
+        if os.path.exists(path):
+            signatures[signature] = path
+    return signatures
+
+
+def apply_dedup(out_dir, entries, mode, settings=None):
+    # 删除或链接重复的输出，并在输出目录写出去重清单；返回本次运行的{输出路径: 实际图片路径}
+    # 清单与之前运行写出的清单合并，实际图片已不存在的旧记录被丢弃；settings与签名一起保存，设置相同时下次运行用于去重
+    manifest = resolve_entries(entries)
+    for path, canonical in manifest.items():
+        if path == canonical:
+            continue
+        if mode == DEDUP_LINK:
+            link_file(canonical, path)
+        elif os.path.lexists(path):
+            # 本次已经写出，或之前的运行输出过、本次成为重复的组合
+            os.remove(path)
+    current = {os.path.relpath(path, out_dir): os.path.relpath(canonical, out_dir)
+               for path, canonical in manifest.items()}
+
+    def carried(mapping):
+        # 之前的记录指向本次成为重复的图片时改为指向其实际图片
+        carried = {}
+        for key, canonical in mapping.items():
+            canonical = current.get(canonical, canonical)
+            if os.path.exists(os.path.join(out_dir, canonical)):
+                carried[key] = canonical
+        return carried
+
+    previous = load_manifest(out_dir)
+    outputs = carried(previous.get('outputs', {}))
+    outputs.update(current)
+    signatures = carried(previous.get('signatures', {})) if previous.get('settings') == settings else {}
+    for path, _, signature, _ in entries:
+        signatures.setdefault(signature, current[os.path.relpath(path, out_dir)])
+    data = json.dumps({'mode': mode, 'settings': settings, 'outputs': outputs, 'signatures': signatures},
+                      ensure_ascii=False, indent=1)
+    write_file(os.path.join(out_dir, DEDUP_MANIFEST), data.encode('utf-8'))
+    return manifest
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import shutil
+import threading
+
+import cv2
+import numpy as np
+
+from file_util import create_temp_file
+from profiler import span
+
+# 持久化缓存目录与上限，可通过环境变量ESCUDE_DISK_CACHE_DIR与ESCUDE_DISK_CACHE_MB调整
+DEFAULT_DISK_CACHE_DIR = os.environ.get('ESCUDE_DISK_CACHE_DIR',
+                                        os.path.join(os.path.expanduser('~'), '.cache', 'escude-cg-composer'))
+DEFAULT_DISK_CACHE_BYTES = int(os.environ.get('ESCUDE_DISK_CACHE_MB', '2048')) * 1024 * 1024
+
+_digest_lock = threading.Lock()
+_lsf_digests = {}
+
+
+def lsf_digest(file_path):
+    # lsf文件内容的哈希，按(路径, 大小, 修改时间)记忆，文件不变时不重复读取
+    st = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        digest = _lsf_digests.get(memo_key)
+    if digest is None:
+        with open(file_path, 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        with _digest_lock:
+            _lsf_digests[memo_key] = digest
+    return digest
+
+
+def component_fingerprint(dir_path, block_name):
+    # 组件图集中记录了打包时PNG文件的大小与修改时间，与解包目录生成相同的键
+    if not isinstance(dir_path, str):
+        return dir_path.fingerprint(block_name)
+    try:
+        st = os.stat(os.path.join(dir_path, block_name + '.png'))
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def make_key(*parts):
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def composite_key(lsf_path, operation_blocks, dir_path, **options):
+    # 由lsf文件哈希、解析后的图层列表以及各组件文件的大小与修改时间生成缓存键
+    layers = tuple((block.name, block.x, block.y, component_fingerprint(dir_path, block.name))
+                   for block in operation_blocks)
+    digest = lsf_digest(lsf_path) if isinstance(dir_path, str) else dir_path.lsf_digest(lsf_path)
+    return make_key(digest, layers, tuple(sorted(options.items())))
+
+
+def component_key(dir_path, block_name, **options):
+    return make_key(block_name, component_fingerprint(dir_path, block_name), tuple(sorted(options.items())))
+
+
+class DiskCache:
+    # 以内容哈希为键的持久化缓存，条目按最近访问时间做LRU淘汰
+    # 写入先写临时文件再重命名，多个进程同时读写同一目录也不会读到不完整的文件
+    def __init__(self, root=DEFAULT_DISK_CACHE_DIR, max_bytes=DEFAULT_DISK_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path_for(self, key, suffix='.png'):
+        return os.path.join(self.root, key[:2], key + suffix)
+
+    def get(self, key, suffix='.png'):
+        path = self.path_for(key, suffix)
+        try:
+            with span('disk_cache.read'), open(path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data, suffix='.png'):
+        self._store(key, suffix, lambda file: file.write(data))
+
+    def put_file(self, key, source, suffix='.png'):
+        # 复制已写出的文件，不需要把文件内容读入内存
+        with open(source, 'rb') as src:
+            self._store(key, suffix, lambda file: shutil.copyfileobj(src, file))
+
+    def _store(self, key, suffix, write):
+        path = self.path_for(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with span('disk_cache.write'):
+            fd, tmp_path = create_temp_file(os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    write(file)
+                    size = file.tell()
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_bytes:
+                self.evict()
+
+    def get_image(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is not None:
+            image.setflags(write=False)
+        return image
+
+    def put_image(self, key, image, compression=1):
+        ok, data = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+        if ok:
+            self.put(key, data.tobytes())
+
+    def get_or_create_image(self, key, producer):
+        image = self.get_image(key)
+        if image is None:
+            image = producer()
+            if image is not None:
+                self.put_image(key, image)
+        return image
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for sub_dir in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for filename in os.listdir(sub_path):
+                if filename.startswith('.tmp-'):
+                    continue
+                path = os.path.join(sub_path, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def evict(self):
+        # 重新统计目录大小，超出上限时删除最久未访问的条目直到低于上限的90%
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # 其他进程可能已经删除了该条目
+                    pass
+                total -= size
+        self._size = total
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'max_bytes': self.max_bytes}
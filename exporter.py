@@ -0,0 +1,389 @@
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from file_util import create_temp_file
+from profiler import span
+
+# 导出格式：png为OpenCV的PNG编码，webp为无损WebP，qoi为QOI格式，raw为NumPy的.npy（原始BGRA像素加形状信息）
+FORMAT_PNG = 'png'
+FORMAT_WEBP = 'webp'
+FORMAT_QOI = 'qoi'
+FORMAT_RAW = 'raw'
+EXPORT_FORMATS = (FORMAT_PNG, FORMAT_WEBP, FORMAT_QOI, FORMAT_RAW)
+EXTENSIONS = {FORMAT_PNG: '.png', FORMAT_WEBP: '.webp', FORMAT_QOI: '.qoi', FORMAT_RAW: '.npy'}
+
+PNG_STRATEGIES = {
+    'default': cv2.IMWRITE_PNG_STRATEGY_DEFAULT,
+    'filtered': cv2.IMWRITE_PNG_STRATEGY_FILTERED,
+    'huffman': cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY,
+    'rle': cv2.IMWRITE_PNG_STRATEGY_RLE,
+    'fixed': cv2.IMWRITE_PNG_STRATEGY_FIXED,
+}
+
+QOI_END = b'\0' * 7 + b'\1'
+
+# 可以逐行写出的格式，用于分块合成时不保存完整画布
+ROW_FORMATS = (FORMAT_PNG, FORMAT_RAW)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# 逐行写出PNG时每次滤波与压缩的行数，滤波的临时数组只与该行数有关
+PNG_ROW_CHUNK = 16
+ZLIB_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+# png_compression与png_strategy为None时使用OpenCV的默认设置，与cv2.imwrite的输出一致
+ExportSettings = namedtuple('ExportSettings', ['format', 'png_compression', 'png_strategy'],
+                            defaults=[FORMAT_PNG, None, None])
+
+
+def settings_extension(settings):
+    return EXTENSIONS[settings.format]
+
+
+def settings_options(settings):
+    # 用于持久化缓存键，不同的编码设置对应不同的缓存条目
+    return {'format': settings.format, 'png_compression': settings.png_compression,
+            'png_strategy': settings.png_strategy}
+
+
+def format_for_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    for fmt, fmt_extension in EXTENSIONS.items():
+        if extension == fmt_extension:
+            return fmt
+    return FORMAT_PNG
+
+
+def qoi_encode(image):
+    # 向量化的QOI编码：索引表中哈希为h的项总是最近一个哈希为h的像素，因此每个像素的编码方式可以一次性算出
+    h, w, c = image.shape
+    if c == 4:
+        pixels = np.ascontiguousarray(image[:, :, [2, 1, 0, 3]]).reshape(-1, 4)
+    else:
+        pixels = np.empty((h * w, 4), dtype=np.uint8)
+        pixels[:, :3] = image[:, :, ::-1].reshape(-1, 3)
+        pixels[:, 3] = 255
+    n = len(pixels)
+    packed = pixels.view(np.uint32).ravel()
+    prev = np.empty_like(pixels)
+    prev[0] = (0, 0, 0, 255)
+    prev[1:] = pixels[:-1]
+    prev_packed = prev.view(np.uint32).ravel()
+
+    # 与前一像素相同的像素组成游程，每62个或游程结束时输出一个字节
+    is_run = packed == prev_packed
+    starts = is_run & ~np.concatenate(([False], is_run[:-1]))
+    run_start = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+    position = np.arange(n) - run_start
+    run_end = is_run & (((position + 1) % 62 == 0) | ~np.concatenate((is_run[1:], [False])))
+
+    wide = pixels.astype(np.int16)
+    hashes = (wide[:, 0] * 3 + wide[:, 1] * 5 + wide[:, 2] * 7 + wide[:, 3] * 11) % 64
+    # 开头与初始前一像素(0, 0, 0, 255)相同的游程不会写入索引表，查找时排除
+    lookup = hashes.astype(np.int8)
+    lookup[:int(np.argmin(is_run)) if not is_run.all() else n] = -1
+    order = np.argsort(lookup, kind='stable')
+    previous_same = np.full(n, -1, dtype=np.int64)
+    same = (lookup[order[1:]] == lookup[order[:-1]]) & (lookup[order[1:]] >= 0)
+    previous_same[order[1:][same]] = order[:-1][same]
+    index_value = np.where(previous_same >= 0, packed[np.maximum(previous_same, 0)], 0)
+    is_index = ~is_run & (packed == index_value)
+
+    diff = (wide[:, :3] - prev[:, :3].astype(np.int16) + 128) % 256 - 128
+    rest = ~is_run & ~is_index
+    same_alpha = pixels[:, 3] == prev[:, 3]
+    is_diff = rest & same_alpha & np.all((diff >= -2) & (diff <= 1), axis=1)
+    dr_dg = diff[:, 0] - diff[:, 1]
+    db_dg = diff[:, 2] - diff[:, 1]
+    is_luma = rest & same_alpha & ~is_diff & (diff[:, 1] >= -32) & (diff[:, 1] <= 31) \
+        & (dr_dg >= -8) & (dr_dg <= 7) & (db_dg >= -8) & (db_dg <= 7)
+    is_rgb = rest & same_alpha & ~is_diff & ~is_luma
+    is_rgba = rest & ~same_alpha
+
+    lengths = run_end + is_index + is_diff + is_luma * 2 + is_rgb * 4 + is_rgba * 5
+    offsets = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    at = offsets[run_end]
+    out[at] = 0xC0 | (position[run_end] % 62)
+    out[offsets[is_index]] = hashes[is_index]
+    d = diff[is_diff] + 2
+    out[offsets[is_diff]] = 0x40 | (d[:, 0] << 4) | (d[:, 1] << 2) | d[:, 2]
+    at = offsets[is_luma]
+    out[at] = 0x80 | (diff[is_luma, 1] + 32)
+    out[at + 1] = ((dr_dg[is_luma] + 8) << 4) | (db_dg[is_luma] + 8)
+    at = offsets[is_rgb]
+    out[at] = 0xFE
+    for k in range(3):
+        out[at + 1 + k] = pixels[is_rgb, k]
+    at = offsets[is_rgba]
+    out[at] = 0xFF
+    for k in range(4):
+        out[at + 1 + k] = pixels[is_rgba, k]
+    header = b'qoif' + struct.pack('>IIBB', w, h, c, 0)
+    return header + out.tobytes() + QOI_END
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png_filter_rows(rows, prev, adaptive):
+    # rows为(n, 字节数)的RGBA行，prev为第一行的上一行；返回每行前加上滤波类型字节的结果
+    # 与OpenCV默认设置一致只使用Sub滤波；adaptive时与libpng相同，每行选择有符号差值绝对值之和最小的滤波
+    if not adaptive:
+        # uint8减法按256取模，正好是滤波的结果
+        out = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        out[:, 0] = 1
+        out[:, 1:5] = rows[:, :4]
+        np.subtract(rows[:, 4:], rows[:, :-4], out=out[:, 5:])
+        return out
+    raw = rows.astype(np.int16)
+    left = np.zeros_like(raw)
+    left[:, 4:] = raw[:, :-4]
+    up = np.empty_like(raw)
+    up[0] = prev
+    up[1:] = raw[:-1]
+    up_left = np.zeros_like(raw)
+    up_left[:, 4:] = up[:, :-4]
+    # Paeth预测：p = a + b - c，取a、b、c中与p最接近的一个，相同时依次优先a、b
+    estimate = left + up - up_left
+    pa, pb, pc = np.abs(estimate - left), np.abs(estimate - up), np.abs(estimate - up_left)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    candidates = np.stack([raw, raw - left, raw - up, raw - ((left + up) >> 1), raw - paeth]) & 0xFF
+    cost = np.abs(candidates.astype(np.uint8).view(np.int8).astype(np.int32)).sum(axis=2)
+    choice = np.argmin(cost, axis=0)
+    out = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = choice
+    out[:, 1:] = candidates[choice, np.arange(len(rows))]
+    return out
+
+
+class PngRowWriter:
+    # 逐行写出RGBA PNG：每批行滤波后送入zlib流，压缩结果作为IDAT块写出，内存只与每批的行数有关
+    # png_compression为None时与OpenCV的默认设置相同（压缩级别1、Sub滤波、RLE策略），否则使用自适应滤波
+    def __init__(self, file, width, height, settings):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.adaptive = settings.png_compression is not None
+        level = settings.png_compression if self.adaptive else 1
+        strategy = ZLIB_STRATEGIES[settings.png_strategy or 'rle']
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+        self._prev = np.zeros(width * 4, dtype=np.int16)
+        file.write(PNG_SIGNATURE + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+
+    def write(self, rows):
+        # rows为(n, 宽, 4)的BGRA像素
+        for start in range(0, len(rows), PNG_ROW_CHUNK):
+            chunk = rows[start:start + PNG_ROW_CHUNK]
+            rgba = np.ascontiguousarray(chunk[:, :, [2, 1, 0, 3]]).reshape(len(chunk), -1)
+            filtered = png_filter_rows(rgba, self._prev, self.adaptive)
+            self._prev = rgba[-1].astype(np.int16)
+            self._write_idat(self._compressor.compress(filtered.data))
+        self.rows += len(rows)
+
+    def _write_idat(self, data):
+        if data:
+            self.file.write(png_chunk(b'IDAT', data))
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f"写出的行数与图片高度不一致: {self.rows} != {self.height}")
+        self._write_idat(self._compressor.flush())
+        self.file.write(png_chunk(b'IEND', b''))
+
+
+class NpyRowWriter:
+    # 逐行写出.npy：文件头与np.save相同，之后按行顺序写出原始BGRA像素
+    def __init__(self, file, width, height, settings=None):
+        self.file = file
+        self.height = height
+        self.rows = 0
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)), 'fortran_order': False,
+                  'shape': (height, width, 4)}
+        np.lib.format.write_array_header_1_0(file, header)
+
+    def write(self, rows):
+        self.rows += len(rows)
+        self.file.write(np.ascontiguousarray(rows).data)
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f"写出的行数与图片高度不一致: {self.rows} != {self.height}")
+
+
+def open_row_writer(file, width, height, settings):
+    if settings.format == FORMAT_PNG:
+        return PngRowWriter(file, width, height, settings)
+    if settings.format == FORMAT_RAW:
+        return NpyRowWriter(file, width, height, settings)
+    raise ValueError(f"该格式不支持逐行写出: {settings.format}")
+
+
+def encode_image(image, settings):
+    with span('encode.' + settings.format):
+        return _encode_image(image, settings)
+
+
+def _encode_image(image, settings):
+    fmt = settings.format
+    if fmt == FORMAT_QOI:
+        return qoi_encode(image)
+    if fmt == FORMAT_RAW:
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(image))
+        return buffer.getvalue()
+    params = []
+    if fmt == FORMAT_PNG:
+        if settings.png_compression is not None:
+            params += [cv2.IMWRITE_PNG_COMPRESSION, settings.png_compression]
+        if settings.png_strategy is not None:
+            params += [cv2.IMWRITE_PNG_STRATEGY, PNG_STRATEGIES[settings.png_strategy]]
+    elif fmt == FORMAT_WEBP:
+        # 质量大于100时OpenCV使用无损WebP
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        raise ValueError(f"未知的导出格式: {fmt}")
+    ok, encoded = cv2.imencode(EXTENSIONS[fmt], image, params)
+    if not ok:
+        raise ValueError(f"编码失败: {fmt}")
+    return encoded.tobytes()
+
+
+def write_file(path, data, atomic=True):
+    # 先写同目录下的临时文件再重命名，中断时不会留下不完整的输出文件
+    with span('write'):
+        if not atomic:
+            with open(path, 'wb') as file:
+                file.write(data)
+            return
+        fd, tmp_path = create_temp_file(os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+def export_image(path, image, settings=ExportSettings(), atomic=True):
+    # 编码并写出一张图片，返回编码耗时（秒）与文件大小
+    start = time.perf_counter()
+    data = encode_image(image, settings)
+    encode_seconds = time.perf_counter() - start
+    write_file(path, data, atomic)
+    return encode_seconds, len(data)
+
+
+class Exporter:
+    # 导出阶段：编码与写出在线程池中进行，合成线程只负责提交
+    # 已提交但尚未写出的图片超过queue_size时submit阻塞，避免合成快于编码时内存无限增长
+    # 提交后调用方不能再修改image；records记录每张图片的(路径, 编码耗时, 文件大小)，命中缓存时编码耗时为0
+    # on_written在每张图片写出后以输出路径在导出线程中调用
+    def __init__(self, settings=ExportSettings(), threads=2, queue_size=8, atomic=True, on_written=None):
+        self.settings = settings
+        self.atomic = atomic
+        self.on_written = on_written
+        self.records = []
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._slots = threading.BoundedSemaphore(max(1, queue_size))
+        self._pending = set()
+        self._errors = []
+        self._lock = threading.Lock()
+
+    @property
+    def extension(self):
+        return settings_extension(self.settings)
+
+    def submit(self, path, image=None, data=None, on_encoded=None):
+        # data为已编码的文件内容时直接写出；on_encoded在编码完成后以编码结果调用（例如写入持久化缓存）
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._export, path, image, data, on_encoded)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _export(self, path, image, data, on_encoded):
+        encode_seconds = 0.0
+        if data is None:
+            start = time.perf_counter()
+            data = encode_image(image, self.settings)
+            encode_seconds = time.perf_counter() - start
+            if on_encoded is not None:
+                on_encoded(data)
+        write_file(path, data, self.atomic)
+        self.record(path, encode_seconds, len(data))
+
+    def record(self, path, encode_seconds, size):
+        # 也用于记录调用方直接写出的图片（例如分块合成逐行写出的图片）
+        with self._lock:
+            self.records.append((path, encode_seconds, size))
+        if self.on_written is not None:
+            self.on_written(path)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def wait(self):
+        # 等待已提交的图片全部写出，有失败的图片时抛出第一个异常
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def take_records(self):
+        self.wait()
+        with self._lock:
+            records, self.records = self.records, []
+        return records
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._pool.shutdown()
+
+
+def summarize_records(records):
+    encoded = [seconds for _, seconds, _ in records if seconds > 0]
+    return {
+        'images': len(records),
+        'encoded': len(encoded),
+        'bytes': sum(size for _, _, size in records),
+        'encode_seconds': sum(encoded),
+        'mean_encode_ms': sum(encoded) / len(encoded) * 1000 if encoded else 0.0,
+        'max_encode_ms': max(encoded) * 1000 if encoded else 0.0,
+    }
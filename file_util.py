@@ -0,0 +1,45 @@
+import os
+import tempfile
+import threading
+
+# 进程的umask，第一次创建临时文件时读取
+_umask = None
+_umask_lock = threading.Lock()
+
+
+def _read_proc_umask():
+    # Linux 4.7以上可以从/proc/self/status读取umask，不需要修改它
+    try:
+        with open('/proc/self/status', 'r', encoding='ascii') as file:
+            for line in file:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def process_umask():
+    # 其他系统只能设置再恢复读取，这段时间内其他线程创建的文件使用较严格的0o077，只在第一次调用时进行
+    global _umask
+    with _umask_lock:
+        if _umask is None:
+            umask = _read_proc_umask()
+            if umask is None:
+                umask = os.umask(0o077)
+                os.umask(umask)
+            _umask = umask
+        return _umask
+
+
+def create_temp_file(dir_path, suffix=''):
+    # 在dir_path中创建以.tmp-开头的临时文件，返回(fd, 路径)，重命名后即为输出文件
+    # mkstemp创建的文件权限为0600，改为与直接创建文件相同的0666去掉umask，输出目录可以共享
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-', suffix=suffix)
+    try:
+        os.chmod(tmp_path, 0o666 & ~process_umask())
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    return fd, tmp_path
@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+JOB_MANIFEST = 'job_manifest.sqlite3'
+
+STATE_PENDING = 'pending'
+STATE_DONE = 'done'
+STATE_DUPLICATE = 'duplicate'
+
+# 子进程把已写出的图片攒起来，每隔这么多秒写入一次清单
+CHECKPOINT_INTERVAL = 2.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS variants (
+    path TEXT PRIMARY KEY,
+    lsf TEXT,
+    base INTEGER,
+    face_differences TEXT,
+    face_effects TEXT,
+    holy_light INTEGER,
+    fingerprint TEXT,
+    state TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS variants_lsf ON variants (lsf);
+"""
+
+
+def encode_keys(keys):
+    return json.dumps({str(n): int(key) for n, key in sorted(keys.items())})
+
+
+class JobManifest:
+    # 批量任务清单：记录每个计划输出的组合（lsf文件、底片、差分键、输出文件、输入指纹）及其完成状态
+    # 输入指纹与持久化缓存的键相同，lsf文件、组件图片或导出设置变化后对应的组合重新输出
+    # 多个进程可以同时打开同一个清单，各自标记自己写出的图片
+    def __init__(self, db_path, out_dir, readonly=False):
+        self.db_path = db_path
+        self.out_dir = out_dir
+        self._written = []
+        self._last_checkpoint = time.monotonic()
+        self._lock = threading.Lock()
+        if readonly:
+            self._conn = sqlite3.connect(f'file:{os.path.abspath(db_path)}?mode=ro', uri=True,
+                                         check_same_thread=False, timeout=60)
+            return
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self.checkpoint(force=True)
+        self._conn.close()
+
+    def _finished(self, path, fingerprint, entry):
+        # 已完成且输入未变化；重复的组合在skip模式下没有输出文件
+        if entry is None or entry[0] != fingerprint:
+            return False
+        if entry[1] == STATE_DUPLICATE:
+            return True
+        return entry[1] == STATE_DONE and os.path.exists(os.path.join(self.out_dir, path))
+
+    def sync(self, lsf_name, planned, resume=True, dry_run=False):
+        # planned逐个给出(输出文件名, 底片, 人脸差分, 特效, 圣光, 输入指纹)
+        # 返回需要输出的文件名（不含扩展名）集合与已完成的数量；未完成的组合登记为pending
+        with self._lock:
+            known = {path: (fingerprint, state) for path, fingerprint, state in self._conn.execute(
+                'SELECT path, fingerprint, state FROM variants WHERE lsf = ?', (lsf_name,))}
+            pending = set()
+            rows = []
+            finished = 0
+            now = time.time()
+            for path, base, fd_keys, fe_keys, hl_key, fingerprint in planned:
+                if resume and self._finished(path, fingerprint, known.get(path)):
+                    finished += 1
+                    continue
+                pending.add(os.path.splitext(path)[0])
+                rows.append((path, lsf_name, int(base), encode_keys(fd_keys), encode_keys(fe_keys), int(hl_key),
+                             fingerprint, STATE_PENDING, now))
+            if rows and not dry_run:
+                with self._conn:
+                    self._conn.executemany('INSERT OR REPLACE INTO variants VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return pending, finished
+
+    def mark_written(self, path):
+        # 由导出线程在图片写出后调用，只记录到内存，checkpoint时写入清单
+        with self._lock:
+            self._written.append(os.path.relpath(path, self.out_dir))
+
+    def checkpoint(self, force=False):
+        with self._lock:
+            if not force and time.monotonic() - self._last_checkpoint < CHECKPOINT_INTERVAL:
+                return
+            written, self._written = self._written, []
+            self._last_checkpoint = time.monotonic()
+            if written:
+                self._mark(written, STATE_DONE)
+
+    def mark(self, paths, state):
+        with self._lock:
+            self._mark([os.path.relpath(path, self.out_dir) for path in paths], state)
+
+    def _mark(self, paths, state):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany('UPDATE variants SET state = ?, updated = ? WHERE path = ?',
+                                   [(state, now, path) for path in paths])
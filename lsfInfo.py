@@ -1,30 +1,217 @@
+import itertools
 import os
+from collections import namedtuple
+
+import numpy as np
+
+from profiler import span
+
+# lsf文件头（28字节）与信息块（164字节）的结构化描述，仅列出解析用到的字段
+LSF_HEADER_SIZE = 28
+LSF_BLOCK_SIZE = 164
+LSF_HEADER_DTYPE = np.dtype({
+    'names': ['num', 'x', 'y', 'type'],
+    'formats': ['u1', '<u2', '<u2', 'u1'],
+    'offsets': [10, 12, 16, 25],
+    'itemsize': LSF_HEADER_SIZE,
+})
+LSF_BLOCK_DTYPE = np.dtype({
+    'names': ['name', 'x', 'y', 'type', 'id', 'mode'],
+    'formats': ['S20', '<u2', '<u2', 'u1', 'u1', 'u1'],
+    'offsets': [0, 128, 132, 152, 153, 154],
+    'itemsize': LSF_BLOCK_SIZE,
+})
+
+PARSER_LEGACY = 'legacy'
+PARSER_NUMPY = 'numpy'
+
+# 差分组合的枚举顺序：gray为混合进制反射格雷码，相邻组合只有一个图层不同；lex为普通的字典序
+ORDER_GRAY = 'gray'
+ORDER_LEX = 'lex'
+
+AXIS_BASE = 'base'
+AXIS_FACE_DIFFERENCE = 'fd'
+AXIS_FACE_EFFECT = 'fe'
+AXIS_HOLY_LIGHT = 'hl'
+
+# 一个差分组合：bi为底片键，fd/fe为{组号: 键}，hl为圣光键，blocks为按合成顺序排列的操作块
+Variant = namedtuple('Variant', ['bi', 'fd', 'fe', 'hl', 'blocks'])
+
+
+class BlockTable:
+    # 列式存储的信息块表：数值字段保存在NumPy数组中，名字保存在字符串表中
+    def __init__(self, names, x, y, type, id, mode):
+        self.names = list(names)
+        self.x = np.asarray(x, dtype=np.int32)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.type = np.asarray(type, dtype=np.int16)
+        self.id = np.asarray(id, dtype=np.int16)
+        self.mode = np.asarray(mode, dtype=np.int16)
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        return cls([block.name for block in blocks], [block.x for block in blocks], [block.y for block in blocks],
+                    [block.type for block in blocks], [block.id for block in blocks],
+                    [block.mode for block in blocks])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.names)
+        if not 0 <= index < len(self.names):
+            raise IndexError('block index out of range')
+        return BlockInfo.view(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.names)):
+            yield BlockInfo.view(self, index)
 
 
 class BlockInfo:
+    # BlockTable中一行的轻量视图
+    __slots__ = ('table', 'index')
+
     def __init__(self, name, x, y, type, id, mode):
-        self.name = name
-        self.x = x
-        self.y = y
-        self.type = type
-        self.id = id
-        self.mode = mode
+        self.table = BlockTable([name], [x], [y], [type], [id], [mode])
+        self.index = 0
+
+    @classmethod
+    def view(cls, table, index):
+        block = cls.__new__(cls)
+        block.table = table
+        block.index = index
+        return block
+
+    @property
+    def name(self):
+        return self.table.names[self.index]
+
+    @property
+    def x(self):
+        return int(self.table.x[self.index])
+
+    @property
+    def y(self):
+        return int(self.table.y[self.index])
+
+    @property
+    def type(self):
+        return int(self.table.type[self.index])
+
+    @property
+    def id(self):
+        return int(self.table.id[self.index])
+
+    @property
+    def mode(self):
+        return int(self.table.mode[self.index])
+
+
+def parse_lsf_bytes(datas):
+    # 将文件头与信息块映射到结构化dtype上，一次性解码所有信息块，返回(x, y, type, BlockTable)
+    datas = memoryview(datas)
+    header = np.frombuffer(datas, dtype=LSF_HEADER_DTYPE, count=1)[0]
+    num = int(header['num'])
+    records = np.frombuffer(datas, dtype=LSF_BLOCK_DTYPE, count=num, offset=LSF_HEADER_SIZE)
+    # 名字以第一个0x00截断，与逐字节解析保持一致
+    names = [name.split(b'\0', 1)[0].decode('latin-1') for name in records['name'].tolist()]
+    table = BlockTable(names, records['x'], records['y'], records['type'], records['id'], records['mode'])
+    return int(header['x']), int(header['y']), int(header['type']), table
+
+
+def _group_indices(keys, indices):
+    # 按首次出现的顺序对indices分组，返回(key, 首个下标, 末个下标)
+    if len(indices) == 0:
+        return []
+    uniq, first = np.unique(keys, return_index=True)
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    order = np.argsort(first)
+    return [(int(uniq[i]), int(indices[first[i]]), int(indices[last[i]])) for i in order]
+
+
+def reflected_product(axes):
+    # 混合进制的反射格雷码，逐个产出各轴的下标元组；相邻两项只有一个轴变化且只变化1
+    # 与itertools.product一样惰性产出，内存占用与组合总数无关
+    sizes = [len(axis) for axis in axes]
+    if any(size == 0 for size in sizes):
+        return
+    digits = [0] * len(sizes)
+    directions = [1] * len(sizes)
+    yield tuple(digits)
+    while True:
+        j = len(sizes) - 1
+        while j >= 0 and not 0 <= digits[j] + directions[j] < sizes[j]:
+            directions[j] = -directions[j]
+            j -= 1
+        if j < 0:
+            return
+        digits[j] += directions[j]
+        yield tuple(digits)
+
+
+def _select_keys(keys, selected):
+    # selected为None时使用全部键，否则按keys中的顺序保留被选中的键
+    if selected is None:
+        return list(keys)
+    selected = set(selected)
+    return [key for key in keys if key in selected]
+
+
+def _optional_keys(keys):
+    # 可以不添加的图层：键0在最前，之后为其余的键
+    return [0] + [key for key in keys if key != 0]
 
 
 class LSFFile:
-    def __init__(self, file_path):
+    def __init__(self, file_path, parser=PARSER_NUMPY):
         self.file_path = file_path
+        self.parser = parser
         self.x = 0
         self.y = 0
         self.name = os.path.splitext(os.path.basename(self.file_path))[0]
         self.naked_image = None
-        self.blocks = self._parse_file()
-        self.base_images = {}
-        self.face_differences = {}
-        self.face_effects = {}
-        self.holy_light = {}
+        with span('lsf.parse'):
+            if parser == PARSER_NUMPY:
+                self.blocks = self._parse_file_numpy()
+            elif parser == PARSER_LEGACY:
+                self.blocks = BlockTable.from_blocks(self._parse_file())
+            else:
+                raise ValueError(f"未知的解析模式: {parser}")
+            self.base_images = {}
+            self.face_differences = {}
+            self.face_effects = {}
+            self.holy_light = {}
 
-        self._process_blocks()
+            self._process_blocks()
+
+    @classmethod
+    def from_bytes(cls, file_path, datas):
+        # 由lsf文件内容构造（例如从组件图集中读取），file_path只用于确定名字
+        with span('lsf.parse'):
+            x, y, type, table = parse_lsf_bytes(datas)
+            return cls.from_table(file_path, x, y, type, table)
+
+    @classmethod
+    def from_table(cls, file_path, x, y, type, blocks):
+        # 由已解析好的信息块表直接构造，不读取lsf文件（例如从目录索引中恢复）
+        lsf = cls.__new__(cls)
+        lsf.file_path = file_path
+        lsf.parser = None
+        lsf.x = x
+        lsf.y = y
+        lsf.type = type
+        lsf.name = os.path.splitext(os.path.basename(file_path))[0]
+        lsf.naked_image = None
+        lsf.blocks = blocks
+        lsf.base_images = {}
+        lsf.face_differences = {}
+        lsf.face_effects = {}
+        lsf.holy_light = {}
+        lsf._process_blocks()
+        return lsf
 
     def _parse_file(self):
         blocks = []
@@ -50,31 +237,54 @@ class LSFFile:
             blocks.append(BlockInfo(name, x, y, type, id, mode))
         return blocks
 
+    def _parse_file_numpy(self):
+        with open(self.file_path, 'rb') as file:
+            datas = file.read()
+        self.x, self.y, self.type, table = parse_lsf_bytes(datas)
+        return table
+
     def _process_blocks(self):
-        for block in self.blocks:
-            if block.type == 0 and self.name[0] == '0':
-                self.naked_image = block
-            if block.mode != 0:
-                continue
-            if block.type == 0 or block.type == 3:
-                if block.id not in self.base_images:
-                    self.base_images[block.id] = []
-                    if self.blocks[0].id == 0:
-                        self.base_images[block.id].append(self.blocks[0])
-                self.base_images[block.id].append(block)
-            elif block.type % 10 == 0 or block.type == 1:
-                n = block.type // 10
-                if n not in self.face_differences:
-                    self.face_differences[n] = {}
-                if block.id not in self.face_differences[n]:
-                    self.face_differences[n][block.id] = block
-            elif block.type % 10 == 1 or block.type == 2:
-                n = (block.type - 1) // 10
-                if n not in self.face_effects:
-                    self.face_effects[n] = {}
-                self.face_effects[n][block.id] = block
-            elif block.type == 255:
-                self.holy_light[block.id] = block
+        table = self.blocks
+        types = table.type
+        ids = table.id
+        if self.name[:1] == '0':
+            naked = np.flatnonzero(types == 0)
+            if len(naked) > 0:
+                self.naked_image = table[int(naked[-1])]
+
+        # 用掩码划分各类信息块，优先级与原有的if/elif分支一致
+        candidate = table.mode == 0
+        base_mask = candidate & ((types == 0) | (types == 3))
+        candidate &= ~base_mask
+        fd_mask = candidate & ((types % 10 == 0) | (types == 1))
+        candidate &= ~fd_mask
+        fe_mask = candidate & ((types % 10 == 1) | (types == 2))
+        candidate &= ~fe_mask
+        hl_mask = candidate & (types == 255)
+
+        # 底片：同ID的底片按顺序组合
+        indices = np.flatnonzero(base_mask)
+        for key, _, _ in _group_indices(ids[indices], indices):
+            members = indices[ids[indices] == key]
+            self.base_images[key] = [table[0]] if table.id[0] == 0 else []
+            self.base_images[key].extend(table[int(i)] for i in members)
+
+        # 人物表情差分：同组同ID取第一个
+        indices = np.flatnonzero(fd_mask)
+        groups = types[indices] // 10
+        for key, first, _ in _group_indices(groups.astype(np.int32) * 256 + ids[indices], indices):
+            self.face_differences.setdefault(key // 256, {})[key % 256] = table[first]
+
+        # 脸红特效差分：同组同ID取最后一个
+        indices = np.flatnonzero(fe_mask)
+        groups = (types[indices] - 1) // 10
+        for key, _, last in _group_indices(groups.astype(np.int32) * 256 + ids[indices], indices):
+            self.face_effects.setdefault(key // 256, {})[key % 256] = table[last]
+
+        # 圣光：同ID取最后一个
+        indices = np.flatnonzero(hl_mask)
+        for key, _, last in _group_indices(ids[indices], indices):
+            self.holy_light[key] = table[last]
 
     def get_name(self):
         return self.name
@@ -143,3 +353,61 @@ class LSFFile:
 
         return blocks
 
+    def variant_axes(self, bi_keys=None, fd_keys=None, fe_keys=None, hl_keys=None):
+        # 返回[(轴类型, 组号, 可选键列表)]；fd_keys与fe_keys为{组号: 键列表}，未列出的组使用全部键
+        # 特效与圣光的键0表示不添加该图层（lsf文件中ID为0的特效或圣光同样不会被添加），只出现一次；
+        # 各轴按其图层的合成深度由底到顶排列
+        fd_keys = fd_keys or {}
+        fe_keys = fe_keys or {}
+        axes = [(AXIS_BASE, 0, _select_keys(self.base_images, bi_keys))]
+        for n, group in self.face_differences.items():
+            axes.append((AXIS_FACE_DIFFERENCE, n, _select_keys(group, fd_keys.get(n))))
+        for n, group in self.face_effects.items():
+            axes.append((AXIS_FACE_EFFECT, n, _select_keys(_optional_keys(group), fe_keys.get(n))))
+        if self.holy_light:
+            axes.append((AXIS_HOLY_LIGHT, 0, _select_keys(_optional_keys(self.holy_light), hl_keys)))
+        return sorted(axes, key=self._axis_depth)
+
+    def _axis_depth(self, axis):
+        # 操作块按名字排序后合成，取该轴所有可选图层中最靠下的名字作为深度
+        kind, n, keys = axis
+        if kind == AXIS_BASE:
+            names = [block.name for key in keys for block in self.base_images[key]]
+        elif kind == AXIS_FACE_DIFFERENCE:
+            names = [self.face_differences[n][key].name for key in keys]
+        elif kind == AXIS_FACE_EFFECT:
+            names = [self.face_effects[n][key].name for key in keys if key != 0]
+        else:
+            names = [self.holy_light[key].name for key in keys if key != 0]
+        return (min(names) if names else '\uffff'), kind, n
+
+    def count_variants(self, bi_keys=None, fd_keys=None, fe_keys=None, hl_keys=None):
+        count = 1
+        for _, _, keys in self.variant_axes(bi_keys, fd_keys, fe_keys, hl_keys):
+            count *= len(keys)
+        return count
+
+    def iter_variants(self, bi_keys=None, fd_keys=None, fe_keys=None, hl_keys=None, order=ORDER_GRAY):
+        # 惰性枚举底片×各组人脸差分×各组特效×圣光的笛卡尔积（或按参数筛选的子集），逐个产出Variant
+        # 变化最频繁的轴位于最上层，配合LayerCompositor/IncrementalCompositor可复用下层的合成结果
+        axes = self.variant_axes(bi_keys, fd_keys, fe_keys, hl_keys)
+        if order == ORDER_GRAY:
+            indices = reflected_product([keys for _, _, keys in axes])
+        elif order == ORDER_LEX:
+            indices = itertools.product(*[range(len(keys)) for _, _, keys in axes])
+        else:
+            raise ValueError(f"未知的枚举顺序: {order}")
+        for digits in indices:
+            bi, hl, fd, fe = None, 0, {}, {}
+            for (kind, n, keys), digit in zip(axes, digits):
+                if kind == AXIS_BASE:
+                    bi = keys[digit]
+                elif kind == AXIS_FACE_DIFFERENCE:
+                    fd[n] = keys[digit]
+                elif kind == AXIS_FACE_EFFECT:
+                    fe[n] = keys[digit]
+                else:
+                    hl = keys[digit]
+            # get_operation_blocks会补全传入的字典，传入副本
+            blocks = self.get_operation_blocks(bi, dict(fd), dict(fe), hl)
+            yield Variant(bi, fd, fe, hl, blocks)
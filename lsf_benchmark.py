@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import struct
+import tempfile
+import time
+
+from lsfInfo import LSFFile, LSF_HEADER_SIZE, LSF_BLOCK_SIZE, PARSER_LEGACY, PARSER_NUMPY
+
+DATA_DIRS = ['data/ev_0', 'data/ev_1', 'data/st_0', 'data/st_1', 'data/st_2']
+
+
+def write_synthetic_lsf(file_path, block_num, x=1280, y=720):
+    # 按解析器期望的布局写出一个合成lsf文件，仅用于基准测试
+    header = bytearray(LSF_HEADER_SIZE)
+    header[10] = block_num
+    struct.pack_into('<H', header, 12, x)
+    struct.pack_into('<H', header, 16, y)
+    datas = bytearray(header)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    for i in range(block_num):
+        block = bytearray(LSF_BLOCK_SIZE)
+        block_name = f"{name}_{i:04d}".encode('ascii')[:20]
+        block[:len(block_name)] = block_name
+        struct.pack_into('<I', block, 128, random.randrange(x))
+        struct.pack_into('<I', block, 132, random.randrange(y))
+        block[152] = random.choice([0, 0, 10, 11, 20, 21, 255])
+        block[153] = random.randrange(1, 10)
+        block[154] = random.choice([0, 0, 0, 3])
+        block[155] = 0xff
+        datas += block
+    with open(file_path, 'wb') as file:
+        file.write(datas)
+
+
+def collect_lsf_files(dirs):
+    lsf_files = []
+    for dir_path in dirs:
+        if not os.path.isdir(dir_path):
+            continue
+        for filename in sorted(os.listdir(dir_path)):
+            if filename.endswith('.lsf'):
+                lsf_files.append(os.path.join(dir_path, filename))
+    return lsf_files
+
+
+def check_same(file_path):
+    legacy = LSFFile(file_path, parser=PARSER_LEGACY)
+    fast = LSFFile(file_path, parser=PARSER_NUMPY)
+    if (legacy.x, legacy.y, legacy.type) != (fast.x, fast.y, fast.type):
+        return False
+    for a, b in zip(legacy.blocks, fast.blocks):
+        if (a.name, a.x, a.y, a.type, a.id, a.mode) != (b.name, b.x, b.y, b.type, b.id, b.mode):
+            return False
+    return len(legacy.blocks) == len(fast.blocks)
+
+
+def time_parser(lsf_files, parser, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file_path in lsf_files:
+            LSFFile(file_path, parser=parser)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比逐字节解析与结构化dtype解析lsf文件的耗时')
+    parser.add_argument('dirs', nargs='*', default=DATA_DIRS, help='包含lsf文件的目录')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数，取最短耗时')
+    parser.add_argument('--synthetic', type=int, default=200, help='目录中没有lsf文件时生成的合成文件数量')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lsf_files = collect_lsf_files(args.dirs)
+        if not lsf_files:
+            print(f"未找到lsf文件，使用{args.synthetic}个合成文件")
+            for i in range(args.synthetic):
+                file_path = os.path.join(tmp_dir, f"EV_{i:04d}.lsf")
+                write_synthetic_lsf(file_path, random.randrange(1, 256))
+                lsf_files.append(file_path)
+
+        mismatched = [file_path for file_path in lsf_files if not check_same(file_path)]
+        if mismatched:
+            print(f"解析结果不一致: {mismatched}")
+            return 1
+
+        legacy_time = time_parser(lsf_files, PARSER_LEGACY, args.repeat)
+        numpy_time = time_parser(lsf_files, PARSER_NUMPY, args.repeat)
+        print(f"文件数: {len(lsf_files)}")
+        print(f"legacy: {legacy_time * 1000:.2f} ms")
+        print(f"numpy:  {numpy_time * 1000:.2f} ms")
+        print(f"加速比: {legacy_time / numpy_time:.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,113 @@
+import os
+
+from component_cache import default_cache
+from lsfInfo import LSFFile
+
+
+def neighbour_keys(data_list, current, distance=1):
+    # 底边栏的箭头按±1循环切换，返回当前项前后distance步以内的项，近的在前
+    if current not in data_list:
+        return []
+    index = data_list.index(current)
+    keys = []
+    for step in range(1, distance + 1):
+        for offset in (step, -step):
+            key = data_list[(index + offset) % len(data_list)]
+            if key != current and key not in keys:
+                keys.append(key)
+    return keys
+
+
+class Prefetcher:
+    # 在每次选择之后预先解码相邻差分的组件图片，可选地预先合成相邻组合
+    # 每次预取（run及之后的warm_lsf_files）新读取的组件最多占组件缓存上限的budget_ratio，
+    # 预先合成新增的前缀画布最多占前缀缓存上限的budget_ratio，避免把用户正在使用的图片挤出缓存；
+    # 缓存本身已满时由LRU淘汰最久未使用的图片
+    def __init__(self, cache=None, budget_ratio=0.25, distance=1, lsf_ahead=3, precomposite=False):
+        self.cache = cache if cache is not None else default_cache
+        self.budget_ratio = budget_ratio
+        self.loaded_bytes = 0
+        self.composed_bytes = 0
+        self.distance = distance
+        self.lsf_ahead = lsf_ahead
+        self.precomposite = precomposite
+        self.loaded = 0
+        self.composed = 0
+
+    def plan(self, lsf, bi_key, fd_key, fe_key, hl_key):
+        # 返回[(组件块列表, 对应的完整组合)]，顺序为各组离当前项由近到远
+        plans = []
+
+        def add(blocks, bi=bi_key, fd=None, fe=None, hl=hl_key):
+            fd_keys = dict(fd_key)
+            fd_keys.update(fd or {})
+            fe_keys = dict(fe_key)
+            fe_keys.update(fe or {})
+            plans.append((blocks, lsf.get_operation_blocks(bi, fd_keys, fe_keys, hl)))
+
+        for key in neighbour_keys(lsf.get_base_images_keys(), bi_key, self.distance):
+            add(lsf.base_images[key], bi=key)
+        for n, data_list in lsf.get_face_differences_keys().items():
+            for key in neighbour_keys(data_list, fd_key.get(n, data_list[0]), self.distance):
+                add([lsf.face_differences[n][key]], fd={n: key})
+        for n, data_list in lsf.get_face_effects_keys().items():
+            for key in neighbour_keys([0] + data_list, fe_key.get(n, 0), self.distance):
+                add([lsf.face_effects[n][key]] if key != 0 else [], fe={n: key})
+        holy_light_keys = lsf.get_holy_light_keys()
+        if holy_light_keys:
+            for key in neighbour_keys([0] + holy_light_keys, hl_key, self.distance):
+                add([lsf.holy_light[key]] if key != 0 else [], hl=key)
+        return plans
+
+    def cache_has_room(self):
+        return self.loaded_bytes < self.cache.max_bytes * self.budget_ratio
+
+    def compositor_has_room(self, compositor):
+        return self.composed_bytes < compositor.max_bytes * self.budget_ratio
+
+    def load(self, dir_path, block_name, level=0):
+        # 只有缓存中还没有的组件计入本次预取的用量
+        if self.cache.has_layer(dir_path, block_name, level):
+            return
+        layer = self.cache.load_layer(dir_path, block_name, level)
+        if layer is not None:
+            self.loaded_bytes += layer.nbytes
+        self.loaded += 1
+
+    def run(self, dir_path, plans, compositor=None, token=None, level=0):
+        # 开始新的一次预取，用量重新计算
+        self.loaded_bytes = 0
+        self.composed_bytes = 0
+        for blocks, _ in plans:
+            for block in blocks:
+                if (token is not None and token.cancelled) or not self.cache_has_room():
+                    return
+                self.load(dir_path, block.name, level)
+        if not self.precomposite or compositor is None:
+            return
+        canvas_bytes = compositor.width * compositor.height * 4
+        for _, operation_blocks in plans:
+            if (token is not None and token.cancelled) or not self.compositor_has_room(compositor):
+                return
+            # 每混合一层缓存一张前缀画布
+            blended = compositor.blended_layers
+            compositor.compose(operation_blocks, token)
+            self.composed_bytes += (compositor.blended_layers - blended) * canvas_bytes
+            self.composed += 1
+
+    def warm_lsf_files(self, dir_path, lsf_names, token=None, loader=None, level=0):
+        # 预先解码侧边栏中接下来几个lsf文件的第一个组合；loader按名字返回LSFFile，默认直接解析文件
+        # level为预览合成使用的缩小级别，各lsf的画布大小不同时可以传入按LSFFile返回级别的函数
+        for name in lsf_names[:self.lsf_ahead]:
+            if (token is not None and token.cancelled) or not self.cache_has_room():
+                return
+            try:
+                lsf = loader(name) if loader is not None else LSFFile(os.path.join(dir_path, name + '.lsf'))
+                operation_blocks = lsf.get_operation_blocks(min(lsf.base_images), {}, {}, 0)
+            except (OSError, ValueError):
+                continue
+            lsf_level = level(lsf) if callable(level) else level
+            for block in operation_blocks:
+                if (token is not None and token.cancelled) or not self.cache_has_room():
+                    return
+                self.load(dir_path, block.name, lsf_level)
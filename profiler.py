@@ -0,0 +1,234 @@
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+# 环境变量ESCUDE_PROFILE=1时按阶段统计耗时；ESCUDE_TRACE=<路径>同时记录时间线，进程退出时写出Chrome trace
+PROFILE_ENV = 'ESCUDE_PROFILE'
+TRACE_ENV = 'ESCUDE_TRACE'
+
+# 直方图按耗时的2的幂分桶：第i个桶为[2^(i-1), 2^i)微秒，第0个桶为不足1微秒
+HISTOGRAM_BUCKETS = 32
+# 时间线最多保留的事件数，超过后不再记录，统计仍然继续
+MAX_TRACE_EVENTS = 500000
+
+
+def bucket_bounds(index):
+    # 返回第index个桶的(下界, 上界)，单位为秒
+    if index == 0:
+        return 0.0, 1e-6
+    return 2 ** (index - 1) * 1e-6, 2 ** index * 1e-6
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def merge(self, data):
+        self.count += data['count']
+        self.total += data['total']
+        if data['min'] is not None:
+            self.min = data['min'] if self.min is None else min(self.min, data['min'])
+        self.max = max(self.max, data['max'])
+        for i, n in enumerate(data['buckets']):
+            self.buckets[i] += n
+
+    def percentile(self, q):
+        # 由直方图估计，返回所在桶的上界（不超过最大值）
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(bucket_bounds(i)[1], self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                'buckets': list(self.buckets)}
+
+
+class Span:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    # 按名字汇总各阶段的耗时与直方图；tracing时同时记录每一次的开始时间与耗时，可导出为Chrome trace
+    # 未开启时span返回空操作的上下文管理器，几乎没有开销
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.stages = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    def enable(self, trace=False):
+        self.tracing = self.tracing or trace
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name, start, end):
+        seconds = end - start
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds)
+            if self.tracing and len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append((name, start, seconds, os.getpid(), threading.get_ident()))
+
+    def snapshot(self, reset=False):
+        # 可以pickle的统计结果，子进程用它把统计与时间线交给主进程合并
+        with self._lock:
+            data = {'stages': {name: stats.to_dict() for name, stats in self.stages.items()},
+                    'events': list(self.events)}
+            if reset:
+                self.stages = {}
+                self.events = []
+        return data
+
+    def merge(self, data):
+        if not data:
+            return
+        with self._lock:
+            for name, stage in data['stages'].items():
+                stats = self.stages.get(name)
+                if stats is None:
+                    stats = self.stages[name] = StageStats()
+                stats.merge(stage)
+            room = MAX_TRACE_EVENTS - len(self.events)
+            self.events.extend(data['events'][:max(room, 0)])
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.events = []
+
+    def stage_rows(self):
+        # 按总耗时从大到小返回[(名字, StageStats)]
+        with self._lock:
+            stages = [(name, stats) for name, stats in self.stages.items()]
+        return sorted(stages, key=lambda item: item[1].total, reverse=True)
+
+    def report(self, histogram=True):
+        # 中文标题每个字占两列，相应减少填充宽度使各列对齐
+        lines = [f"{'阶段':<20}{'次数':>6}{'总计ms':>10}{'平均ms':>8}{'p50ms':>10}{'p95ms':>10}{'最长ms':>8}"]
+        for name, stats in self.stage_rows():
+            mean = stats.total / stats.count if stats.count else 0.0
+            lines.append(f"{name:<22}{stats.count:>8}{stats.total * 1000:>12.1f}{mean * 1000:>10.3f}"
+                         f"{stats.percentile(0.5) * 1000:>10.3f}{stats.percentile(0.95) * 1000:>10.3f}"
+                         f"{stats.max * 1000:>10.3f}")
+            if histogram:
+                lines.append('    ' + format_histogram(stats))
+        return '\n'.join(lines)
+
+    def write_trace(self, path):
+        # Chrome trace格式（chrome://tracing或Perfetto可直接打开），同时附带汇总统计
+        with self._lock:
+            events = [{'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'ts': start * 1e6, 'dur': seconds * 1e6,
+                       'pid': pid, 'tid': tid} for name, start, seconds, pid, tid in self.events]
+            stages = {name: stats.to_dict() for name, stats in self.stages.items()}
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'stats': stages}, file)
+        return len(events)
+
+
+def format_histogram(stats):
+    # 只显示第一个与最后一个非空桶之间的范围，例如 <512us:3 <1ms:10 <2ms:0 <4ms:1
+    used = [i for i, n in enumerate(stats.buckets) if n]
+    if not used:
+        return ''
+    parts = []
+    for i in range(used[0], used[-1] + 1):
+        parts.append(f"<{format_seconds(bucket_bounds(i)[1])}:{stats.buckets[i]}")
+    return ' '.join(parts)
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.0f}us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.0f}ms'
+    return f'{seconds:.0f}s'
+
+
+profiler = Profiler()
+
+
+def span(name):
+    # 用法：with span('blend'): ...
+    if not profiler.enabled:
+        return NULL_SPAN
+    return Span(profiler, name)
+
+
+def _write_trace_at_exit(path):
+    # 子进程的统计与时间线由主进程合并后写出
+    if multiprocessing.parent_process() is not None:
+        return
+    try:
+        count = profiler.write_trace(path)
+        print(f"已写出 {count} 个时间线事件到 {path}")
+    except OSError as e:
+        print(f"写出时间线失败: {e}")
+
+
+def configure_from_environment():
+    trace_path = os.environ.get(TRACE_ENV)
+    if os.environ.get(PROFILE_ENV, '') not in ('', '0') or trace_path:
+        profiler.enable(trace=bool(trace_path))
+    if trace_path:
+        atexit.register(_write_trace_at_exit, trace_path)
+
+
+configure_from_environment()
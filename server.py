@@ -0,0 +1,535 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import cv2
+
+from atlas import Atlas, is_atlas_path
+from catalog import Catalog
+from component_cache import default_cache
+from compositor import LayerCompositor
+from disk_cache import DiskCache, DEFAULT_DISK_CACHE_BYTES, DEFAULT_DISK_CACHE_DIR, component_fingerprint, \
+    composite_key
+from exporter import ExportSettings, EXPORT_FORMATS, FORMAT_PNG, FORMAT_QOI, FORMAT_RAW, FORMAT_WEBP, encode_image
+from lsfInfo import LSFFile
+from profiler import profiler, span
+from synthesis_util import BLEND_FLOAT, BLEND_FIXED, DEFAULT_BLEND_ENGINE
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# 内存中保留的已编码结果上限，可通过环境变量ESCUDE_SERVER_CACHE_MB调整（单位MB）
+DEFAULT_RESPONSE_CACHE_BYTES = int(os.environ.get('ESCUDE_SERVER_CACHE_MB', '128')) * 1024 * 1024
+# 保留前缀画布缓存的lsf文件数
+MAX_COMPOSITORS = 8
+MAX_HEADER_LINES = 100
+MAX_LINE_BYTES = 8192
+KEEP_ALIVE_SECONDS = 30
+
+CONTENT_TYPES = {
+    FORMAT_PNG: 'image/png',
+    FORMAT_WEBP: 'image/webp',
+    FORMAT_QOI: 'image/qoi',
+    FORMAT_RAW: 'application/octet-stream',
+}
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class CompositeRequest:
+    # 一次合成请求：lsf文件名、底片（None表示最小的底片键）、人脸差分与特效的{组号: 键}、圣光与导出格式
+    __slots__ = ('name', 'base', 'face_differences', 'face_effects', 'holy_light', 'format')
+
+    def __init__(self, name, base, face_differences, face_effects, holy_light, fmt):
+        self.name = name
+        self.base = base
+        self.face_differences = face_differences
+        self.face_effects = face_effects
+        self.holy_light = holy_light
+        self.format = fmt
+
+
+def parse_int(query, name, default):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return int(values[-1])
+    except ValueError:
+        raise RequestError(400, f"参数{name}不是整数: {values[-1]}")
+
+
+def parse_keys(query, name):
+    # 与批量输出的文件名相同，按"组号-键"给出，多组用逗号分隔或重复参数，例如fd=1-2,2-1
+    keys = {}
+    for value in query.get(name, []):
+        for item in value.split(','):
+            if not item:
+                continue
+            group, sep, key = item.partition('-')
+            try:
+                keys[int(group)] = int(key)
+            except ValueError:
+                raise RequestError(400, f"参数{name}应为\"组号-键\"的形式: {item}")
+            if not sep:
+                raise RequestError(400, f"参数{name}应为\"组号-键\"的形式: {item}")
+    return keys
+
+
+def parse_composite_request(name, query):
+    fmt = query.get('format', [FORMAT_PNG])[-1]
+    if fmt not in EXPORT_FORMATS:
+        raise RequestError(400, f"未知的格式: {fmt}，可选{'、'.join(EXPORT_FORMATS)}")
+    return CompositeRequest(name, parse_int(query, 'base', None), parse_keys(query, 'fd'), parse_keys(query, 'fe'),
+                            parse_int(query, 'hl', 0), fmt)
+
+
+class ResponseCache:
+    # 已编码结果的LRU缓存，按字节数限制
+    def __init__(self, max_bytes=DEFAULT_RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._items[key] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+
+class CompositeService:
+    # 常驻的合成服务：保留解析好的LSFFile、已解码的组件（default_cache）与各lsf文件的前缀画布，
+    # 合成与编码在线程池中进行；输入指纹与持久化缓存的键相同，同时用作ETag
+    def __init__(self, file_dir, engine=DEFAULT_BLEND_ENGINE, use_catalog=True, disk_cache=None,
+                 response_cache_bytes=DEFAULT_RESPONSE_CACHE_BYTES):
+        self.file_dir = file_dir
+        self.engine = engine
+        self.atlas = Atlas(file_dir) if is_atlas_path(file_dir) else None
+        # 目录索引保存在持久化缓存目录中，不使用持久化缓存时直接解析lsf文件
+        self.catalog = Catalog(file_dir, cache_dir=disk_cache.root) \
+            if use_catalog and disk_cache is not None and self.atlas is None else None
+        if self.catalog is not None:
+            self.catalog.refresh()
+        self.disk_cache = disk_cache
+        self.responses = ResponseCache(response_cache_bytes)
+        self.counters = {'requests': 0, 'composed': 0, 'coalesced': 0, 'not_modified': 0, 'memory_hits': 0,
+                         'disk_hits': 0}
+        self._lsf_files = {}
+        self._compositors = OrderedDict()
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    @property
+    def source(self):
+        return self.atlas if self.atlas is not None else self.file_dir
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def list_lsf(self):
+        if self.atlas is not None:
+            return self.atlas.list_lsf()
+        if self.catalog is not None:
+            self.catalog.refresh(check_components=False)
+            return self.catalog.list_lsf()
+        return sorted(os.path.splitext(file)[0] for file in os.listdir(self.file_dir) if file.endswith('.lsf'))
+
+    def lsf_path(self, name):
+        return os.path.join(self.file_dir, name + '.lsf')
+
+    def load_lsf(self, name):
+        # 按lsf文件的大小与修改时间记忆，文件被修改后重新读取；图集在运行期间不变
+        if os.path.basename(name) != name or not name:
+            raise RequestError(404, f"没有这个lsf文件: {name}")
+        if self.atlas is not None:
+            if name not in self.atlas.lsf_entries:
+                raise RequestError(404, f"没有这个lsf文件: {name}")
+            stamp = self.atlas.stamp
+        else:
+            try:
+                st = os.stat(self.lsf_path(name))
+            except OSError:
+                raise RequestError(404, f"没有这个lsf文件: {name}")
+            stamp = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._lsf_files.get(name)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        if self.atlas is not None:
+            lsf = self.atlas.load_lsf(name)
+        elif self.catalog is not None:
+            lsf = self.catalog.load_lsf(name)
+        else:
+            lsf = LSFFile(self.lsf_path(name))
+        with self._lock:
+            self._lsf_files[name] = (stamp, lsf)
+        return lsf
+
+    def describe(self, name):
+        lsf = self.load_lsf(name)
+        return {
+            'name': name,
+            'width': lsf.x,
+            'height': lsf.y,
+            'bases': sorted(lsf.get_base_images_keys()),
+            'face_differences': {str(n): sorted(keys) for n, keys in sorted(lsf.get_face_differences_keys().items())},
+            'face_effects': {str(n): sorted(keys) for n, keys in sorted(lsf.get_face_effects_keys().items())},
+            'holy_lights': sorted(lsf.get_holy_light_keys()),
+        }
+
+    def prepare(self, request):
+        # 在线程池中调用：检查各键是否存在，确定图层并计算输入指纹，不合成；返回(指纹, 图层)
+        # get_operation_blocks会把不存在的键替换为默认值，这里先检查，避免对错误的请求返回默认的组合
+        lsf = self.load_lsf(request.name)
+        if not lsf.base_images:
+            raise RequestError(404, f"{request.name}没有底片")
+        base = request.base if request.base is not None else min(lsf.base_images)
+        if base not in lsf.base_images:
+            raise RequestError(404, f"{request.name}没有底片{base}")
+        check_keys(request.name, '人脸差分', request.face_differences, lsf.face_differences)
+        check_keys(request.name, '特效', request.face_effects, lsf.face_effects, allow_zero=True)
+        if request.holy_light != 0 and request.holy_light not in lsf.holy_light:
+            raise RequestError(404, f"{request.name}没有圣光{request.holy_light}")
+        operation_blocks = lsf.get_operation_blocks(base, dict(request.face_differences),
+                                                    dict(request.face_effects), request.holy_light)
+        key = composite_key(self.lsf_path(request.name), operation_blocks, self.source, engine=self.engine,
+                            kind='server', format=request.format)
+        return key, operation_blocks
+
+    def compositor(self, request, operation_blocks):
+        # 前缀画布缓存只以图层为键，组件文件被修改后清空该lsf文件的缓存
+        lsf = self.load_lsf(request.name)
+        with self._lock:
+            entry = self._compositors.get(request.name)
+            if entry is None or entry[0] is not lsf:
+                entry = (lsf, LayerCompositor(lsf.x, lsf.y, self.source, engine=self.engine))
+                self._compositors[request.name] = entry
+                while len(self._compositors) > MAX_COMPOSITORS:
+                    self._compositors.popitem(last=False)
+            self._compositors.move_to_end(request.name)
+            compositor = entry[1]
+            stale = False
+            for block in operation_blocks:
+                fingerprint = component_fingerprint(self.source, block.name)
+                if self._fingerprints.setdefault(block.name, fingerprint) != fingerprint:
+                    self._fingerprints[block.name] = fingerprint
+                    stale = True
+        if stale:
+            for _, other in list(self._compositors.values()):
+                other.clear()
+        return compositor
+
+    def cached_size(self, request, key):
+        # 已编码结果的字节数，内存与持久化缓存中都没有时返回None；用于HEAD请求，不合成
+        data = self.responses.get(key)
+        if data is not None:
+            return len(data)
+        if self.disk_cache is not None:
+            try:
+                return os.path.getsize(self.disk_cache.path_for(key, '.' + request.format))
+            except OSError:
+                pass
+        return None
+
+    def render(self, request, key, operation_blocks):
+        # 在线程池中调用：依次查找内存与持久化缓存，未命中时合成并编码
+        data = self.responses.get(key)
+        if data is not None:
+            self.count('memory_hits')
+            return data
+        extension = '.' + request.format
+        if self.disk_cache is not None:
+            data = self.disk_cache.get(key, extension)
+            if data is not None:
+                self.count('disk_hits')
+                self.responses.put(key, data)
+                return data
+        with span('server.render'):
+            image = self.compositor(request, operation_blocks).compose(operation_blocks)
+            data = encode_image(image, ExportSettings(request.format))
+        self.count('composed')
+        self.responses.put(key, data)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, data, extension)
+        return data
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            compositors = {name: entry[1].stats() for name, entry in self._compositors.items()}
+        stats = {'counters': counters, 'responses': self.responses.stats(), 'components': default_cache.stats(),
+                 'compositors': compositors}
+        if self.disk_cache is not None:
+            stats['disk_cache'] = self.disk_cache.stats()
+        if profiler.enabled:
+            stats['profile'] = {name: stage.to_dict() for name, stage in profiler.stage_rows()}
+        return stats
+
+
+def check_keys(name, label, keys, groups, allow_zero=False):
+    # keys为{组号: 键}，groups为lsf文件中{组号: {键: 图层}}；allow_zero时键0表示不添加该组的图层
+    for n, key in keys.items():
+        if n not in groups:
+            raise RequestError(404, f"{name}没有第{n}组{label}")
+        if key not in groups[n] and not (allow_zero and key == 0):
+            raise RequestError(404, f"{name}的第{n}组{label}没有键{key}")
+
+
+def etag_for(key):
+    return f'"{key[:40]}"'
+
+
+def etag_matches(header, etag):
+    # If-None-Match可以是*或逗号分隔的多个ETag，弱比较忽略W/前缀
+    if header is None:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag:
+            return True
+    return False
+
+
+class CompositeServer:
+    # 本地HTTP/1.1服务（TCP或Unix套接字），只处理GET与HEAD：
+    #   /composite/<lsf>?base=1&fd=1-2,2-1&fe=1-0&hl=0&format=png  合成图片，format可为png、webp、qoi或raw（.npy）
+    #   /lsf                列出lsf文件
+    #   /lsf/<lsf>          画布大小与可选的底片、差分、特效与圣光键
+    #   /stats              请求、缓存与（开启时）各阶段耗时统计
+    #   /health             健康检查
+    # 相同指纹的并发请求只合成一次；带If-None-Match且指纹未变化时返回304，HEAD请求只返回响应头，都不合成
+    # 列出与读取lsf文件、计算指纹（需要检查组件文件）都在线程池中进行，事件循环只负责收发
+    def __init__(self, service, workers=None):
+        self.service = service
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self._inflight = {}
+
+    def close(self):
+        self.pool.shutdown()
+
+    async def call(self, func, *args):
+        # 读取lsf文件、索引或组件文件的操作都在线程池中进行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, func, *args)
+
+    async def composite(self, request, key, operation_blocks):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.service.count('coalesced')
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, self.service.render, request, key, operation_blocks)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield避免某个客户端断开时取消其他请求共享的任务
+        return await asyncio.shield(future)
+
+    async def route(self, method, target, headers):
+        # 返回(状态码, 响应头, 响应体)
+        self.service.count('requests')
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        if parts == ['health']:
+            return json_response(200, {'status': 'ok'})
+        if parts == ['stats']:
+            return json_response(200, self.service.stats())
+        if parts == ['lsf']:
+            return json_response(200, {'lsf': await self.call(self.service.list_lsf)})
+        if len(parts) == 2 and parts[0] == 'lsf':
+            return json_response(200, await self.call(self.service.describe, parts[1]))
+        if len(parts) == 2 and parts[0] == 'composite':
+            request = parse_composite_request(parts[1], query)
+            key, operation_blocks = await self.call(self.service.prepare, request)
+            etag = etag_for(key)
+            response_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if etag_matches(headers.get('if-none-match'), etag):
+                self.service.count('not_modified')
+                return 304, response_headers, b''
+            response_headers['Content-Type'] = CONTENT_TYPES[request.format]
+            if method == 'HEAD':
+                # 只有已缓存的结果才给出Content-Length
+                size = self.service.cached_size(request, key)
+                if size is not None:
+                    response_headers['Content-Length'] = str(size)
+                return 200, response_headers, None
+            data = await self.composite(request, key, operation_blocks)
+            return 200, response_headers, data
+        raise RequestError(404, f"未知的路径: {url.path}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                    headers = await read_headers(reader)
+                except (ValueError, RequestError):
+                    await write_response(writer, *error_response(400, "请求格式错误"), close=True)
+                    break
+                length = int(headers.get('content-length', '0') or 0)
+                if length:
+                    await reader.readexactly(length)
+                keep_alive = keep_alive_requested(version, headers)
+                if method not in ('GET', 'HEAD'):
+                    response = error_response(405, f"不支持的方法: {method}")
+                else:
+                    try:
+                        response = await self.route(method, target, headers)
+                    except RequestError as e:
+                        response = error_response(e.status, str(e))
+                    except Exception as e:
+                        response = error_response(500, f"{type(e).__name__}: {e}")
+                await write_response(writer, *response, head=method == 'HEAD', close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def read_headers(reader):
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if len(line) > MAX_LINE_BYTES:
+            raise RequestError(400, "请求头过长")
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            raise RequestError(400, "请求头格式错误")
+        headers[name.strip().lower()] = value.strip()
+    raise RequestError(400, "请求头过多")
+
+
+def keep_alive_requested(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def json_response(status, data):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return status, {'Content-Type': 'application/json; charset=utf-8'}, body
+
+
+def error_response(status, message):
+    return json_response(status, {'error': message})
+
+
+async def write_response(writer, status, headers, body, head=False, close=False):
+    # body为None时（HEAD请求）使用headers中给出的Content-Length
+    lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+    headers = dict(headers)
+    if status != 304 and body is not None:
+        headers['Content-Length'] = str(len(body))
+    if close:
+        headers['Connection'] = 'close'
+    lines += [f'{name}: {value}' for name, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    if not head and status != 304 and body is not None:
+        writer.write(body)
+    await writer.drain()
+
+
+async def serve(server, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, ready=None):
+    # ready为可选的回调，服务开始监听后以监听地址调用
+    if unix_path:
+        listener = await asyncio.start_unix_server(server.handle, unix_path)
+        address = unix_path
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        address = '%s:%d' % listener.sockets[0].getsockname()[:2]
+    if ready is not None:
+        ready(address)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='常驻的合成服务，通过本地HTTP或Unix套接字按需返回合成图片')
+    parser.add_argument('-i', '--input', default='data/ev_0', help='解包的lsf文件与素材图片所在目录，或组件图集')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='监听地址，默认只监听本机')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='监听端口，0表示随机端口')
+    parser.add_argument('--unix', help='改为监听该Unix套接字路径')
+    parser.add_argument('-j', '--workers', type=int, default=0, help='合成线程数，0表示CPU核心数')
+    parser.add_argument('--engine', choices=[BLEND_FLOAT, BLEND_FIXED], default=DEFAULT_BLEND_ENGINE,
+                        help='混合引擎')
+    parser.add_argument('--cache-dir', default=DEFAULT_DISK_CACHE_DIR, help='持久化合成结果缓存目录')
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_DISK_CACHE_BYTES // (1024 * 1024),
+                        help='持久化缓存上限（MB）')
+    parser.add_argument('--no-disk-cache', action='store_true', help='不使用持久化缓存，也不使用保存在其中的目录索引')
+    parser.add_argument('--no-catalog', action='store_true', help='不使用目录索引，直接解析lsf文件')
+    parser.add_argument('--memory-cache-mb', type=int, default=DEFAULT_RESPONSE_CACHE_BYTES // (1024 * 1024),
+                        help='内存中保留的已编码结果上限（MB）')
+    parser.add_argument('--profile', action='store_true', help='按阶段统计耗时，通过/stats查看')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        profiler.enable()
+    cv2.setNumThreads(1)
+    disk_cache = None if args.no_disk_cache else DiskCache(args.cache_dir, args.cache_mb * 1024 * 1024)
+    start = time.perf_counter()
+    service = CompositeService(args.input, args.engine, not args.no_catalog, disk_cache,
+                               args.memory_cache_mb * 1024 * 1024)
+    server = CompositeServer(service, args.workers or None)
+    print(f"已加载 {len(service.list_lsf())} 个lsf文件，耗时 {time.perf_counter() - start:.2f}s")
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix,
+                          lambda address: print(f"正在监听 {address}", flush=True)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if args.unix and os.path.exists(args.unix):
+            os.remove(args.unix)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QFontDatabase
+from PyQt5.QtWidgets import QDockWidget, QPlainTextEdit
+
+from profiler import profiler
+
+REFRESH_INTERVAL_MS = 1000
+
+
+class StatsPanel(QDockWidget):
+    # 停靠在主窗口底部的性能统计面板，显示时每秒刷新一次各阶段的耗时与直方图
+    def __init__(self, parent=None):
+        super().__init__('性能统计', parent)
+        self.setObjectName('stats_panel')
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.setWidget(self.text)
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL_MS)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.on_visibility_changed)
+
+    def on_visibility_changed(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        if not profiler.enabled:
+            self.text.setPlainText('性能统计未开启')
+            return
+        # 保持滚动位置，避免每次刷新都跳回顶部
+        bar = self.text.verticalScrollBar()
+        position = bar.value()
+        self.text.setPlainText(profiler.report() if profiler.stages else '暂无数据')
+        bar.setValue(position)
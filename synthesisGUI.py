@@ -1,109 +1,35 @@
 import os
 import sys
 
-import cv2
 import numpy as np
-from PyQt5.QtCore import Qt, QSize, pyqtSignal
-from PyQt5.QtGui import QPixmap, QImage, QIcon
+from PyQt5.QtCore import Qt, QSortFilterProxyModel, QStringListModel
+from PyQt5.QtGui import QPixmap, QImage, QPainter
 from PyQt5.QtWidgets import QApplication, QMainWindow, QAction, QVBoxLayout, QHBoxLayout, QWidget, QLabel, QScrollArea, \
-    QFileDialog, QSizePolicy, QPushButton, QMessageBox, QTextEdit
+    QFileDialog, QMessageBox, QTextEdit, QListView, QLineEdit, QAbstractItemView
 
-from lsfInfo import LSFFile
-from synthesis_util import synthesis
+from atlas import Atlas, ATLAS_SUFFIX, is_atlas_path
+from component_cache import default_cache, preview_level
+from composite_worker import CompositeScheduler
+from catalog import Catalog
+from compositor import LayerCompositor, IncrementalCompositor, union_rect
+from disk_cache import DiskCache, composite_key, component_key
+from exporter import ExportSettings, export_image, format_for_path
+from prefetcher import Prefetcher
+from profiler import profiler, span
+from stats_panel import StatsPanel
+from variant_views import VariantGroup, VariantGroupModel, VariantGroupDelegate
 
+THUMBNAIL_HEIGHT = 100
+TRACE_FILTER = "JSON Files (*.json);;All Files (*)"
+EXPORT_FILTER = "PNG Files (*.png);;WebP Files (*.webp);;QOI Files (*.qoi);;NumPy Files (*.npy);;All Files (*)"
 
-class BottomBarComponent(QWidget):
-    index_changed = pyqtSignal(object)
 
-    def __init__(self, type_str, cv2_image, data_list, index, sid=0):
-        super().__init__()
-        self.type = type_str
-        self.sid = sid
-        self.data_list = data_list
-        self.index = index
-
-        layout = QVBoxLayout()
-        layout.setContentsMargins(5, 5, 5, 5)
-        layout.setSpacing(0)
-
-        text_label = QLabel(type_str)
-        text_label.setAlignment(Qt.AlignCenter)
-        layout.addWidget(text_label)
-
-        if cv2_image is not None:
-            if cv2_image.shape[2] == 4:
-                height, width, channel = cv2_image.shape
-                bytes_per_line = 4 * width
-                q_image = QImage(cv2_image.data, width, height, bytes_per_line, QImage.Format_ARGB32)
-            else:
-                height, width, channel = cv2_image.shape
-                bytes_per_line = 3 * width
-                q_image = QImage(cv2_image.data, width, height, bytes_per_line, QImage.Format_RGB888).rgbSwapped()
-            pixmap = QPixmap.fromImage(q_image)
-            scaled_pixmap = pixmap.scaledToHeight(100, Qt.SmoothTransformation)
-            self.image_label = QLabel()
-            self.image_label.setPixmap(scaled_pixmap)
-            self.image_label.setAlignment(Qt.AlignCenter)
-            self.image_label.setMargin(0)
-            layout.addWidget(self.image_label)
-
-        bottom_layout = QHBoxLayout()
-
-        left_button = QPushButton()
-        left_button.setIcon(QIcon("static/BxLeftArrow.svg"))
-        left_button.setIconSize(QSize(20, 20))
-        left_button.setFlat(True)
-        left_button.setStyleSheet("background-color: transparent;")
-        left_button.clicked.connect(self.decrement_index)
-        bottom_layout.addWidget(left_button)
-
-        self.bottom_text_label = QLabel(f"{self.index + 1}/{len(self.data_list)}")
-        self.bottom_text_label.setAlignment(Qt.AlignCenter)
-        bottom_layout.addWidget(self.bottom_text_label)
-
-        right_button = QPushButton()
-        right_button.setIcon(QIcon("static/BxRightArrow.svg"))
-        right_button.setIconSize(QSize(20, 20))
-        right_button.setFlat(True)
-        right_button.setStyleSheet("background-color: transparent;")
-        right_button.clicked.connect(self.increment_index)
-        bottom_layout.addWidget(right_button)
-
-        # 将底部布局添加到主布局中
-        layout.addLayout(bottom_layout)
-
-        self.setLayout(layout)
-        self.setStyleSheet("border: 1px solid #808080; padding: 5px;")
-        size_policy = QSizePolicy(QSizePolicy.Preferred, QSizePolicy.Expanding)
-        self.setSizePolicy(size_policy)
-
-    def decrement_index(self):
-        self.index -= 1
-        self.index %= len(self.data_list)
-        self.bottom_text_label.setText(f"{self.index + 1}/{len(self.data_list)}")
-        self.index_changed.emit(self)
-
-    def increment_index(self):
-        self.index += 1
-        self.index %= len(self.data_list)
-        self.bottom_text_label.setText(f"{self.index + 1}/{len(self.data_list)}")
-        self.index_changed.emit(self)
-
-    def reset_image(self, cv2_image):
-        # 重新设置图片
-        if cv2_image is not None:
-            if cv2_image.shape[2] == 4:
-                height, width, channel = cv2_image.shape
-                bytes_per_line = 4 * width
-                q_image = QImage(cv2_image.data, width, height, bytes_per_line, QImage.Format_ARGB32)
-            else:
-                height, width, channel = cv2_image.shape
-                bytes_per_line = 3 * width
-                q_image = QImage(cv2_image.data, width, height, bytes_per_line, QImage.Format_RGB888).rgbSwapped()
-            pixmap = QPixmap.fromImage(q_image)
-            # 按比例缩放图片
-            scaled_pixmap = pixmap.scaledToHeight(100, Qt.SmoothTransformation)
-            self.image_label.setPixmap(scaled_pixmap)
+def cv2_to_qimage(cv2_image):
+    # QImage直接引用numpy数组的内存，调用方需要在转换为QPixmap之前保持数组存活
+    height, width, channel = cv2_image.shape
+    if channel == 4:
+        return QImage(cv2_image.data, width, height, 4 * width, QImage.Format_ARGB32)
+    return QImage(cv2_image.data, width, height, 3 * width, QImage.Format_RGB888).rgbSwapped()
 
 
 class SynthesisGUI(QMainWindow):
@@ -111,15 +37,13 @@ class SynthesisGUI(QMainWindow):
         super().__init__()
         self.directory = None
         self.main_layout = None
-        self.sidebar_layout = QVBoxLayout()
-        self.sidebar_widget = QWidget()
-        self.sidebar_widget.setLayout(self.sidebar_layout)
         self.setWindowTitle('ESCUDE-CG-Composer')
         self.setGeometry(100, 100, 800, 600)
 
         self.menubar = self.menuBar()
         file_menu = self.menubar.addMenu('导入目录')
         extract_menu = self.menubar.addMenu('提取')
+        stats_menu = self.menubar.addMenu('统计')
         help_menu = self.menubar.addMenu('帮助')
         exit_menu = self.menubar.addMenu('退出')
 
@@ -131,22 +55,59 @@ class SynthesisGUI(QMainWindow):
         import_action.triggered.connect(self.open_directory_dialog)
         file_menu.addAction(import_action)
 
+        import_atlas_action = QAction('导入图集', self)
+        import_atlas_action.triggered.connect(self.open_atlas_dialog)
+        file_menu.addAction(import_atlas_action)
+
         extract_action = QAction('提取图片', self)
         extract_action.triggered.connect(self.extract_image)
         extract_menu.addAction(extract_action)
 
+        # 性能统计面板：开启后记录解析、解码、混合、显示与编码各阶段的耗时，并可导出Chrome时间线
+        self.stats_panel = StatsPanel(self)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.stats_panel)
+        self.stats_panel.hide()
+        self.stats_action = QAction('性能统计', self)
+        self.stats_action.setCheckable(True)
+        self.stats_action.setChecked(profiler.enabled)
+        self.stats_action.toggled.connect(self.toggle_stats)
+        stats_menu.addAction(self.stats_action)
+        clear_stats_action = QAction('清空统计', self)
+        clear_stats_action.triggered.connect(self.clear_stats)
+        stats_menu.addAction(clear_stats_action)
+        trace_action = QAction('导出时间线', self)
+        trace_action.triggered.connect(self.export_trace)
+        stats_menu.addAction(trace_action)
+
         help_action = QAction('操作说明', self)
         help_action.triggered.connect(self.show_help_document)
         help_menu.addAction(help_action)
 
         self.main_layout = QVBoxLayout()
 
-        self.sidebar = QScrollArea()
+        # 侧边栏与底边栏使用model/view，只绘制可见的行，文件数量很多时也不会创建大量控件
+        self.lsf_model = QStringListModel(self)
+        self.lsf_filter = QSortFilterProxyModel(self)
+        self.lsf_filter.setSourceModel(self.lsf_model)
+        self.lsf_filter.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText('搜索lsf文件')
+        self.search_box.setClearButtonEnabled(True)
+        self.search_box.textChanged.connect(self.lsf_filter.setFilterFixedString)
+        self.sidebar_view = QListView()
+        self.sidebar_view.setModel(self.lsf_filter)
+        self.sidebar_view.setUniformItemSizes(True)
+        self.sidebar_view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.sidebar_view.setStyleSheet("QListView::item { height: 30px; border-bottom: 1px solid #D3D3D3; }"
+                                        "QListView::item:selected { background-color: #E0F7FA; color: black; }")
+        self.sidebar_view.clicked.connect(self.on_lsf_clicked)
+        self.sidebar = QWidget()
         self.sidebar.setFixedWidth(200)
-        self.sidebar.setWidgetResizable(True)
-        self.sidebar_layout.setSpacing(5)
-        self.sidebar_layout.setContentsMargins(5, 5, 5, 5)
-        self.sidebar.setWidget(self.sidebar_widget)
+        sidebar_layout = QVBoxLayout(self.sidebar)
+        sidebar_layout.setContentsMargins(0, 0, 0, 0)
+        sidebar_layout.setSpacing(5)
+        sidebar_layout.addWidget(self.search_box)
+        sidebar_layout.addWidget(self.sidebar_view)
 
         self.image_display = QScrollArea()
         self.image_display.setWidgetResizable(True)
@@ -159,14 +120,21 @@ class SynthesisGUI(QMainWindow):
         self.top_layout.addWidget(self.sidebar)
         self.top_layout.addWidget(self.image_display)
 
-        self.bottom_bar = QScrollArea()
+        self.variant_model = VariantGroupModel(self)
+        self.variant_model.index_changed.connect(self.handle_index_change)
+        self.variant_model.thumbnail_needed.connect(self.request_group_thumbnail)
+        self.bottom_bar = QListView()
         self.bottom_bar.setFixedHeight(200)
-        self.bottom_bar.setWidgetResizable(True)
-        bottom_bar_widget = QWidget()
-        self.bottom_bar_layout = QHBoxLayout(bottom_bar_widget)
-        self.bottom_bar_layout.setContentsMargins(5, 5, 5, 5)  # 调整外边距
-        self.bottom_bar_layout.setSpacing(5)  # 调整间距
-        self.bottom_bar.setWidget(bottom_bar_widget)
+        self.bottom_bar.setFlow(QListView.LeftToRight)
+        self.bottom_bar.setWrapping(False)
+        self.bottom_bar.setUniformItemSizes(True)
+        self.bottom_bar.setSpacing(3)
+        self.bottom_bar.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.bottom_bar.setSelectionMode(QAbstractItemView.NoSelection)
+        self.bottom_bar.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.bottom_bar.setMouseTracking(True)
+        self.bottom_bar.setItemDelegate(VariantGroupDelegate(self.bottom_bar))
+        self.bottom_bar.setModel(self.variant_model)
 
         self.main_layout.addLayout(self.top_layout)
         self.main_layout.addWidget(self.bottom_bar)
@@ -175,8 +143,21 @@ class SynthesisGUI(QMainWindow):
         self.central_widget.setLayout(self.main_layout)
         self.setCentralWidget(self.central_widget)
 
-        self.selected_label = None
+        self.selected_name = None
+        self.catalog = None
         self.lsfData = None
+        self.compositor = None
+        self.preview_compositor = None
+        self.thumbnail_compositor = None
+        self.incremental = None
+        # 解码与合成放在后台线程中进行，连续点击时只渲染最后选中的状态
+        self.scheduler = CompositeScheduler(parent=self)
+        # 导出使用单独的调度器，切换lsf时取消预览任务不会影响正在保存的图片
+        self.export_scheduler = CompositeScheduler(max_threads=1, parent=self)
+        self.pending_dirty = None
+        self.prefetcher = Prefetcher()
+        # 缩略图保存在持久化缓存中，下次打开同一目录时无需重新解码与合成
+        self.disk_cache = DiskCache()
 
         self.bi_key = 1
         self.fd_key = {}
@@ -187,161 +168,309 @@ class SynthesisGUI(QMainWindow):
     def open_directory_dialog(self):
         self.directory = QFileDialog.getExistingDirectory(self, "选择文件夹")
         self.display_cv2_image()
-        self.clear_bottom_bar_components()
+        self.variant_model.clear()
         if self.directory:
             self.update_sidebar(self.directory)
 
+    def open_atlas_dialog(self):
+        # 组件图集由atlas.py pack生成，组件直接从映射的图集文件读取
+        file_path, _ = QFileDialog.getOpenFileName(self, "选择组件图集", "", f"组件图集 (*{ATLAS_SUFFIX})")
+        if file_path:
+            self.update_sidebar(file_path)
+
     def update_sidebar(self, folder_path):
-        self.selected_label = None
-        for i in reversed(range(self.sidebar_layout.count())):
-            widget = self.sidebar_layout.itemAt(i).widget()
-            if widget is not None:
-                widget.deleteLater()
-
-        for filename in os.listdir(folder_path):
-            if filename.endswith('.lsf'):
-                label = QLabel(os.path.splitext(filename)[0])
-                label.setAlignment(Qt.AlignLeft)
-                label.setFixedHeight(30)
-                label.setStyleSheet("border: 1px solid #D3D3D3;")
-                label.mousePressEvent = lambda event, lbl=label: self.on_label_clicked(lbl)
-                self.sidebar_layout.addWidget(label)
-
-        self.sidebar_layout.setAlignment(Qt.AlignTop)
-        self.sidebar_layout.setSpacing(5)
-
-    def on_label_clicked(self, label):
-        if self.selected_label:
-            self.selected_label.setStyleSheet("border: 1px solid #D3D3D3;")
-        label.setStyleSheet("border: 2px solid #4CAF50; background-color: #E0F7FA;")  # 选中颜色
-        self.selected_label = label
-        file_path = os.path.join(self.directory, label.text() + '.lsf')
-        self.lsfData = LSFFile(file_path)
+        # 通过目录索引列出lsf文件，只有新增或修改过的lsf需要重新解析；图集自带索引
+        # 取消后台任务但不等待，旧任务的结果由各自的回调丢弃；旧的索引或图集等被取消的任务结束后再关闭，
+        # 导出仍使用旧的图集时同样等正在进行的导出结束
+        self.scheduler.cancel_all()
+        if self.catalog is not None:
+            previous = self.catalog
+            self.scheduler.after_running(lambda: self.export_scheduler.after_running(previous.close))
+        # 清空当前的lsf与底边栏，之后不会再提交读取旧索引或图集的任务
+        self.catalog = None
+        self.lsfData = None
+        self.incremental = None
+        self.variant_model.clear()
+        self.display_cv2_image()
+        self.selected_name = None
+        self.search_box.clear()
+        self.lsf_model.setStringList([])
+
+        def open_catalog():
+            # 打开索引与刷新需要读取目录中的每个lsf文件，在后台进行
+            catalog = Atlas(folder_path) if is_atlas_path(folder_path) else Catalog(folder_path)
+            catalog.refresh()
+            return catalog, catalog.list_lsf()
+
+        # 再次切换时被取代的索引不再使用，直接关闭
+        self.scheduler.submit('catalog', open_catalog, self.on_catalog_opened,
+                              lambda result: result is not None and result[0].close())
+
+    def on_catalog_opened(self, result):
+        if result is None:
+            return
+        self.catalog, names = result
+        if isinstance(self.catalog, Atlas):
+            self.directory = self.catalog
+        self.lsf_model.setStringList(names)
+
+    def on_lsf_clicked(self, index):
+        self.on_lsf_selected(index.data())
+
+    def on_lsf_selected(self, name):
+        # 读取lsf在后台进行，连续点击时只使用最后选中的lsf
+        self.selected_name = name
+        self.scheduler.cancel_all()
+        catalog = self.catalog
+        self.scheduler.submit('lsf', lambda: catalog.load_lsf(name), lambda lsf: self.on_lsf_loaded(name, lsf))
+
+    def on_lsf_loaded(self, name, lsf):
+        if lsf is None or name != self.selected_name:
+            return
+        self.lsfData = lsf
+        # 预览与缩略图按显示尺寸缩小合成，提取图片时使用原始分辨率的compositor
+        level = self.viewport_level()(self.lsfData)
+        self.compositor = LayerCompositor(self.lsfData.x, self.lsfData.y, self.directory)
+        self.preview_compositor = LayerCompositor(self.lsfData.x, self.lsfData.y, self.directory, level=level)
+        self.thumbnail_compositor = LayerCompositor(self.lsfData.x, self.lsfData.y, self.directory,
+                                                    level=preview_level(self.lsfData.y, THUMBNAIL_HEIGHT))
+        self.incremental = IncrementalCompositor(self.preview_compositor)
+        self.pending_dirty = None
         self.bi_key = self.lsfData.get_base_images_keys()[0]
-        image = self.synthesis_image()
-        self.display_cv2_image(image)
-
-        self.clear_bottom_bar_components()  # 清空底边栏子构件
-
-        operator_blocks = self.lsfData.base_images[self.bi_key]
-        image_bi = synthesis(self.lsfData.x, self.lsfData.y, operator_blocks, self.directory)
-        data_list = self.lsfData.get_base_images_keys()
-        index = 0
-        self.add_bottom_bar_component("图片", image_bi, data_list, index)
-
-        for fd_key in self.lsfData.get_face_differences_keys():
-            data_list = self.lsfData.get_face_differences_keys()[fd_key]
-            index = 0
-            fd_image_path = os.path.join(self.directory,
-                                         self.lsfData.face_differences[fd_key][data_list[index]].name + '.png')
-            fd_image = cv2.imread(fd_image_path, cv2.IMREAD_UNCHANGED)
-            self.add_bottom_bar_component(f"人脸{fd_key}", fd_image, data_list, index, fd_key)
-
-        for fe_key in self.lsfData.get_face_effects_keys():
-            data_list = self.lsfData.get_face_effects_keys()[fe_key]
-            data_list.insert(0, 0)
-            index = 0
-            fe_image = np.zeros((100, 100, 4))
-            self.add_bottom_bar_component(f"特效{fe_key}", fe_image, data_list, index, fe_key)
-
-        data_list = self.lsfData.get_holy_light_keys()
-        if len(data_list) == 0:
+        self.fd_key = {}
+        self.fe_key = {}
+        self.hl_key = 0
+        self.request_composite()
+        self.request_prefetch()
+
+        # 只创建各组的数据项，缩略图在底边栏绘制到该项时才加载
+        groups = [VariantGroup("图片", self.lsfData.get_base_images_keys())]
+        for fd_key, data_list in self.lsfData.get_face_differences_keys().items():
+            groups.append(VariantGroup(f"人脸{fd_key}", data_list, sid=fd_key))
+        for fe_key, data_list in self.lsfData.get_face_effects_keys().items():
+            groups.append(VariantGroup(f"特效{fe_key}", [0] + data_list, sid=fe_key))
+        holy_light_keys = self.lsfData.get_holy_light_keys()
+        if holy_light_keys:
+            groups.append(VariantGroup("圣光", [0] + holy_light_keys))
+        self.variant_model.set_groups(groups)
+
+    def base_image_loader(self, bi_key):
+        compositor = self.thumbnail_compositor
+        operator_blocks = self.lsfData.base_images[bi_key]
+        lsf_path = self.lsfData.file_path
+        disk_cache = self.disk_cache
+
+        def load(token=None):
+            key = composite_key(lsf_path, operator_blocks, compositor.dir_path, level=compositor.level,
+                                kind='thumbnail')
+            return disk_cache.get_or_create_image(key, lambda: compositor.compose(operator_blocks, token))
+
+        return load
+
+    def component_loader(self, block):
+        directory = self.directory
+        disk_cache = self.disk_cache
+
+        def load(token=None):
+            key = component_key(directory, block.name, height=THUMBNAIL_HEIGHT, kind='thumbnail')
+            return disk_cache.get_or_create_image(
+                key, lambda: default_cache.load_for_height(directory, block.name, THUMBNAIL_HEIGHT))
+
+        return load
+
+    def group_loader(self, group):
+        # 返回的函数接受取消令牌，合成底片缩略图时每混合一层检查一次
+        key = group.key
+        if group.type == "图片":
+            return self.base_image_loader(key)
+        if group.type.startswith("人脸"):
+            return self.component_loader(self.lsfData.face_differences[group.sid][key])
+        if key == 0:
+            return lambda token=None: np.zeros((THUMBNAIL_HEIGHT, THUMBNAIL_HEIGHT, 4), dtype=np.uint8)
+        if group.type.startswith("特效"):
+            return self.component_loader(self.lsfData.face_effects[group.sid][key])
+        return self.component_loader(self.lsfData.holy_light[key])
+
+    def request_group_thumbnail(self, group):
+        model = self.variant_model
+
+        def on_result(image):
+            if image is not None:
+                # 在UI线程中缩放为固定高度的pixmap，视图只保存可见过的项的缩略图
+                with span('qt.thumbnail'):
+                    pixmap = QPixmap.fromImage(cv2_to_qimage(image)).scaledToHeight(THUMBNAIL_HEIGHT,
+                                                                                    Qt.SmoothTransformation)
+                model.set_thumbnail(group, pixmap)
+
+        self.scheduler.submit(('thumbnail', id(group)), self.group_loader(group), on_result, with_token=True)
+
+    def request_composite(self):
+        # 在UI线程中确定要合成的图层，后台只负责合成；被新的请求取代时在两个图层之间停止
+        incremental = self.incremental
+        operation_blocks = self.get_operation_blocks()
+        self.scheduler.submit('composite', lambda token: incremental.update(operation_blocks, token),
+                              lambda result: self.on_composite_finished(incremental, result),
+                              lambda result: self.on_composite_discarded(incremental, result), with_token=True)
+
+    def next_lsf_names(self):
+        # 按侧边栏当前的过滤结果返回选中项之后的lsf文件名
+        names = self.lsf_model.stringList()
+        visible = [self.lsf_filter.mapToSource(self.lsf_filter.index(row, 0)).row()
+                   for row in range(self.lsf_filter.rowCount())]
+        for i, row in enumerate(visible):
+            if names[row] == self.selected_name:
+                return [names[r] for r in visible[i + 1:i + 1 + self.prefetcher.lsf_ahead]]
+        return []
+
+    def viewport_level(self):
+        # 返回按LSFFile计算预览缩小级别的函数，使画布缩小后仍不小于当前的显示区域；视口大小在UI线程中读取
+        viewport = self.image_display.viewport().size()
+        width, height = viewport.width(), viewport.height()
+        return lambda lsf: min(preview_level(lsf.x, width), preview_level(lsf.y, height))
+
+    def request_prefetch(self):
+        # 预取相邻差分与侧边栏中接下来的几个lsf，新的选择会取代尚未完成的预取
+        plans = self.prefetcher.plan(self.lsfData, self.bi_key, self.fd_key, self.fe_key, self.hl_key)
+        next_names = self.next_lsf_names()[:self.prefetcher.lsf_ahead]
+        directory = self.directory
+        compositor = self.preview_compositor
+        catalog = self.catalog
+        level = self.viewport_level()
+
+        def prefetch(token):
+            self.prefetcher.run(directory, plans, compositor, token, compositor.level)
+            # 按各lsf自己的画布大小预先解码预览合成读取的缩小图层
+            self.prefetcher.warm_lsf_files(directory, next_names, token, catalog.load_lsf, level)
+
+        self.scheduler.submit('prefetch', prefetch, lambda result: None, with_token=True)
+
+    def on_composite_finished(self, incremental, result):
+        if incremental is not self.incremental:
+            return
+        image, rect = result
+        # 被丢弃的中间结果已经修改了画布，需要一并刷新它们的脏矩形
+        rect = union_rect([self.pending_dirty, rect])
+        self.pending_dirty = None
+        self.update_display_region(image, rect)
+
+    def on_composite_discarded(self, incremental, result):
+        if incremental is not self.incremental or result is None:
             return
-        data_list.insert(0, 0)
-        index = 0
-        hl_image = np.zeros((100, 100, 4))
-        self.add_bottom_bar_component("圣光", hl_image, data_list, index, 0)
+        self.pending_dirty = union_rect([self.pending_dirty, result[1]])
 
     def extract_image(self):
-        image = self.synthesis_image()
-        if image is None:
+        if self.lsfData is None:
             QMessageBox.warning(self, "警告", "合成图片为空，无法提取。")
         else:
             default_file_name = f"synthesized_image_{self.image_counter}.png"
             file_path, _ = QFileDialog.getSaveFileName(self, "保存图片", default_file_name,
-                                                       "PNG Files (*.png);;All Files (*)")
+                                                       EXPORT_FILTER)
             if file_path:
                 while os.path.exists(file_path):
                     self.image_counter += 1
                     default_file_name = f"synthesized_image_{self.image_counter}.png"
                     file_path, _ = QFileDialog.getSaveFileName(self, "保存图片", default_file_name,
-                                                               "PNG Files (*.png);;All Files (*)")
+                                                               EXPORT_FILTER)
                     if not file_path:
                         return  # 用户取消保存
-                cv2.imwrite(file_path, image)
-                QMessageBox.information(self, "成功", f"图片已保存到 {file_path}")
-                self.image_counter += 1  # 保存成功后增加计数器
+                # 原始分辨率的合成与编码、写出都在后台进行，格式由扩展名决定
+                settings = ExportSettings(format_for_path(file_path))
+                compositor = self.compositor
+                operation_blocks = self.get_operation_blocks()
+
+                def export():
+                    return export_image(file_path, compositor.compose(operation_blocks), settings)
+
+                self.export_scheduler.submit(file_path, export,
+                                      lambda result: self.on_export_finished(file_path, result),
+                                      lambda result: self.on_export_failed(file_path))
+
+    def on_export_finished(self, file_path, result):
+        encode_seconds, size = result
+        QMessageBox.information(self, "成功", f"图片已保存到 {file_path}\n"
+                                            f"编码耗时 {encode_seconds * 1000:.0f}ms，大小 {size / 1024:.0f}KB")
+        self.image_counter += 1  # 保存成功后增加计数器
+
+    def on_export_failed(self, file_path):
+        QMessageBox.warning(self, "警告", f"保存 {file_path} 失败。")
 
     def display_cv2_image(self, cv2_image=None):
         if cv2_image is not None:
-            if cv2_image.shape[2] == 4:  # 检查是否为4通道图
-                height, width, channel = cv2_image.shape
-                bytes_per_line = 4 * width
-                q_image = QImage(cv2_image.data, width, height, bytes_per_line, QImage.Format_ARGB32)
-            else:
-                height, width, channel = cv2_image.shape
-                bytes_per_line = 3 * width
-                q_image = QImage(cv2_image.data, width, height, bytes_per_line, QImage.Format_RGB888).rgbSwapped()
-            pixmap = QPixmap.fromImage(q_image)
-            self.image_label.setPixmap(pixmap)
+            with span('qt.pixmap'):
+                pixmap = QPixmap.fromImage(cv2_to_qimage(cv2_image))
+                self.image_label.setPixmap(pixmap)
         else:
             self.image_label.clear()
 
-    def synthesis_image(self):
-        if self.lsfData is not None:
-            operation_blocks = self.lsfData.get_operation_blocks(self.bi_key, self.fd_key, self.fe_key, self.hl_key)
-
-            return synthesis(self.lsfData.x, self.lsfData.y, operation_blocks, self.directory)
-
-    def add_bottom_bar_component(self, type_str, cv2_image, data_list, index, sid=0):
-        component = BottomBarComponent(type_str, cv2_image, data_list, index, sid)
-        component.index_changed.connect(self.handle_index_change)  # 连接信号到槽函数
-        component.setMaximumSize(150, 150)
-        component.setMinimumSize(150, 150)
-        self.bottom_bar_layout.addWidget(component)
-        self.bottom_bar_layout.setAlignment(Qt.AlignLeft)  # 子控件靠左分布
-
-    def clear_bottom_bar_components(self):
-        for i in reversed(range(self.bottom_bar_layout.count())):
-            widget = self.bottom_bar_layout.itemAt(i).widget()
-            if widget is not None:
-                widget.deleteLater()
-
-    def handle_index_change(self, widget):
-        if widget.type == "图片":
-            self.bi_key = widget.data_list[widget.index]
-            operator_blocks = self.lsfData.base_images[self.bi_key]
-            image_bi = synthesis(self.lsfData.x, self.lsfData.y, operator_blocks, self.directory)
-            widget.reset_image(image_bi)
-        elif widget.type.startswith("人脸"):
-            fd_key = widget.data_list[widget.index]
-            fd_image_path = os.path.join(self.directory,
-                                         self.lsfData.face_differences[widget.sid][fd_key].name + '.png')
-            fd_image = cv2.imread(fd_image_path, cv2.IMREAD_UNCHANGED)
-            widget.reset_image(fd_image)
-            self.fd_key[widget.sid] = fd_key
-        elif widget.type.startswith("特效"):
-            fe_key = widget.data_list[widget.index]
-            if fe_key != 0:
-                fe_image_path = os.path.join(self.directory,
-                                             self.lsfData.face_effects[widget.sid][fe_key].name + '.png')
-                fe_image = cv2.imread(fe_image_path, cv2.IMREAD_UNCHANGED)
-            else:
-                fe_image = np.zeros((100, 100, 4))
-            widget.reset_image(fe_image)
-            self.fe_key[widget.sid] = fe_key
-        elif widget.type == "圣光":
-            hl_key = widget.data_list[widget.index]
-            if hl_key != 0:
-                hl_image_path = os.path.join(self.directory, self.lsfData.holy_light[hl_key].name + '.png')
-                hl_image = cv2.imread(hl_image_path, cv2.IMREAD_UNCHANGED)
-            else:
-                hl_image = np.zeros((100, 100, 4))
-            widget.reset_image(hl_image)
-            self.hl_key = hl_key
-
-        image = self.synthesis_image()
-        self.display_cv2_image(image)
+    def update_display_region(self, cv2_image, rect):
+        # 只把脏矩形区域绘制到当前显示的pixmap上
+        if rect is None:
+            return
+        x, y, w, h = rect
+        pixmap = self.image_label.pixmap()
+        if pixmap is None or pixmap.isNull() or pixmap.width() != cv2_image.shape[1] \
+                or pixmap.height() != cv2_image.shape[0] or (w, h) == (pixmap.width(), pixmap.height()):
+            self.display_cv2_image(cv2_image)
+            return
+        with span('qt.pixmap.region'):
+            region = np.ascontiguousarray(cv2_image[y:y + h, x:x + w])
+            q_image = QImage(region.data, w, h, 4 * w, QImage.Format_ARGB32)
+            pixmap = QPixmap(pixmap)
+            painter = QPainter(pixmap)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.drawImage(x, y, q_image)
+            painter.end()
+            self.image_label.setPixmap(pixmap)
+
+    def get_operation_blocks(self):
+        return self.lsfData.get_operation_blocks(self.bi_key, self.fd_key, self.fe_key, self.hl_key)
+
+    def handle_index_change(self, group):
+        if group.type == "图片":
+            self.bi_key = group.key
+        elif group.type.startswith("人脸"):
+            self.fd_key[group.sid] = group.key
+        elif group.type.startswith("特效"):
+            self.fe_key[group.sid] = group.key
+        elif group.type == "圣光":
+            self.hl_key = group.key
+
+        self.request_composite()
+        self.request_prefetch()
+
+    def toggle_stats(self, checked):
+        # 在界面中开启时同时记录时间线，便于导出
+        if checked:
+            profiler.enable(trace=True)
+            self.stats_panel.show()
+        else:
+            profiler.disable()
+            self.stats_panel.hide()
+
+    def clear_stats(self):
+        profiler.reset()
+        self.stats_panel.refresh()
+
+    def export_trace(self):
+        if not profiler.tracing:
+            QMessageBox.warning(self, "警告", "请先在统计菜单中开启性能统计。")
+            return
+        file_path, _ = QFileDialog.getSaveFileName(self, "导出时间线", "trace.json", TRACE_FILTER)
+        if not file_path:
+            return
+        try:
+            count = profiler.write_trace(file_path)
+        except OSError as e:
+            QMessageBox.critical(self, "错误", f"导出时间线失败: {str(e)}")
+            return
+        QMessageBox.information(self, "成功", f"已导出 {count} 个事件到 {file_path}\n"
+                                            f"可在chrome://tracing或Perfetto中打开")
+
+    def closeEvent(self, event):
+        self.scheduler.cancel_all()
+        self.scheduler.wait_for_done()
+        self.export_scheduler.wait_for_done()
+        super().closeEvent(event)
 
     def show_help_document(self):
         try:
@@ -1,24 +1,595 @@
+import argparse
+import csv
+import functools
 import os
-import random
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cv2
 
+from atlas import Atlas, is_atlas_path
+from catalog import Catalog
+from component_cache import default_cache
+from compositor import BatchCompositor, LayerCompositor, DEFAULT_PREFIX_CACHE_BYTES, stream_composites
+from dedup import Deduplicator, DEDUP_MODES, DIGEST_SUFFIX, apply_dedup, blocks_signature, pixel_digest, \
+    previous_signatures
+from disk_cache import DiskCache, DEFAULT_DISK_CACHE_DIR, DEFAULT_DISK_CACHE_BYTES, composite_key
+from exporter import Exporter, ExportSettings, EXPORT_FORMATS, PNG_STRATEGIES, FORMAT_PNG, ROW_FORMATS, \
+    settings_extension, settings_options, summarize_records
+from job_manifest import JobManifest, JOB_MANIFEST, STATE_DUPLICATE
 from lsfInfo import LSFFile
-from synthesis_util import synthesis
+from profiler import profiler
+from synthesis_util import BLEND_FLOAT, BLEND_FIXED, DEFAULT_BLEND_ENGINE
+from tiled import export_tiled
 
 file_dir = 'data/ev_0'  # 换成解包的lsf文件与其他素材图片的路径
 out_dir = 'output'  # 输出路径
-files = os.listdir(file_dir)
-for file in files:
-    if file.endswith('.lsf'):
-        file_path = os.path.join(file_dir, file)
-        lsf = LSFFile(file_path)
-        df_keys = lsf.get_face_differences_keys()
+
+SHARD_LSF = 'lsf'
+SHARD_VARIANT = 'variant'
+
+# 同时保留的合成器个数（load_compositor的缓存大小）
+COMPOSITOR_CACHE_SIZE = 2
+# 限制每个进程的缓存时，合成器前缀缓存占其中的比例，其余留给组件缓存
+PREFIX_CACHE_SHARE = 0.25
+
+# 持久化的合成结果缓存，为None时不使用
+disk_cache = None
+# 目录索引，为None时直接解析lsf文件
+catalog = None
+# 组件图集，输入为图集文件时代替解包目录
+atlas = None
+# 导出阶段，编码与写出在后台线程中进行
+exporter = None
+# 去重记录，为None时不去重
+deduplicator = None
+# 任务清单，为None时不记录完成状态
+job_manifest = None
+# 是否跳过任务清单中已完成且输入未变化的组合
+resume_jobs = True
+# 分块合成的分块大小，为0时合成完整画布
+tile_size = 0
+# 批量合成时每批的组合数，为0时逐个合成
+batch_size = 0
+# 每个合成器的前缀缓存上限
+prefix_cache_bytes = DEFAULT_PREFIX_CACHE_BYTES
+
+
+def configure_disk_cache(cache_dir, max_bytes):
+    global disk_cache
+    disk_cache = DiskCache(cache_dir, max_bytes) if cache_dir else None
+
+
+def configure_catalog(file_dir, enabled, cache_dir):
+    # 索引保存在持久化缓存目录中，不使用持久化缓存时也不使用索引
+    global catalog
+    catalog = Catalog(file_dir, cache_dir=cache_dir) if enabled and cache_dir and not is_atlas_path(file_dir) else None
+
+
+def configure_exporter(settings, threads, queue_size):
+    # 需要先配置任务清单，图片写出后由导出线程登记为已完成
+    global exporter
+    exporter = Exporter(settings, threads, queue_size,
+                        on_written=job_manifest.mark_written if job_manifest is not None else None)
+
+
+def configure_job_manifest(manifest_path, out_dir, readonly=False, resume=True):
+    global job_manifest, resume_jobs
+    job_manifest = JobManifest(manifest_path, out_dir, readonly) if manifest_path else None
+    resume_jobs = resume
+
+
+def checkpoint(force=False):
+    if job_manifest is not None:
+        job_manifest.checkpoint(force)
+
+
+def configure_profiler(profile, trace):
+    # 以fork方式创建的子进程会继承主进程已有的统计，先清空，避免合并时重复计算
+    profiler.reset()
+    if profile or trace:
+        profiler.enable(trace)
+
+
+def configure_worker_cache(cache_bytes):
+    # cache_bytes同时限制组件缓存与保留的合成器的前缀缓存，不再额外占用每个合成器的默认上限
+    global prefix_cache_bytes
+    prefix_bytes = int(cache_bytes * PREFIX_CACHE_SHARE)
+    prefix_cache_bytes = prefix_bytes // COMPOSITOR_CACHE_SIZE
+    default_cache.set_max_bytes(cache_bytes - prefix_bytes)
+    load_compositor.cache_clear()
+
+
+def configure_tiling(size):
+    global tile_size
+    tile_size = size
+
+
+def configure_batching(size):
+    global batch_size
+    batch_size = size
+
+
+def dedup_settings(engine, export_settings):
+    # 只有混合引擎与导出格式相同时，之前的运行输出的图片才能代替本次的组合
+    return {'engine': engine, 'format': export_settings.format}
+
+
+def configure_dedup(mode, out_dir=None, settings=None):
+    # 用输出目录中的去重清单登记之前的运行已输出的图片，多次运行之间同样去重
+    global deduplicator
+    deduplicator = Deduplicator() if mode else None
+    if deduplicator is not None and out_dir is not None:
+        deduplicator.seed(previous_signatures(out_dir, settings))
+
+
+def configure_atlas(file_dir):
+    global atlas
+    atlas = Atlas(file_dir) if is_atlas_path(file_dir) else None
+
+
+def component_source(file_dir):
+    # 合成时读取组件的来源：组件图集或解包目录
+    return atlas if atlas is not None else file_dir
+
+
+def list_lsf_files(file_dir):
+    # 排序保证任务划分与输出顺序在多次运行之间一致
+    if atlas is not None:
+        return [name + '.lsf' for name in atlas.list_lsf()]
+    if catalog is not None:
+        return [name + '.lsf' for name in catalog.list_lsf()]
+    return sorted(file for file in os.listdir(file_dir) if file.endswith('.lsf'))
+
+
+@functools.lru_cache(maxsize=8)
+def load_lsf(file_path):
+    if atlas is not None:
+        return atlas.load_lsf(os.path.splitext(os.path.basename(file_path))[0])
+    if catalog is not None:
+        return catalog.load_lsf(os.path.splitext(os.path.basename(file_path))[0])
+    return LSFFile(file_path)
+
+
+@functools.lru_cache(maxsize=COMPOSITOR_CACHE_SIZE)
+def load_compositor(file_dir, lsf_file, engine):
+    lsf = load_lsf(os.path.join(file_dir, lsf_file))
+    return LayerCompositor(lsf.x, lsf.y, component_source(file_dir), engine=engine, max_bytes=prefix_cache_bytes)
+
+
+def plan_variants(lsf):
+    # 与原有脚本相同的组合方式：每次只切换一组人脸差分
+    # 底片放在最外层，使相邻组合共享尽可能长的图层前缀
+    variants = []
+    df_keys = lsf.get_face_differences_keys()
+    for id in lsf.get_base_images_keys():
         for fds in df_keys:
             for fd in df_keys[fds]:
-                for id in lsf.get_base_images_keys():
-                    operation_blocks = lsf.get_operation_blocks(id, {fds: fd}, {}, 0)
-                    result_image = synthesis(lsf.x, lsf.y,operation_blocks, file_dir)
-                    if not os.path.exists(out_dir):
-                        os.mkdir(out_dir)
-                    cv2.imwrite(os.path.join(out_dir, lsf.name + f'_{id}_{fds}_{fd}.png'), result_image)
+                variants.append((id, fds, fd, lsf.name + f'_{id}_{fds}_{fd}.png'))
+    return variants
+
+
+def is_pending(pending, out_name):
+    # pending为需要输出的文件名（不含扩展名）集合，为None时全部输出
+    return pending is None or os.path.splitext(out_name)[0] in pending
+
+
+def variant_name(lsf_name, variant):
+    # 完整枚举时的输出文件名，例如EV_A00_1_fd1-2_fe1-0_hl0.png
+    parts = [lsf_name, str(variant.bi)]
+    parts += [f'fd{n}-{key}' for n, key in sorted(variant.fd.items())]
+    parts += [f'fe{n}-{key}' for n, key in sorted(variant.fe.items())]
+    parts.append(f'hl{variant.hl}')
+    return '_'.join(parts) + '.png'
+
+
+def save_composite(file_dir, lsf_path, operation_blocks, out_path, engine, produce):
+    # produce返回合成好的图片，只在持久化缓存未命中且不分块合成时调用；提交给导出阶段后不能再被修改
+    # 输出文件的扩展名由导出格式决定
+    out_path = os.path.splitext(out_path)[0] + exporter.extension
+    signature = None
+    if deduplicator is not None:
+        # 合成之前先按图层签名去重，默认键补全等原因产生的相同组合不再合成
+        lsf = load_lsf(lsf_path)
+        signature = blocks_signature(lsf.x, lsf.y, operation_blocks)
+        if deduplicator.claim(out_path, signature) is not None:
+            return
+    key = None
+    suffix = exporter.extension
+    if disk_cache is not None:
+        # 缓存中保存的是按当前导出设置编码好的文件，命中时直接写出，无需合成与编码
+        key = composite_key(lsf_path, operation_blocks, component_source(file_dir), engine=engine, kind='variant',
+                            **settings_options(exporter.settings))
+        data = disk_cache.get(key, suffix)
+        if data is not None and signature is not None:
+            # 去重时还需要缓存的像素哈希，缺失时按未命中处理
+            digest = disk_cache.get(key, DIGEST_SUFFIX)
+            if digest is None:
+                data = None
+            elif deduplicator.claim(out_path, signature, digest.decode('ascii')) is not None:
+                return
+        if data is not None:
+            exporter.submit(out_path, data=data)
+            return
+    if tile_size:
+        save_tiled(file_dir, lsf_path, operation_blocks, out_path, engine, signature, key)
+        return
+    image = produce()
+    if disk_cache is None:
+        if signature is None or deduplicator.claim(out_path, signature, pixel_digest(image)) is None:
+            exporter.submit(out_path, image=image)
+        return
+    if signature is not None:
+        # 图层不同但像素相同的组合在合成之后按像素哈希去重
+        digest = pixel_digest(image)
+        disk_cache.put(key, digest.encode('ascii'), DIGEST_SUFFIX)
+        if deduplicator.claim(out_path, signature, digest) is not None:
+            return
+    exporter.submit(out_path, image=image, on_encoded=lambda encoded: disk_cache.put(key, encoded, suffix))
+
+
+def save_tiled(file_dir, lsf_path, operation_blocks, out_path, engine, signature, key):
+    # 分块合成并在本线程中逐行编码写出，不分配完整画布；像素哈希在写出过程中计算，重复的输出在重命名前丢弃
+    lsf = load_lsf(lsf_path)
+
+    def accept(digest):
+        if signature is None:
+            return True
+        if key is not None:
+            disk_cache.put(key, digest.encode('ascii'), DIGEST_SUFFIX)
+        return deduplicator.claim(out_path, signature, digest) is None
+
+    encode_seconds, size, _ = export_tiled(out_path, lsf.x, lsf.y, operation_blocks, component_source(file_dir),
+                                           exporter.settings, engine=engine, tile_size=tile_size, accept=accept)
+    if size is None:
+        return
+    if key is not None:
+        disk_cache.put_file(key, out_path, exporter.extension)
+    exporter.record(out_path, encode_seconds, size)
+
+
+def submit_variant(file_dir, out_dir, lsf_file, id, fds, fd, out_name, engine, produce=None):
+    # produce为None时使用按前缀缓存的LayerCompositor合成
+    lsf_path = os.path.join(file_dir, lsf_file)
+    lsf = load_lsf(lsf_path)
+    operation_blocks = lsf.get_operation_blocks(id, {fds: fd}, {}, 0)
+    save_composite(file_dir, lsf_path, operation_blocks, os.path.join(out_dir, out_name), engine,
+                   produce or (lambda: load_compositor(file_dir, lsf_file, engine).compose(operation_blocks)))
+
+
+def finish_task(skipped=0):
+    # 等待本任务提交的图片全部写出，返回[(输出路径, 编码耗时, 文件大小)]、本任务的去重记录、
+    # 性能统计（未开启时为None）与按任务清单跳过的已完成组合数
+    records = exporter.take_records()
+    checkpoint(force=True)
+    entries = deduplicator.take_entries() if deduplicator is not None else []
+    return records, entries, profiler.snapshot(reset=True) if profiler.enabled else None, skipped
+
+
+def task_pending(file_dir, lsf_file, all_variants, engine, export_settings):
+    # 在任务中对照任务清单找出该lsf文件未完成的组合，返回需要输出的文件名集合（没有任务清单时为None）与已完成的数量
+    # 各进程只枚举自己负责的lsf文件，主进程不需要预先枚举全部组合
+    if job_manifest is None:
+        return None, 0
+    variants = planned_variants(file_dir, lsf_file, all_variants, engine, export_settings)
+    return job_manifest.sync(os.path.splitext(lsf_file)[0], variants, resume_jobs)
+
+
+# 以下为任务函数，返回finish_task()的结果；不在任务清单的待处理集合中的组合跳过
+def render_variant(file_dir, out_dir, lsf_file, id, fds, fd, out_name, engine):
+    submit_variant(file_dir, out_dir, lsf_file, id, fds, fd, out_name, engine)
+    return finish_task()
+
+
+def render_lsf(file_dir, out_dir, lsf_file, engine):
+    # 合成下一张图片的同时，导出线程编码与写出之前的图片
+    pending, skipped = task_pending(file_dir, lsf_file, False, engine, exporter.settings)
+    lsf = load_lsf(os.path.join(file_dir, lsf_file))
+    variants = [variant for variant in plan_variants(lsf) if is_pending(pending, variant[-1])]
+    batch = None
+    if batch_size:
+        # 批量合成：待处理的组合按顺序每batch_size个一批，第一次需要合成某个组合时合成整批
+        block_lists = [lsf.get_operation_blocks(id, {fds: fd}, {}, 0) for id, fds, fd, _ in variants]
+        batch = BatchCompositor(lsf.x, lsf.y, block_lists, component_source(file_dir), engine=engine,
+                                batch_size=batch_size)
+    for index, (id, fds, fd, out_name) in enumerate(variants):
+        produce = functools.partial(batch.get, index) if batch is not None else None
+        submit_variant(file_dir, out_dir, lsf_file, id, fds, fd, out_name, engine, produce)
+        checkpoint()
+    return finish_task(skipped)
+
+
+def render_all_variants(file_dir, out_dir, lsf_file, engine):
+    # 完整枚举底片×各组人脸差分×特效×圣光，按格雷码顺序流式合成，不保存组合列表
+    pending, skipped = task_pending(file_dir, lsf_file, True, engine, exporter.settings)
+    lsf_path = os.path.join(file_dir, lsf_file)
+    lsf = load_lsf(lsf_path)
+    for variant, compose in stream_composites(load_compositor(file_dir, lsf_file, engine), lsf.iter_variants()):
+        out_name = variant_name(lsf.name, variant)
+        if not is_pending(pending, out_name):
+            continue
+        # 增量合成的画布会被下一个组合原地修改，交给导出线程前复制
+        save_composite(file_dir, lsf_path, variant.blocks, os.path.join(out_dir, out_name),
+                       engine, lambda: compose().copy())
+        checkpoint()
+    return finish_task(skipped)
+
+
+def init_worker(cache_bytes, memory_bytes, cache_dir, disk_cache_bytes, file_dir, use_catalog, export_settings,
+                writer_threads, writer_queue, dedup, manifest_path, resume, out_dir, profile, trace, tiles, batch,
+                engine):
+    # 每个进程自己负责解码、混合与编码，多进程之间各阶段自然重叠；限制OpenCV内部线程避免超额占用
+    cv2.setNumThreads(1)
+    configure_profiler(profile, trace)
+    configure_tiling(tiles)
+    configure_batching(batch)
+    configure_worker_cache(cache_bytes)
+    configure_disk_cache(cache_dir, disk_cache_bytes)
+    configure_catalog(file_dir, use_catalog, cache_dir)
+    configure_atlas(file_dir)
+    configure_job_manifest(manifest_path, out_dir, resume=resume)
+    configure_exporter(export_settings, writer_threads, writer_queue)
+    # 每个进程只对之前的运行与自己输出的图片去重，进程之间的重复由主进程在结束后合并
+    configure_dedup(dedup, out_dir, dedup_settings(engine, export_settings))
+    if memory_bytes:
+        try:
+            import resource
+        except ImportError:
+            return
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def print_progress(done, total):
+    sys.stderr.write(f"\r进度: {done}/{total}")
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def planned_variants(file_dir, lsf_file, all_variants, engine, export_settings):
+    # 逐个给出本次运行计划输出的组合：(输出文件名, 底片, 人脸差分, 特效, 圣光, 输入指纹)，输入指纹与持久化缓存的键相同
+    lsf_path = os.path.join(file_dir, lsf_file)
+    lsf = load_lsf(lsf_path)
+    extension = settings_extension(export_settings)
+    options = settings_options(export_settings)
+    if all_variants:
+        variants = ((variant_name(lsf.name, variant), variant.bi, variant.fd, variant.fe, variant.hl, variant.blocks)
+                    for variant in lsf.iter_variants())
+    else:
+        variants = ((out_name, id, {fds: fd}, {}, 0, lsf.get_operation_blocks(id, {fds: fd}, {}, 0))
+                    for id, fds, fd, out_name in plan_variants(lsf))
+    for out_name, bi, fd_keys, fe_keys, hl_key, blocks in variants:
+        fingerprint = composite_key(lsf_path, blocks, component_source(file_dir), engine=engine, kind='variant',
+                                    **options)
+        yield os.path.splitext(out_name)[0] + extension, bi, fd_keys, fe_keys, hl_key, fingerprint
+
+
+def plan_pending(file_dir, all_variants, engine, export_settings, resume=True, dry_run=False):
+    # 对照任务清单找出未完成的组合，返回{lsf文件: 需要输出的文件名集合}与(计划的组合数, 已完成的组合数)
+    # 会在主进程中枚举全部组合，只用于dry_run；实际运行时由各任务在task_pending中对照任务清单
+    pending = {}
+    planned = finished = 0
+    for lsf_file in list_lsf_files(file_dir):
+        variants = planned_variants(file_dir, lsf_file, all_variants, engine, export_settings)
+        if job_manifest is not None:
+            names, done = job_manifest.sync(os.path.splitext(lsf_file)[0], variants, resume, dry_run)
+        else:
+            names, done = {os.path.splitext(variant[0])[0] for variant in variants}, 0
+        pending[lsf_file] = names
+        planned += len(names) + done
+        finished += done
+    return pending, (planned, finished)
+
+
+def build_tasks(file_dir, shard, engine, export_settings, all_variants=False):
+    # 返回任务列表与在主进程中按任务清单跳过的已完成组合数
+    tasks = []
+    skipped = 0
+    for lsf_file in list_lsf_files(file_dir):
+        if all_variants:
+            # 完整枚举的组合数可能非常多，总是按lsf文件划分任务，由各进程流式枚举
+            tasks.append((render_all_variants, (lsf_file,)))
+        elif shard == SHARD_LSF:
+            tasks.append((render_lsf, (lsf_file,)))
+        else:
+            # 按组合划分时主进程本来就要枚举该lsf文件的组合，在这里对照任务清单
+            names, done = task_pending(file_dir, lsf_file, False, engine, export_settings)
+            skipped += done
+            lsf = load_lsf(os.path.join(file_dir, lsf_file))
+            for variant in plan_variants(lsf):
+                if is_pending(names, variant[-1]):
+                    tasks.append((render_variant, (lsf_file,) + variant))
+    return tasks, skipped
+
+
+def run(file_dir, out_dir, jobs=1, shard=SHARD_LSF, engine=DEFAULT_BLEND_ENGINE, worker_cache_bytes=None,
+        worker_memory_bytes=None, cache_dir=None, disk_cache_bytes=DEFAULT_DISK_CACHE_BYTES, use_catalog=True,
+        all_variants=False, export_settings=ExportSettings(), writer_threads=2, writer_queue=8, dedup=None,
+        manifest_path=None, resume=True, dry_run=False, profile=False, trace=False, tiles=0, batch=0):
+    # 返回每个任务的([(输出路径, 编码耗时, 文件大小)], 去重记录, 性能统计, 跳过的已完成组合数)与主进程跳过的组合数；dedup为skip或link时跳过或链接重复的组合
+    # manifest_path为任务清单路径：resume时跳过清单中已完成且输入未变化的组合；dry_run只统计待处理的组合
+    # profile时各进程按阶段统计耗时，trace时同时记录时间线，结束后合并到主进程的profiler
+    # tiles大于0时按该大小分块合成并逐行写出，峰值内存与分块大小而不是画布大小有关（只支持ROW_FORMATS）
+    if tiles and export_settings.format not in ROW_FORMATS:
+        raise ValueError(f"分块合成只支持{'、'.join(ROW_FORMATS)}格式: {export_settings.format}")
+    # batch大于0时按lsf文件划分的任务每batch个组合一批合成为(N, H, W, 4)的数组，共有的图层只混合一次
+    if profile or trace:
+        profiler.enable(trace)
+    if dry_run:
+        manifest_path = manifest_path if manifest_path and os.path.exists(manifest_path) else None
+    elif not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    configure_disk_cache(cache_dir, disk_cache_bytes)
+    configure_catalog(file_dir, use_catalog, cache_dir)
+    configure_atlas(file_dir)
+    configure_dedup(dedup, out_dir, dedup_settings(engine, export_settings))
+    configure_tiling(tiles)
+    configure_batching(batch)
+    configure_job_manifest(manifest_path, out_dir, readonly=dry_run, resume=resume)
+    if catalog is not None:
+        # 只重新解析新增或修改过的lsf文件，子进程直接读取刷新后的索引
+        catalog.refresh()
+        missing = catalog.missing_components()
+        if missing:
+            print(f"缺少 {len(missing)} 个组件图片，对应的图层不参与合成: {', '.join(missing[:10])}"
+                  + ('等' if len(missing) > 10 else ''))
+    if dry_run:
+        pending, (planned, finished) = plan_pending(file_dir, all_variants, engine, export_settings, resume, dry_run)
+        print(f"计划 {planned} 个组合，已完成 {finished} 个，待处理 {planned - finished} 个"
+              f"（{sum(1 for names in pending.values() if names)} 个lsf文件）")
+        for lsf_file, names in pending.items():
+            if names:
+                print(f"  {lsf_file}: 待处理 {len(names)} 个")
+        return [], 0
+    if all_variants:
+        # 只按各轴的键数相乘统计组合数，不枚举组合
+        count = sum(load_lsf(os.path.join(file_dir, lsf_file)).count_variants() for lsf_file in list_lsf_files(file_dir))
+        print(f"计划 {count} 个组合")
+    tasks, skipped = build_tasks(file_dir, shard, engine, export_settings, all_variants)
+    total = len(tasks)
+    results = [None] * total
+
+    if jobs == 1:
+        if worker_cache_bytes is not None:
+            configure_worker_cache(worker_cache_bytes)
+        configure_exporter(export_settings, writer_threads, writer_queue)
+        try:
+            for index, (func, args) in enumerate(tasks):
+                results[index] = func(file_dir, out_dir, *args, engine)
+                print_progress(index + 1, total)
+        finally:
+            try:
+                exporter.close()
+            finally:
+                # 中断时也把已经写出的图片登记为已完成
+                checkpoint(force=True)
+        finish_dedup(out_dir, results, dedup, engine, export_settings)
+        merge_profiles(results)
+        return results, skipped
+
+    if worker_cache_bytes is None:
+        worker_cache_bytes = default_cache.max_bytes
+    # 不使用max_tasks_per_child回收进程：在Python 3.11.7上即使任务函数直接返回，
+    # ProcessPoolExecutor(max_workers=1, max_tasks_per_child=2)提交10个任务也会在替换第一个进程后卡死，
+    # 因此每个进程的内存由组件缓存上限与可选的RLIMIT_AS限制
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(worker_cache_bytes, worker_memory_bytes, cache_dir, disk_cache_bytes,
+                                       file_dir, use_catalog, export_settings, writer_threads,
+                                       writer_queue, dedup, manifest_path, resume, out_dir, profiler.enabled,
+                                       profiler.tracing, tiles, batch, engine)) as executor:
+        futures = {executor.submit(func, file_dir, out_dir, *args, engine): index
+                   for index, (func, args) in enumerate(tasks)}
+        done = 0
+        try:
+            for future in as_completed(futures):
+                # 结果按任务下标存放，完成顺序不影响输出顺序
+                results[futures[future]] = future.result()
+                done += 1
+                print_progress(done, total)
+        except BaseException:
+            # 中断时取消尚未开始的任务，已完成的组合记录在任务清单中，下次运行时跳过
+            for future in futures:
+                future.cancel()
+            raise
+    finish_dedup(out_dir, results, dedup, engine, export_settings)
+    merge_profiles(results)
+    return results, skipped
+
+
+def merge_profiles(results):
+    # 单进程时统计在finish_task中取出，同样合并回来
+    for _, _, snapshot, _ in results:
+        profiler.merge(snapshot)
+
+
+def finish_dedup(out_dir, results, dedup, engine, export_settings):
+    if not dedup:
+        return
+    entries = [entry for _, task_entries, _, _ in results for entry in task_entries]
+    manifest = apply_dedup(out_dir, entries, dedup, dedup_settings(engine, export_settings))
+    duplicates = [path for path, canonical in manifest.items() if path != canonical]
+    if job_manifest is not None:
+        job_manifest.mark(duplicates, STATE_DUPLICATE)
+    print(f"去重: {len(entries)} 个组合中有 {len(duplicates)} 个与已输出的图片相同")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量合成lsf文件对应的cg或立绘')
+    parser.add_argument('-i', '--input', default=file_dir, help='解包的lsf文件与素材图片所在目录，或atlas.py打包的组件图集')
+    parser.add_argument('-o', '--output', default=out_dir, help='输出目录')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='并行进程数，0表示使用全部CPU核心')
+    parser.add_argument('--shard', choices=[SHARD_LSF, SHARD_VARIANT], default=SHARD_LSF,
+                        help='任务划分粒度：每个lsf文件或每个差分组合')
+    parser.add_argument('--engine', choices=[BLEND_FLOAT, BLEND_FIXED], default=DEFAULT_BLEND_ENGINE,
+                        help='混合引擎')
+    parser.add_argument('--worker-cache-mb', type=int, default=256, help='每个进程的组件缓存与合成器前缀缓存的总上限（MB）')
+    parser.add_argument('--worker-memory-mb', type=int, default=0, help='每个进程的地址空间上限（MB），0表示不限制')
+    parser.add_argument('--cache-dir', default=DEFAULT_DISK_CACHE_DIR, help='持久化合成结果缓存目录')
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_DISK_CACHE_BYTES // (1024 * 1024),
+                        help='持久化缓存上限（MB）')
+    parser.add_argument('--no-disk-cache', action='store_true', help='不使用持久化缓存，也不使用保存在其中的目录索引')
+    parser.add_argument('--no-catalog', action='store_true', help='不使用目录索引，每次直接解析lsf文件')
+    parser.add_argument('--all-variants', action='store_true',
+                        help='输出底片、各组人脸差分、特效与圣光的全部组合（按lsf文件划分任务）')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default=FORMAT_PNG,
+                        help='导出格式：png、无损webp、qoi或raw（NumPy的.npy）')
+    parser.add_argument('--png-compression', type=int, choices=range(10), default=None,
+                        help='PNG压缩级别0-9，默认使用OpenCV的默认值')
+    parser.add_argument('--png-strategy', choices=sorted(PNG_STRATEGIES), default=None, help='PNG压缩策略')
+    parser.add_argument('--writer-threads', type=int, default=2, help='每个进程的编码与写出线程数')
+    parser.add_argument('--writer-queue', type=int, default=8, help='每个进程等待编码的图片数上限，超过时合成等待')
+    parser.add_argument('--encode-log', help='把每张图片的编码耗时写入该CSV文件')
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=None,
+                        help='跳过（skip）或硬链接（link）与已输出图片相同的组合，并在输出目录写出去重清单')
+    parser.add_argument('--manifest', default=None, help=f'任务清单路径，默认为输出目录下的{JOB_MANIFEST}')
+    parser.add_argument('--no-resume', action='store_true', help='忽略任务清单中已完成的组合，全部重新输出')
+    parser.add_argument('--dry-run', action='store_true', help='只统计待处理的组合，不合成也不修改任务清单')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='按该大小（像素）分块合成并逐行写出，不分配完整画布，0表示不分块；只支持png与raw格式')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='按lsf文件划分任务时每批一起合成的组合数，共有的图层在一批中只混合一次，0表示逐个合成')
+    parser.add_argument('--profile', action='store_true', help='按阶段统计解析、解码、混合、编码与写出的耗时并打印直方图')
+    parser.add_argument('--trace', help='同时记录时间线，结束后以Chrome trace格式写入该JSON文件')
+    args = parser.parse_args(argv)
+    if args.tile_size and args.format not in ROW_FORMATS:
+        parser.error(f"--tile-size只支持{'、'.join(ROW_FORMATS)}格式")
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    cache_dir = None if args.no_disk_cache else args.cache_dir
+    export_settings = ExportSettings(args.format, args.png_compression, args.png_strategy)
+    manifest_path = args.manifest or os.path.join(args.output, JOB_MANIFEST)
+    results, skipped = run(args.input, args.output, jobs, args.shard, args.engine, args.worker_cache_mb * 1024 * 1024,
+                  args.worker_memory_mb * 1024 * 1024, cache_dir, args.cache_mb * 1024 * 1024, not args.no_catalog,
+                  args.all_variants, export_settings, args.writer_threads, args.writer_queue, args.dedup,
+                  manifest_path, not args.no_resume, args.dry_run, args.profile, bool(args.trace),
+                  args.tile_size, args.batch_size)
+    if args.dry_run:
+        return 0
+    records = [record for task_records, _, _, _ in results for record in task_records]
+    skipped += sum(task_skipped for _, _, _, task_skipped in results)
+    if skipped:
+        print(f"跳过任务清单中已完成的 {skipped} 个组合")
+    if jobs == 1:
+        print(f"组件缓存统计: {default_cache.stats()}")
+        if disk_cache is not None:
+            print(f"持久化缓存统计: {disk_cache.stats()}")
+    summary = summarize_records(records)
+    print(f"导出 {summary['images']} 张图片（编码 {summary['encoded']} 张，"
+          f"平均 {summary['mean_encode_ms']:.1f}ms，最长 {summary['max_encode_ms']:.1f}ms，"
+          f"共 {summary['bytes'] / 1024 / 1024:.1f}MB）")
+    if args.encode_log:
+        with open(args.encode_log, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['path', 'encode_ms', 'bytes'])
+            writer.writerows((path, f'{seconds * 1000:.3f}', size) for path, seconds, size in records)
+    if profiler.enabled:
+        print(profiler.report())
+    if args.trace:
+        count = profiler.write_trace(args.trace)
+        print(f"已写出 {count} 个时间线事件到 {args.trace}")
+    print(f"完成 {len(results)} 个任务")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
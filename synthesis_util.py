@@ -1,52 +1,243 @@
 import os
+import threading
 
 import cv2
 import numpy as np
 
+from component_cache import default_cache
 from lsfInfo import LSFFile
+from profiler import span
 
+# 混合引擎：float为原有的浮点实现；fixed为uint16定点实现，结果与float相差不超过±1
+BLEND_FLOAT = 'float'
+BLEND_FIXED = 'fixed'
+DEFAULT_BLEND_ENGINE = os.environ.get('ESCUDE_BLEND_ENGINE', BLEND_FLOAT)
 
-def CG_synthesis_opencv(image, operation_block, dir_path, mode=0):
-    op_path = os.path.join(dir_path, operation_block.name + '.png')
-    if os.path.exists(op_path):
-        op_image = cv2.imread(op_path, cv2.IMREAD_UNCHANGED)
-        if op_image is not None:
-            if image.shape[2] == 3:
-                image = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
+# 批量混合时按批分段，每段临时数组的总大小不超过STACK_TEMP_BYTES；
+# STACK_PIXEL_BYTES为每张画布每个像素产生的临时数组字节数（float约为7个float64，fixed约为3个4通道uint16）
+STACK_TEMP_BYTES = 32 * 1024 * 1024
+STACK_PIXEL_BYTES = {BLEND_FLOAT: 56, BLEND_FIXED: 24}
 
-            op_h, op_w, op_c = op_image.shape
 
-            x, y = operation_block.x, operation_block.y
+class FixedPointBlender:
+    # 在画布ROI上原地进行定点混合，临时数组复用预分配的缓冲区
+    # 每个像素的4个通道以uint16存放在一个uint64中：通道值与alpha的乘积不超过65025，
+    # 通道之间不会产生进位，因此可以按像素整体做乘法与移位，避免逐通道广播
+    LANE_MASK = np.uint64(0x00FF00FF00FF00FF)
+    LANE_ONES = np.uint64(0x0001000100010001)
+    SHIFT = np.uint64(8)
 
-            if x + op_w > image.shape[1] or y + op_h > image.shape[0]:
-                print("操作块图像超出主图像范围")
-                return image
+    def __init__(self):
+        self._buffers = {}
 
-            if op_c == 4:
-                op_alpha = op_image[:, :, 3] / 255.0
-                op_rgb = op_image[:, :, :3]
+    def _buffer(self, slot, shape, dtype):
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(slot)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[slot] = buffer
+        return buffer[:size].reshape(shape)
+
+    def _div255(self, values, scratch):
+        # 对每个通道精确计算floor(v / 255)，v不超过65025：(v + 1 + (v >> 8)) >> 8
+        np.right_shift(values, self.SHIFT, out=scratch)
+        scratch &= self.LANE_MASK
+        values += scratch
+        values += self.LANE_ONES
+        values >>= self.SHIFT
+        values &= self.LANE_MASK
+        return values
+
+    def blend(self, image, op_image, x, y):
+        op_h, op_w, op_c = op_image.shape
+        roi = image[y:y + op_h, x:x + op_w]
+        if op_c != 4:
+            roi[:, :, :3] = op_image
+            roi[:, :, 3] = 255
+            return image
+
+        acc = self._buffer('acc', (op_h, op_w, 4), np.uint16)
+        tmp = self._buffer('tmp', (op_h, op_w, 4), np.uint16)
+        alpha = self._buffer('alpha', (op_h, op_w, 1), np.uint64)
+        inv_alpha = self._buffer('inv_alpha', (op_h, op_w, 1), np.uint64)
+        acc64 = acc.view(np.uint64)
+        tmp64 = tmp.view(np.uint64)
+
+        np.copyto(alpha, op_image[:, :, 3:])
+        np.subtract(np.uint64(255), alpha, out=inv_alpha)
+
+        # rgb = (op_rgb * A + roi_rgb * (255 - A)) / 255
+        # alpha = A + roi_A * (255 - A) / 255，即把op的alpha通道视为255后套用同一公式
+        np.copyto(acc, op_image)
+        acc[:, :, 3] = 255
+        acc64 *= alpha
+        np.copyto(tmp, roi)
+        tmp64 *= inv_alpha
+        acc64 += tmp64
+        self._div255(acc64, tmp64)
+        np.copyto(roi, acc, casting='unsafe')
+        return image
+
+
+_local = threading.local()
+
+
+def get_fixed_point_blender():
+    blender = getattr(_local, 'blender', None)
+    if blender is None:
+        blender = FixedPointBlender()
+        _local.blender = blender
+    return blender
+
+
+def blend_image(image, op_image, x, y, engine=None):
+    # 将组件图片按偏移量混合到image上，调用方保证不越界
+    if engine is None:
+        engine = DEFAULT_BLEND_ENGINE
+    if engine == BLEND_FIXED:
+        return get_fixed_point_blender().blend(image, op_image, x, y)
+
+    op_h, op_w, op_c = op_image.shape
+    if op_c == 4:
+        op_alpha = op_image[:, :, 3] / 255.0
+        op_rgb = op_image[:, :, :3]
+    else:
+        op_alpha = np.ones((op_h, op_w), dtype=np.float32)
+        op_rgb = op_image
+
+    roi = image[y:y + op_h, x:x + op_w]
+    roi_rgb = roi[:, :, :3]
+    roi_alpha = roi[:, :, 3] / 255.0
+
+    composite_rgb = op_rgb * op_alpha[:, :, np.newaxis] + roi_rgb * (1 - op_alpha[:, :, np.newaxis])
+    composite_alpha = op_alpha + roi_alpha * (1 - op_alpha)
+
+    image[y:y + op_h, x:x + op_w, :3] = composite_rgb
+    image[y:y + op_h, x:x + op_w, 3] = composite_alpha * 255
+    return image
+
+
+def blend_layer(image, layer, x, y, engine=None):
+    # 将TrimmedLayer的像素以(x, y)为左上角混合到image上，超出image的部分被裁掉
+    # 完全透明的块被跳过，完全不透明的块直接复制，其余块调用blend_image混合
+    with span('blend'):
+        h, w = image.shape[:2]
+        pixels = layer.pixels
+        for y0, y1, x0, x1, opaque in layer.spans:
+            ty0, ty1 = max(y + y0, 0), min(y + y1, h)
+            tx0, tx1 = max(x + x0, 0), min(x + x1, w)
+            if ty0 >= ty1 or tx0 >= tx1:
+                continue
+            piece = pixels[ty0 - y:ty1 - y, tx0 - x:tx1 - x]
+            if not opaque:
+                blend_image(image, piece, tx0, ty0, engine)
+            elif piece.shape[2] == 4:
+                image[ty0:ty1, tx0:tx1] = piece
             else:
-                op_alpha = np.ones((op_h, op_w), dtype=np.float32)
-                op_rgb = op_image
+                image[ty0:ty1, tx0:tx1, :3] = piece
+                image[ty0:ty1, tx0:tx1, 3] = 255
+    return image
+
+
+def blend_stack_pixels(roi, op_image, engine=None):
+    # 在(N, h, w, 4)的ROI上原地混合同一张4通道组件图片，按批广播，结果与对每张图片调用blend_image相同
+    # 按批分段混合，临时数组不随N增大：N=64张1280x720的画布一次广播时float约需3GB临时数组
+    if engine is None:
+        engine = DEFAULT_BLEND_ENGINE
+    h, w = op_image.shape[:2]
+    step = max(1, STACK_TEMP_BYTES // (h * w * STACK_PIXEL_BYTES[engine]))
+    if engine == BLEND_FIXED:
+        # 与FixedPointBlender相同：v = op * A + roi * (255 - A)，floor(v / 255) = (v + 1 + (v >> 8)) >> 8
+        alpha = op_image[:, :, 3:].astype(np.uint16)
+        op = op_image.astype(np.uint16)
+        op[:, :, 3] = 255
+        op *= alpha
+        for start in range(0, len(roi), step):
+            chunk = roi[start:start + step]
+            values = chunk * (255 - alpha)
+            values += op
+            values += 1 + (values >> 8)
+            values >>= 8
+            chunk[:] = values
+        return roi
+    op_alpha = op_image[:, :, 3] / 255.0
+    op_rgb = op_image[:, :, :3] * op_alpha[:, :, np.newaxis]
+    for start in range(0, len(roi), step):
+        chunk = roi[start:start + step]
+        composite_rgb = op_rgb + chunk[..., :3] * (1 - op_alpha[:, :, np.newaxis])
+        composite_alpha = op_alpha + chunk[..., 3] / 255.0 * (1 - op_alpha)
+        chunk[..., :3] = composite_rgb
+        chunk[..., 3] = composite_alpha * 255
+    return roi
+
+
+def blend_layer_stack(stack, index, layer, x, y, engine=None):
+    # 把同一个TrimmedLayer混合到stack[index]的每张画布上，index为切片或下标数组，超出画布的部分被裁掉
+    # 下标数组取出的ROI是副本，混合后写回
+    with span('blend.stack'):
+        h, w = stack.shape[1:3]
+        pixels = layer.pixels
+        view = isinstance(index, slice)
+        for y0, y1, x0, x1, opaque in layer.spans:
+            ty0, ty1 = max(y + y0, 0), min(y + y1, h)
+            tx0, tx1 = max(x + x0, 0), min(x + x1, w)
+            if ty0 >= ty1 or tx0 >= tx1:
+                continue
+            piece = pixels[ty0 - y:ty1 - y, tx0 - x:tx1 - x]
+            if opaque:
+                if piece.shape[2] == 4:
+                    stack[index, ty0:ty1, tx0:tx1] = piece
+                else:
+                    stack[index, ty0:ty1, tx0:tx1, :3] = piece
+                    stack[index, ty0:ty1, tx0:tx1, 3] = 255
+                continue
+            roi = stack[index, ty0:ty1, tx0:tx1]
+            blend_stack_pixels(roi, piece, engine)
+            if not view:
+                stack[index, ty0:ty1, tx0:tx1] = roi
+    return stack
+
+
+def place_layer(width, height, operation_block, dir_path, cache=None, level=0):
+    # 读取组件并按偏移量定位，返回(TrimmedLayer, x, y)，(x, y)为裁剪后像素的左上角
+    # 与CG_synthesis_opencv一致：缺失或越界的组件返回None
+    if cache is None:
+        cache = default_cache
+    layer = cache.load_layer(dir_path, operation_block.name, level)
+    if layer is None:
+        return None
+    x, y = operation_block.x >> level, operation_block.y >> level
+    if x + layer.width > width or y + layer.height > height:
+        print("操作块图像超出主图像范围")
+        return None
+    return layer, x + layer.dx, y + layer.dy
+
 
-            roi = image[y:y + op_h, x:x + op_w]
-            roi_rgb = roi[:, :, :3]
-            roi_alpha = roi[:, :, 3] / 255.0
+def CG_synthesis_opencv(image, operation_block, dir_path, mode=0, cache=None, engine=None, level=0):
+    # level大于0时按2^level缩小的分辨率合成，组件与偏移量同步缩小
+    if cache is None:
+        cache = default_cache
+    layer = cache.load_layer(dir_path, operation_block.name, level)
+    if layer is not None:
+        if image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
 
-            composite_rgb = op_rgb * op_alpha[:, :, np.newaxis] + roi_rgb * (1 - op_alpha[:, :, np.newaxis])
-            composite_alpha = op_alpha + roi_alpha * (1 - op_alpha)
+        x, y = operation_block.x >> level, operation_block.y >> level
 
-            image[y:y + op_h, x:x + op_w, :3] = composite_rgb
-            image[y:y + op_h, x:x + op_w, 3] = composite_alpha * 255
+        # 越界判断仍按裁剪前的原图大小进行
+        if x + layer.width > image.shape[1] or y + layer.height > image.shape[0]:
+            print("操作块图像超出主图像范围")
+            return image
 
+        image = blend_layer(image, layer, x + layer.dx, y + layer.dy, engine)
 
     return image
 
 
-def synthesis(x,y,operation_blocks, dir_path):
+def synthesis(x,y,operation_blocks, dir_path, cache=None, engine=None, level=0):
     # image_filename = operation_blocks[0].name + '.png'
     # image = cv2.imread(os.path.join(dir_path, image_filename), cv2.IMREAD_UNCHANGED)
-    image = np.zeros((y, x, 4),dtype=np.uint8)
+    image = np.zeros((y >> level, x >> level, 4),dtype=np.uint8)
     for block in operation_blocks:
-        image = CG_synthesis_opencv(image, block, dir_path, 1)
+        image = CG_synthesis_opencv(image, block, dir_path, 1, cache, engine, level)
     return image
@@ -0,0 +1,162 @@
+import argparse
+import os
+import struct
+import sys
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from lsfInfo import LSF_HEADER_SIZE, LSF_BLOCK_SIZE
+
+# 信息块类型：底片为0，第n组人脸差分为10n，第n组脸红特效为10n+1，圣光为0xff
+TYPE_BASE = 0
+TYPE_HOLY_LIGHT = 0xff
+NAME_LIMIT = 20
+MAX_BLOCKS = 255
+
+# 合成数据集的参数：画布大小；底片数与每张底片拆成的块数；人脸差分与脸红特效的组数与每组键数；圣光数；
+# 人脸与特效组件的边长占画布短边的比例；组件中非透明像素的比例（底片总是完全不透明）
+SyntheticSpec = namedtuple('SyntheticSpec', [
+    'width', 'height', 'base_ids', 'base_parts', 'face_groups', 'face_keys', 'effect_groups', 'effect_keys',
+    'holy_lights', 'face_scale', 'coverage', 'seed',
+], defaults=[1280, 720, 2, 2, 2, 4, 1, 2, 1, 0.3, 0.6, 0])
+
+
+def spec_layers(spec):
+    # 每个组合的图层数：底片各块、各组特效、各组人脸差分与圣光
+    return spec.base_parts + spec.effect_groups + spec.face_groups + (1 if spec.holy_lights else 0)
+
+
+def encode_lsf(width, height, blocks, lsf_type=0):
+    # blocks为[(名字, x, y, 类型, ID, 模式)]，按LSFFile解析的28字节文件头与164字节信息块布局编码
+    if len(blocks) > MAX_BLOCKS:
+        raise ValueError(f"信息块数量不能超过{MAX_BLOCKS}: {len(blocks)}")
+    header = bytearray(LSF_HEADER_SIZE)
+    header[10] = len(blocks)
+    struct.pack_into('<H', header, 12, width)
+    struct.pack_into('<H', header, 16, height)
+    header[25] = lsf_type
+    datas = bytearray(header)
+    for name, x, y, block_type, block_id, mode in blocks:
+        encoded = name.encode('ascii')
+        if len(encoded) > NAME_LIMIT:
+            raise ValueError(f"信息块名字超过{NAME_LIMIT}字节: {name}")
+        block = bytearray(LSF_BLOCK_SIZE)
+        block[:len(encoded)] = encoded
+        struct.pack_into('<I', block, 128, x)
+        struct.pack_into('<I', block, 132, y)
+        block[152] = block_type
+        block[153] = block_id
+        block[154] = mode
+        block[155] = 0xff
+        datas += block
+    return bytes(datas)
+
+
+def make_component(rng, width, height, coverage):
+    # 颜色为平滑渐变加少量噪声；alpha由平滑随机场按分位数取阈值，非透明像素约占coverage，边缘为窄的半透明过渡
+    image = np.empty((height, width, 4), dtype=np.uint8)
+    color = rng.uniform(0, 255, (3, 3))
+    u = np.linspace(0, 1, width, dtype=np.float32)[np.newaxis, :]
+    v = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    for c in range(3):
+        channel = color[c, 0] + (color[c, 1] - color[c, 0]) * u + (color[c, 2] - color[c, 0]) * v
+        channel = channel + rng.normal(0, 4, (height, width))
+        image[:, :, c] = np.clip(channel, 0, 255)
+    if coverage >= 1 or coverage <= 0:
+        image[:, :, 3] = 255 if coverage >= 1 else 0
+        return image
+    field = cv2.resize(rng.random((6, 6), dtype=np.float32), (width, height), interpolation=cv2.INTER_CUBIC)
+    threshold = np.quantile(field, 1 - coverage)
+    spread = max(float(field.std()) * 0.05, 1e-6)
+    alpha = np.clip((field - threshold) / spread, 0, 1)
+    image[:, :, 3] = np.round(alpha * 255)
+    return image
+
+
+def generate_lsf(dir_path, name, spec, rng):
+    # 写出一个lsf文件及其引用的组件PNG，返回lsf文件路径
+    width, height = spec.width, spec.height
+    side = max(1, int(min(width, height) * spec.face_scale))
+    blocks = []
+    components = []
+
+    def add(block_name, x, y, block_type, block_id, w, h, coverage):
+        blocks.append((block_name, x, y, block_type, block_id, 0))
+        components.append((block_name, w, h, coverage))
+
+    # 底片按行拆成base_parts块，同ID的块依次组合成完整的底片
+    for base_id in range(1, spec.base_ids + 1):
+        for part in range(spec.base_parts):
+            top = height * part // spec.base_parts
+            bottom = height * (part + 1) // spec.base_parts
+            add(f'{name}_B{base_id}_{part}', 0, top, TYPE_BASE, base_id, width, bottom - top, 1.0)
+    for group in range(1, spec.effect_groups + 1):
+        x, y = int(rng.integers(0, width - side + 1)), int(rng.integers(0, height - side + 1))
+        for key in range(1, spec.effect_keys + 1):
+            add(f'{name}_E{group}_{key}', x, y, group * 10 + 1, key, side, side, spec.coverage)
+    for group in range(1, spec.face_groups + 1):
+        x, y = int(rng.integers(0, width - side + 1)), int(rng.integers(0, height - side + 1))
+        for key in range(1, spec.face_keys + 1):
+            add(f'{name}_F{group}_{key}', x, y, group * 10, key, side, side, spec.coverage)
+    for key in range(1, spec.holy_lights + 1):
+        add(f'{name}_H{key}', 0, 0, TYPE_HOLY_LIGHT, key, width, height, spec.coverage)
+
+    lsf_path = os.path.join(dir_path, name + '.lsf')
+    with open(lsf_path, 'wb') as file:
+        file.write(encode_lsf(width, height, blocks))
+    for block_name, w, h, coverage in components:
+        cv2.imwrite(os.path.join(dir_path, block_name + '.png'), make_component(rng, w, h, coverage))
+    return lsf_path
+
+
+def generate_dataset(dir_path, count, spec=SyntheticSpec(), prefix='EV_S'):
+    # 生成count个lsf文件与组件图片，相同的参数与种子总是生成相同的数据；返回lsf文件路径列表
+    os.makedirs(dir_path, exist_ok=True)
+    rng = np.random.default_rng(spec.seed)
+    return [generate_lsf(dir_path, f'{prefix}{i:02d}', spec, rng) for i in range(count)]
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def add_spec_arguments(parser):
+    defaults = SyntheticSpec()
+    parser.add_argument('--canvas', type=parse_size, default=(defaults.width, defaults.height),
+                        help='画布大小，例如1280x720')
+    parser.add_argument('--base-ids', type=int, default=defaults.base_ids, help='每个lsf文件的底片数')
+    parser.add_argument('--base-parts', type=int, default=defaults.base_parts, help='每张底片拆成的块数')
+    parser.add_argument('--face-groups', type=int, default=defaults.face_groups, help='人脸差分组数')
+    parser.add_argument('--face-keys', type=int, default=defaults.face_keys, help='每组人脸差分的键数')
+    parser.add_argument('--effect-groups', type=int, default=defaults.effect_groups, help='脸红特效组数')
+    parser.add_argument('--effect-keys', type=int, default=defaults.effect_keys, help='每组脸红特效的键数')
+    parser.add_argument('--holy-lights', type=int, default=defaults.holy_lights, help='圣光数')
+    parser.add_argument('--face-scale', type=float, default=defaults.face_scale, help='人脸与特效组件边长占画布短边的比例')
+    parser.add_argument('--coverage', type=float, default=defaults.coverage, help='人脸、特效与圣光组件中非透明像素的比例')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='随机种子')
+
+
+def spec_from_args(args):
+    return SyntheticSpec(args.canvas[0], args.canvas[1], args.base_ids, args.base_parts, args.face_groups,
+                         args.face_keys, args.effect_groups, args.effect_keys, args.holy_lights, args.face_scale,
+                         args.coverage, args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='生成合成的lsf文件与组件图片，用于基准测试')
+    parser.add_argument('output', help='输出目录')
+    parser.add_argument('-n', '--count', type=int, default=4, help='lsf文件数量')
+    parser.add_argument('--prefix', default='EV_S', help='lsf文件名前缀')
+    add_spec_arguments(parser)
+    args = parser.parse_args(argv)
+    spec = spec_from_args(args)
+    lsf_paths = generate_dataset(args.output, args.count, spec, args.prefix)
+    print(f"已生成 {len(lsf_paths)} 个lsf文件到 {args.output}（每个组合 {spec_layers(spec)} 个图层）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
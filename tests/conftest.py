@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在仓库根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lsfInfo import LSFFile  # noqa: E402
+from synthetic_data import SyntheticSpec, generate_dataset  # noqa: E402
+
+# 画布宽高不是分块大小的整数倍，组件带有半透明边缘
+TEST_SPEC = SyntheticSpec(width=320, height=240, face_keys=3, seed=7)
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    # 返回(解包目录, [LSFFile])，同一次测试中只生成一次
+    dir_path = str(tmp_path_factory.mktemp('dataset'))
+    paths = generate_dataset(dir_path, 2, TEST_SPEC)
+    return dir_path, [LSFFile(path) for path in paths]
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from compositor import BatchCompositor, compose_batch
+from synthesis_util import BLEND_FIXED, BLEND_FLOAT, synthesis
+import synthesis_util
+
+ENGINES = (BLEND_FLOAT, BLEND_FIXED)
+
+
+def variant_blocks(lsf):
+    return [variant.blocks for variant in lsf.iter_variants()]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_compose_batch_matches_synthesis(dataset, engine):
+    dir_path, lsfs = dataset
+    for lsf in lsfs:
+        block_lists = variant_blocks(lsf)
+        stack = compose_batch(lsf.x, lsf.y, block_lists, dir_path, engine=engine)
+        assert stack.shape == (len(block_lists), lsf.y, lsf.x, 4)
+        for canvas, blocks in zip(stack, block_lists):
+            assert np.array_equal(canvas, synthesis(lsf.x, lsf.y, blocks, dir_path, engine=engine))
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_compose_batch_in_small_chunks(dataset, engine, monkeypatch):
+    # 分段混合的临时数组上限小于一张画布时每段只有一个组合
+    monkeypatch.setattr(synthesis_util, 'STACK_TEMP_BYTES', 1)
+    dir_path, lsfs = dataset
+    lsf = lsfs[1]
+    block_lists = variant_blocks(lsf)[:24]
+    stack = compose_batch(lsf.x, lsf.y, block_lists, dir_path, engine=engine)
+    for canvas, blocks in zip(stack, block_lists):
+        assert np.array_equal(canvas, synthesis(lsf.x, lsf.y, blocks, dir_path, engine=engine))
+
+
+def test_batch_compositor_matches_synthesis(dataset):
+    dir_path, lsfs = dataset
+    lsf = lsfs[0]
+    # 打乱顺序，使同一层上的组合不连续，按下标取出ROI混合
+    block_lists = variant_blocks(lsf)[::-5]
+    batch = BatchCompositor(lsf.x, lsf.y, block_lists, dir_path, batch_size=7)
+    assert len(batch) == len(block_lists)
+    for canvas, blocks in zip(batch, block_lists):
+        assert np.array_equal(canvas, synthesis(lsf.x, lsf.y, blocks, dir_path))
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from synthesis_util import BLEND_FIXED, BLEND_FLOAT, blend_image, blend_stack_pixels, synthesis
+
+
+def random_layer(rng, h, w):
+    # alpha包括0、255与各种半透明值
+    layer = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+    choice = rng.integers(0, 3, (h, w))
+    layer[..., 3][choice == 0] = 0
+    layer[..., 3][choice == 1] = 255
+    return layer
+
+
+def max_difference(a, b):
+    return int(np.abs(a.astype(int) - b).max())
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_fixed_within_one_of_float(seed):
+    rng = np.random.default_rng(seed)
+    canvas = random_layer(rng, 97, 131)
+    float_canvas, fixed_canvas = canvas.copy(), canvas.copy()
+    # 多个图层依次混合，包括不同偏移量与边缘对齐的图层；每层之后两种引擎的画布统一，误差不累积
+    for h, w, x, y in ((97, 131, 0, 0), (40, 50, 3, 7), (61, 17, 114, 36), (1, 131, 0, 96), (33, 1, 5, 5)):
+        layer = random_layer(rng, h, w)
+        blend_image(float_canvas, layer, x, y, BLEND_FLOAT)
+        blend_image(fixed_canvas, layer, x, y, BLEND_FIXED)
+        assert max_difference(float_canvas, fixed_canvas) <= 1
+        fixed_canvas[:] = float_canvas
+
+
+def test_fixed_within_one_of_float_exhaustive():
+    # 组件像素值、组件alpha与画布像素值（画布alpha取相同的值）的全部组合，按组件alpha分段
+    values = np.arange(256, dtype=np.uint8)
+    for start in range(0, 256, 32):
+        op_alpha, op_value, value = np.meshgrid(values[start:start + 32], values, values, indexing='ij')
+        layer = np.stack([op_value, op_value, op_value, op_alpha], axis=-1).reshape(-1, 256, 4)
+        canvas = np.stack([value, value, value, value], axis=-1).reshape(-1, 256, 4)
+        float_canvas, fixed_canvas = canvas.copy(), canvas.copy()
+        blend_image(float_canvas, layer, 0, 0, BLEND_FLOAT)
+        blend_image(fixed_canvas, layer, 0, 0, BLEND_FIXED)
+        assert max_difference(float_canvas, fixed_canvas) <= 1
+
+
+@pytest.mark.parametrize('engine', (BLEND_FLOAT, BLEND_FIXED))
+def test_blend_stack_matches_blend_image(engine):
+    rng = np.random.default_rng(9)
+    layer = random_layer(rng, 45, 60)
+    stack = np.stack([random_layer(rng, 45, 60) for _ in range(6)])
+    expected = stack.copy()
+    for canvas in expected:
+        blend_image(canvas, layer, 0, 0, engine)
+    assert np.array_equal(blend_stack_pixels(stack, layer, engine), expected)
+
+
+def test_blend_stack_fixed_within_one_of_float():
+    rng = np.random.default_rng(10)
+    layer = random_layer(rng, 45, 60)
+    stack = np.stack([random_layer(rng, 45, 60) for _ in range(6)])
+    float_stack = blend_stack_pixels(stack.copy(), layer, BLEND_FLOAT)
+    fixed_stack = blend_stack_pixels(stack.copy(), layer, BLEND_FIXED)
+    assert max_difference(float_stack, fixed_stack) <= 1
+
+
+def test_synthesis_fixed_within_one_per_layer(dataset):
+    # 完整合成时误差可能逐层累积，每层不超过1
+    dir_path, lsfs = dataset
+    for lsf in lsfs:
+        for variant in list(lsf.iter_variants())[::11]:
+            a = synthesis(lsf.x, lsf.y, variant.blocks, dir_path, engine=BLEND_FLOAT)
+            b = synthesis(lsf.x, lsf.y, variant.blocks, dir_path, engine=BLEND_FIXED)
+            assert max_difference(a, b) <= len(variant.blocks)
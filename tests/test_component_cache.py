@@ -0,0 +1,33 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from component_cache import trim_layer
+from synthesis_util import BLEND_FIXED, BLEND_FLOAT, blend_image, blend_layer
+
+ENGINES = (BLEND_FLOAT, BLEND_FIXED)
+
+
+def sample_layers():
+    rng = np.random.default_rng(5)
+    partial = np.zeros((90, 70, 4), dtype=np.uint8)
+    partial[20:70, 15:60] = rng.integers(0, 256, (50, 45, 4), dtype=np.uint8)
+    partial[30:50, 20:40, 3] = 255
+    opaque = rng.integers(0, 256, (40, 50, 4), dtype=np.uint8)
+    opaque[..., 3] = 255
+    return [partial, opaque, np.zeros((30, 30, 4), dtype=np.uint8), rng.integers(0, 256, (35, 45, 3), dtype=np.uint8)]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('tile', (8, 32))
+def test_trimmed_layer_matches_full_blend(engine, tile):
+    # 裁掉透明边框并跳过透明块、直接复制不透明块后，结果与对原图调用blend_image一致
+    rng = np.random.default_rng(11)
+    for image, (x, y) in itertools.product(sample_layers(), ((0, 0), (13, 7), (50, 60))):
+        canvas = rng.integers(0, 256, (160, 130, 4), dtype=np.uint8)
+        expected = canvas.copy()
+        blend_image(expected, image, x, y, engine)
+        layer = trim_layer(image, tile)
+        blend_layer(canvas, layer, x + layer.dx, y + layer.dy, engine)
+        assert np.array_equal(canvas, expected)
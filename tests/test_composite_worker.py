@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+QtCore = pytest.importorskip('PyQt5.QtCore')
+
+from composite_worker import CompositeScheduler
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+def process_until(app, condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+    return condition()
+
+
+def test_after_running_ignores_later_tasks(app):
+    scheduler = CompositeScheduler(max_threads=2)
+    started = threading.Event()
+    old_release = threading.Event()
+    new_release = threading.Event()
+    calls = []
+    scheduler.submit('old', lambda: started.set() or old_release.wait(5), calls.append, calls.append)
+    assert started.wait(5)
+    scheduler.cancel_all()
+    scheduler.after_running(lambda: calls.append('closed'))
+    # 取消之后提交的任务仍在运行时，已取消的任务结束即调用callback
+    scheduler.submit('new', lambda: new_release.wait(5), calls.append)
+    old_release.set()
+    assert process_until(app, lambda: 'closed' in calls)
+    assert 'new' in scheduler.channels
+    new_release.set()
+    assert process_until(app, lambda: not scheduler.channels)
+    assert calls == [True, 'closed', True]
+    scheduler.after_running(lambda: calls.append('idle'))
+    assert calls[-1] == 'idle'
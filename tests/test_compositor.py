@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import synthesis_script
+from component_cache import default_cache
+from compositor import IncrementalCompositor, LayerCompositor
+from synthesis_util import BLEND_FIXED, BLEND_FLOAT, synthesis
+
+ENGINES = (BLEND_FLOAT, BLEND_FIXED)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('order', ('gray', 'shuffled'))
+def test_incremental_matches_full_compose(dataset, engine, order):
+    dir_path, lsfs = dataset
+    lsf = lsfs[0]
+    variants = list(lsf.iter_variants())
+    if order == 'shuffled':
+        # 相邻组合可能有多个图层不同，脏矩形为各变化图层包围盒的并集
+        variants = [variants[i] for i in np.random.default_rng(2).permutation(len(variants))[:40]]
+    incremental = IncrementalCompositor(LayerCompositor(lsf.x, lsf.y, dir_path, engine=engine))
+    previous = None
+    partial = 0
+    for variant in variants:
+        canvas, dirty = incremental.update(variant.blocks)
+        expected = synthesis(lsf.x, lsf.y, variant.blocks, dir_path, engine=engine)
+        assert np.array_equal(canvas, expected)
+        if previous is not None:
+            # 脏矩形之外的像素与上一个组合相同
+            outside = np.ones(expected.shape[:2], dtype=bool)
+            if dirty is not None:
+                x, y, w, h = dirty
+                outside[y:y + h, x:x + w] = False
+                partial += w * h < lsf.x * lsf.y
+            assert np.array_equal(expected[outside], previous[outside])
+        previous = expected
+    assert partial > 0
+
+
+def test_incremental_unchanged_blocks(dataset):
+    dir_path, lsfs = dataset
+    lsf = lsfs[1]
+    variant = next(lsf.iter_variants())
+    incremental = IncrementalCompositor(LayerCompositor(lsf.x, lsf.y, dir_path))
+    canvas, dirty = incremental.update(variant.blocks)
+    assert dirty == (0, 0, lsf.x, lsf.y)
+    canvas, dirty = incremental.update(list(variant.blocks))
+    assert dirty is None
+    assert np.array_equal(canvas, synthesis(lsf.x, lsf.y, variant.blocks, dir_path))
+
+
+def test_worker_cache_bounds_prefix_cache(dataset, tmp_path):
+    dir_path, lsfs = dataset
+    cache_bytes = default_cache.max_bytes
+    prefix_bytes = synthesis_script.prefix_cache_bytes
+    try:
+        synthesis_script.run(dir_path, str(tmp_path), use_catalog=False, worker_cache_bytes=8 * 1024 * 1024)
+        # 组件缓存与保留的合成器的前缀缓存加起来不超过每个进程的缓存上限
+        compositors = [synthesis_script.load_compositor(dir_path, lsf.name + '.lsf', synthesis_script.DEFAULT_BLEND_ENGINE)
+                       for lsf in lsfs]
+        assert default_cache.max_bytes + sum(c.max_bytes for c in compositors) <= 8 * 1024 * 1024
+        assert all(0 < c.stats()['bytes'] <= c.max_bytes for c in compositors)
+    finally:
+        synthesis_script.prefix_cache_bytes = prefix_bytes
+        default_cache.set_max_bytes(cache_bytes)
+        synthesis_script.load_compositor.cache_clear()
@@ -0,0 +1,78 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from dedup import DEDUP_LINK, DEDUP_MANIFEST, DEDUP_SKIP, Deduplicator, blocks_signature, resolve_entries
+import synthesis_script
+from synthesis_util import synthesis
+
+
+def expected_images(dataset):
+    # {输出文件名: 合成结果}，与synthesis_script按lsf文件输出的组合相同
+    dir_path, lsfs = dataset
+    images = {}
+    for lsf in lsfs:
+        for id, fds, fd, out_name in synthesis_script.plan_variants(lsf):
+            blocks = lsf.get_operation_blocks(id, {fds: fd}, {}, 0)
+            images[out_name] = synthesis(lsf.x, lsf.y, blocks, dir_path)
+    return images
+
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, DEDUP_MANIFEST), encoding='utf-8') as file:
+        return json.load(file)
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+@pytest.mark.parametrize('mode', (DEDUP_SKIP, DEDUP_LINK))
+def test_dedup_outputs(dataset, tmp_path, mode, jobs):
+    out_dir = str(tmp_path)
+    synthesis_script.run(dataset[0], out_dir, jobs=jobs, use_catalog=False, dedup=mode)
+    outputs = read_manifest(out_dir)['outputs']
+    expected = expected_images(dataset)
+    assert sorted(outputs) == sorted(expected)
+    # 每组人脸差分的键1与其他组的默认键相同，每张底片有重复的组合
+    duplicates = [path for path, canonical in outputs.items() if path != canonical]
+    assert duplicates
+    for path, canonical in outputs.items():
+        assert outputs[canonical] == canonical
+        image = cv2.imread(os.path.join(out_dir, canonical), cv2.IMREAD_UNCHANGED)
+        assert np.array_equal(image, expected[path])
+        if path == canonical:
+            continue
+        if mode == DEDUP_SKIP:
+            assert not os.path.exists(os.path.join(out_dir, path))
+        else:
+            assert os.path.samefile(os.path.join(out_dir, path), os.path.join(out_dir, canonical))
+
+
+def test_deduplicator_claims(tmp_path):
+    deduplicator = Deduplicator()
+    a, b, c = (str(tmp_path / name) for name in ('a.png', 'b.png', 'c.png'))
+    # 按签名查找时未找到不登记；合成后按签名或像素哈希找到相同的图片
+    assert deduplicator.claim(a, 'sig-a') is None
+    assert deduplicator.claim(a, 'sig-a', 'digest-1') is None
+    assert deduplicator.claim(b, 'sig-a') == a
+    assert deduplicator.claim(c, 'sig-c', 'digest-1') == a
+    assert [entry[:2] for entry in deduplicator.take_entries()] == [(a, None), (b, a), (c, a)]
+    # 之前的运行登记的图片：同一个输出路径需要重新输出，其他相同签名的组合对应到它
+    deduplicator.seed({'sig-d': a})
+    assert deduplicator.claim(a, 'sig-d') is None
+    assert deduplicator.claim(b, 'sig-d') == a
+
+
+def test_resolve_entries_across_processes():
+    # 两个进程各自输出了相同的图片，按任务顺序保留第一张
+    entries = [('x/a', None, 's1', 'd1'), ('x/b', 'x/a', 's2', 'd1'), ('x/c', None, 's1', 'd1'),
+               ('x/d', 'x/c', 's3', 'd1'), ('x/e', None, 's4', 'd2')]
+    assert resolve_entries(entries) == {'x/a': 'x/a', 'x/b': 'x/a', 'x/c': 'x/a', 'x/d': 'x/a', 'x/e': 'x/e'}
+
+
+def test_blocks_signature_depends_on_layers_and_canvas(dataset):
+    lsf = dataset[1][0]
+    blocks = lsf.get_operation_blocks(1, {}, {}, 0)
+    assert blocks_signature(lsf.x, lsf.y, blocks) == blocks_signature(lsf.x, lsf.y, list(blocks))
+    assert blocks_signature(lsf.x, lsf.y, blocks) != blocks_signature(lsf.x + 1, lsf.y, blocks)
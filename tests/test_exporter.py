@@ -0,0 +1,77 @@
+import struct
+
+import cv2
+import numpy as np
+import pytest
+
+from exporter import ExportSettings, FORMAT_QOI, encode_image, qoi_encode
+
+
+def qoi_decode(data):
+    # 按QOI规范逐字节解码的参考实现，返回BGR或BGRA图片
+    assert data[:4] == b'qoif'
+    width, height, channels, _ = struct.unpack('>IIBB', data[4:14])
+    assert data[-8:] == b'\0' * 7 + b'\1'
+    out = np.empty((width * height, 4), dtype=np.uint8)
+    index = [(0, 0, 0, 0)] * 64
+    pixel = (0, 0, 0, 255)
+    p = 14
+    i = 0
+    while i < width * height:
+        b = data[p]
+        p += 1
+        run = 1
+        if b == 0xFE:
+            pixel = (data[p], data[p + 1], data[p + 2], pixel[3])
+            p += 3
+        elif b == 0xFF:
+            pixel = tuple(data[p:p + 4])
+            p += 4
+        elif b >> 6 == 0:
+            pixel = index[b]
+        elif b >> 6 == 1:
+            pixel = ((pixel[0] + (b >> 4 & 3) - 2) % 256, (pixel[1] + (b >> 2 & 3) - 2) % 256,
+                     (pixel[2] + (b & 3) - 2) % 256, pixel[3])
+        elif b >> 6 == 2:
+            b2 = data[p]
+            p += 1
+            dg = (b & 63) - 32
+            pixel = ((pixel[0] + dg - 8 + (b2 >> 4)) % 256, (pixel[1] + dg) % 256,
+                     (pixel[2] + dg - 8 + (b2 & 15)) % 256, pixel[3])
+        else:
+            run = (b & 63) + 1
+        index[(pixel[0] * 3 + pixel[1] * 5 + pixel[2] * 7 + pixel[3] * 11) % 64] = pixel
+        out[i:i + run] = pixel
+        i += run
+    assert p == len(data) - 8
+    image = out.reshape(height, width, 4)[:, :, [2, 1, 0, 3]]
+    return image if channels == 4 else image[:, :, :3]
+
+
+def sample_images():
+    # 随机噪声、平滑渐变（差分与亮度编码）、大片相同像素（游程与索引）与半透明边缘
+    rng = np.random.default_rng(3)
+    noise = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    gradient = np.zeros((40, 90, 4), dtype=np.uint8)
+    gradient[..., 0] = np.arange(90, dtype=np.uint8)
+    gradient[..., 1] = np.arange(40, dtype=np.uint8)[:, np.newaxis] * 3
+    gradient[..., 2] = 200
+    gradient[..., 3] = 255
+    flat = np.zeros((64, 80, 4), dtype=np.uint8)
+    flat[10:50, 20:70] = (30, 60, 90, 255)
+    flat[20:30, 30:40, 3] = rng.integers(0, 256, (10, 10), dtype=np.uint8)
+    palette = rng.integers(0, 256, (5, 4), dtype=np.uint8)
+    indexed = palette[rng.integers(0, 5, (33, 41))]
+    return [noise, gradient, flat, indexed, np.zeros((1, 200, 4), dtype=np.uint8)]
+
+
+@pytest.mark.parametrize('image', sample_images())
+def test_qoi_roundtrip(image):
+    assert np.array_equal(qoi_decode(qoi_encode(image)), image)
+    assert np.array_equal(qoi_decode(qoi_encode(image[:, :, :3])), image[:, :, :3])
+    assert encode_image(image, ExportSettings(FORMAT_QOI)) == qoi_encode(image)
+
+
+def test_default_png_matches_imencode():
+    image = sample_images()[0]
+    assert encode_image(image, ExportSettings()) == cv2.imencode('.png', image)[1].tobytes()
@@ -0,0 +1,33 @@
+import importlib
+import os
+import stat
+
+import file_util
+from file_util import create_temp_file, process_umask
+
+
+def test_temp_file_uses_umask(tmp_path):
+    umask = os.umask(0o027)
+    try:
+        # 测试中修改了umask，重新读取
+        file_util._umask = None
+        fd, path = create_temp_file(str(tmp_path), '.png')
+        os.close(fd)
+        assert os.path.basename(path).startswith('.tmp-') and path.endswith('.png')
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+        assert process_umask() == 0o027
+        # 读取umask不修改它
+        assert os.umask(0o027) == 0o027
+    finally:
+        os.umask(umask)
+        file_util._umask = None
+
+
+def test_import_does_not_touch_umask():
+    umask = os.umask(0o022)
+    try:
+        importlib.reload(file_util)
+        assert file_util._umask is None
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
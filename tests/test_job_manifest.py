@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from dedup import DEDUP_MANIFEST, DEDUP_SKIP
+from job_manifest import JOB_MANIFEST, STATE_DONE, STATE_DUPLICATE
+import synthesis_script
+
+
+def run(file_dir, out_dir, **kwargs):
+    # 返回本次写出的文件名集合与按任务清单跳过的组合数
+    kwargs.setdefault('manifest_path', os.path.join(out_dir, JOB_MANIFEST))
+    results, skipped = synthesis_script.run(file_dir, out_dir, use_catalog=False, **kwargs)
+    written = {os.path.basename(path) for records, _, _, _ in results for path, _, _ in records}
+    return written, skipped + sum(result[3] for result in results)
+
+
+def states(out_dir):
+    with sqlite3.connect(os.path.join(out_dir, JOB_MANIFEST)) as conn:
+        return dict(conn.execute('SELECT path, state FROM variants'))
+
+
+@pytest.fixture
+def source(dataset, tmp_path):
+    # 测试会修改组件图片，使用数据集的副本
+    dir_path = str(tmp_path / 'source')
+    shutil.copytree(dataset[0], dir_path)
+    return dir_path
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_resume_after_partial_run(source, tmp_path, jobs):
+    out_dir = str(tmp_path / 'out')
+    written, skipped = run(source, out_dir, jobs=jobs)
+    total = len(written)
+    assert skipped == 0 and total > 0
+    assert set(states(out_dir).values()) == {STATE_DONE}
+
+    # 模拟中断：部分输出不存在或仍为pending，重新运行只输出这些组合
+    missing = sorted(written)[:3]
+    pending = sorted(written)[-1]
+    for name in missing:
+        os.remove(os.path.join(out_dir, name))
+    with sqlite3.connect(os.path.join(out_dir, JOB_MANIFEST)) as conn:
+        conn.execute("UPDATE variants SET state = 'pending' WHERE path = ?", (pending,))
+    # dry_run不修改任务清单
+    before = states(out_dir)
+    synthesis_script.run(source, out_dir, use_catalog=False, dry_run=True,
+                         manifest_path=os.path.join(out_dir, JOB_MANIFEST))
+    assert states(out_dir) == before
+    written, skipped = run(source, out_dir, jobs=jobs)
+    assert written == set(missing) | {pending}
+    assert skipped == total - len(written)
+
+    written, skipped = run(source, out_dir, jobs=jobs)
+    assert written == set() and skipped == total
+    written, skipped = run(source, out_dir, jobs=jobs, resume=False)
+    assert len(written) == total and skipped == 0
+
+
+def test_changed_component_is_rendered_again(source, tmp_path):
+    out_dir = str(tmp_path / 'out')
+    written, _ = run(source, out_dir)
+    # 修改第二组人脸差分的键2，只有使用它的组合重新输出
+    component = next(name for name in os.listdir(source) if name.endswith('_F2_2.png'))
+    path = os.path.join(source, component)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    written, skipped = run(source, out_dir)
+    lsf_name = component[:-len('_F2_2.png')]
+    assert written == {f'{lsf_name}_{base}_2_2.png' for base in (1, 2)}
+    assert skipped > 0
+
+
+def test_dedup_manifest_is_kept_across_runs(source, tmp_path):
+    out_dir = str(tmp_path / 'out')
+    written, _ = run(source, out_dir, dedup=DEDUP_SKIP)
+    with open(os.path.join(out_dir, DEDUP_MANIFEST), encoding='utf-8') as file:
+        first = json.load(file)
+    duplicates = {path for path, canonical in first['outputs'].items() if path != canonical}
+    assert duplicates and written == set(first['outputs']) - duplicates
+    assert {path for path, state in states(out_dir).items() if state == STATE_DUPLICATE} == duplicates
+
+    # 第二次运行没有需要输出的组合，清单保持不变
+    assert run(source, out_dir, dedup=DEDUP_SKIP)[0] == set()
+    with open(os.path.join(out_dir, DEDUP_MANIFEST), encoding='utf-8') as file:
+        assert json.load(file) == first
+
+    # 没有任务清单时全部重新合成，之前登记的签名使重复的组合仍然不输出
+    os.remove(os.path.join(out_dir, JOB_MANIFEST))
+    written, _ = run(source, out_dir, dedup=DEDUP_SKIP)
+    assert written == set(first['outputs']) - duplicates
+    with open(os.path.join(out_dir, DEDUP_MANIFEST), encoding='utf-8') as file:
+        assert json.load(file)['outputs'] == first['outputs']
+    assert not any(os.path.exists(os.path.join(out_dir, path)) for path in duplicates)
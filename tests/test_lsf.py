@@ -0,0 +1,164 @@
+import itertools
+
+import pytest
+
+from lsfInfo import PARSER_LEGACY, PARSER_NUMPY, BlockInfo, BlockTable, LSFFile, parse_lsf_bytes
+from synthetic_data import encode_lsf
+
+
+class BaselineLSF:
+    # 原有的逐字节解析与分类，作为对照
+    def __init__(self, file_path, name):
+        with open(file_path, 'rb') as file:
+            datas = [int(d) for d in file.read()]
+        self.name = name
+        self.x = datas[12] + datas[13] * 256
+        self.y = datas[16] + datas[17] * 256
+        self.type = datas[25]
+        self.blocks = []
+        for i in range(datas[10]):
+            base = 28 + i * 164
+            name = ''
+            for j in range(20):
+                if datas[base + j] == 0:
+                    break
+                name += chr(datas[base + j])
+            self.blocks.append((name, datas[base + 128] + datas[base + 129] * 256,
+                                datas[base + 132] + datas[base + 133] * 256,
+                                datas[base + 152], datas[base + 153], datas[base + 154]))
+        self.naked_image = None
+        self.base_images = {}
+        self.face_differences = {}
+        self.face_effects = {}
+        self.holy_light = {}
+        for block in self.blocks:
+            _, _, _, type, id, mode = block
+            if type == 0 and self.name[0] == '0':
+                self.naked_image = block
+            if mode != 0:
+                continue
+            if type == 0 or type == 3:
+                if id not in self.base_images:
+                    self.base_images[id] = [self.blocks[0]] if self.blocks[0][4] == 0 else []
+                self.base_images[id].append(block)
+            elif type % 10 == 0 or type == 1:
+                self.face_differences.setdefault(type // 10, {}).setdefault(id, block)
+            elif type % 10 == 1 or type == 2:
+                self.face_effects.setdefault((type - 1) // 10, {})[id] = block
+            elif type == 255:
+                self.holy_light[id] = block
+
+    def get_operation_blocks(self, bi_key, fd_keys, fe_keys, hl_key):
+        if bi_key not in self.base_images:
+            bi_key = min(self.base_images)
+        for n in self.face_differences:
+            if fd_keys.get(n) not in self.face_differences[n]:
+                fd_keys[n] = 1
+        for n in self.face_effects:
+            if fe_keys.get(n) not in self.face_effects[n]:
+                fe_keys[n] = 0
+        if hl_key not in self.holy_light:
+            hl_key = 0
+        blocks = list(self.base_images[bi_key])
+        blocks += [self.face_effects[n][key] for n, key in fe_keys.items() if n in self.face_effects and key != 0]
+        blocks += [self.face_differences[n][key] for n, key in fd_keys.items() if n in self.face_differences]
+        if self.naked_image is not None:
+            blocks.append(self.naked_image)
+        if hl_key != 0:
+            blocks.append(self.holy_light[hl_key])
+        return sorted(blocks, key=lambda block: block[0])
+
+
+def row(block):
+    return block.name, block.x, block.y, block.type, block.id, block.mode
+
+
+# 覆盖各分类分支：ID为0的首个块、类型3的底片、mode非0、类型1与2、同组同ID的重复块、无法分类的类型、
+# 20字节的名字、超过255的坐标与lsf文件名以0开头时的裸体图层
+EDGE_BLOCKS = [
+    ('0Z_B0', 0, 0, 0, 0, 0), ('0Z_B1a', 300, 400, 0, 1, 0), ('0Z_B1b', 0, 360, 3, 1, 0),
+    ('0Z_B2', 0, 0, 0, 2, 0), ('0Z_B2m', 0, 0, 0, 2, 1), ('0Z_F1_1', 10, 20, 10, 1, 0),
+    ('0Z_F1_1dup', 11, 21, 10, 1, 0), ('0Z_F1_2', 10, 20, 10, 2, 0), ('0Z_T1', 5, 5, 1, 1, 0),
+    ('0Z_F10_1', 7, 9, 100, 1, 0), ('0Z_E1_1', 1, 1, 11, 1, 0), ('0Z_E1_1dup', 2, 2, 11, 1, 0),
+    ('0Z_T2', 3, 3, 2, 4, 0), ('0Z_X7', 0, 0, 7, 1, 0), ('0Z_H1', 0, 0, 255, 1, 0),
+    ('0Z_H1dup', 0, 0, 255, 1, 0), ('0Z_H2', 0, 0, 255, 2, 3), ('ABCDEFGHIJKLMNOPQRST', 1000, 700, 21, 1, 0),
+]
+
+
+@pytest.fixture(scope='module')
+def lsf_paths(dataset, tmp_path_factory):
+    path = tmp_path_factory.mktemp('lsf') / '0Z.lsf'
+    path.write_bytes(encode_lsf(1280, 720, EDGE_BLOCKS, lsf_type=2))
+    return [lsf.file_path for lsf in dataset[1]] + [str(path)]
+
+
+def key_combinations(baseline):
+    # 各组的全部键加上不存在的键
+    bases = list(baseline.base_images) + [99]
+    fds = [dict(zip(baseline.face_differences, keys)) for keys in itertools.product(
+        *[list(group) + [99] for group in baseline.face_differences.values()])]
+    fes = [dict(zip(baseline.face_effects, keys)) for keys in itertools.product(
+        *[[0] + list(group) + [99] for group in baseline.face_effects.values()])]
+    hls = [0] + list(baseline.holy_light) + [99]
+    return itertools.product(bases, fds[:12], fes[:6], hls)
+
+
+@pytest.mark.parametrize('parser', (PARSER_NUMPY, PARSER_LEGACY))
+def test_parse_matches_baseline(lsf_paths, parser):
+    for path in lsf_paths:
+        lsf = LSFFile(path, parser=parser)
+        baseline = BaselineLSF(path, lsf.name)
+        assert (lsf.x, lsf.y, lsf.type) == (baseline.x, baseline.y, baseline.type)
+        assert [row(block) for block in lsf.blocks] == baseline.blocks
+        assert {key: [row(block) for block in blocks] for key, blocks in lsf.base_images.items()} \
+            == baseline.base_images
+        for mine, theirs in ((lsf.face_differences, baseline.face_differences),
+                             (lsf.face_effects, baseline.face_effects)):
+            assert {n: {key: row(block) for key, block in group.items()} for n, group in mine.items()} == theirs
+            # 键的顺序决定差分列表与组合枚举的顺序
+            assert [list(group) for group in mine.values()] == [list(group) for group in theirs.values()]
+        assert {key: row(block) for key, block in lsf.holy_light.items()} == baseline.holy_light
+        assert (row(lsf.naked_image) if lsf.naked_image is not None else None) == baseline.naked_image
+        for bi, fd, fe, hl in key_combinations(baseline):
+            mine_fd, mine_fe = dict(fd), dict(fe)
+            blocks = lsf.get_operation_blocks(bi, mine_fd, mine_fe, hl)
+            assert [row(block) for block in blocks] == baseline.get_operation_blocks(bi, fd, fe, hl)
+            # 传入的字典同样被补全
+            assert (mine_fd, mine_fe) == (fd, fe)
+
+
+def test_edge_case_categories(lsf_paths):
+    lsf = LSFFile(lsf_paths[-1])
+    assert [block.name for block in lsf.base_images[1]] == ['0Z_B0', '0Z_B1a', '0Z_B1b']
+    assert lsf.face_differences[1][1].name == '0Z_F1_1'
+    assert lsf.face_differences[0][1].name == '0Z_T1'
+    assert lsf.face_effects[1][1].name == '0Z_E1_1dup'
+    assert lsf.holy_light == {1: lsf.holy_light[1]} and lsf.holy_light[1].name == '0Z_H1dup'
+    assert lsf.naked_image.name == '0Z_B2m'
+    assert lsf.face_effects[2][1].name == 'ABCDEFGHIJKLMNOPQRST'
+
+
+def test_from_bytes_and_table_match_file(lsf_paths):
+    for path in lsf_paths:
+        lsf = LSFFile(path)
+        with open(path, 'rb') as file:
+            datas = file.read()
+        x, y, type, table = parse_lsf_bytes(datas)
+        for other in (LSFFile.from_bytes(path, datas), LSFFile.from_table(path, x, y, type, table)):
+            assert (other.x, other.y, other.type, other.name) == (lsf.x, lsf.y, lsf.type, lsf.name)
+            assert [row(block) for block in other.blocks] == [row(block) for block in lsf.blocks]
+            assert {key: [row(block) for block in blocks] for key, blocks in other.base_images.items()} \
+                == {key: [row(block) for block in blocks] for key, blocks in lsf.base_images.items()}
+
+
+def test_block_table_views():
+    blocks = [BlockInfo('a', 1, 2, 0, 1, 0), BlockInfo('b', 300, 400, 255, 2, 3)]
+    table = BlockTable.from_blocks(blocks)
+    assert len(table) == 2
+    assert [row(block) for block in table] == [('a', 1, 2, 0, 1, 0), ('b', 300, 400, 255, 2, 3)]
+    assert row(table[-1]) == row(table[1]) == row(blocks[1])
+    assert all(type(value) is int for value in row(table[0])[1:])
+    with pytest.raises(IndexError):
+        table[2]
+    with pytest.raises(IndexError):
+        table[-3]
@@ -0,0 +1,25 @@
+from component_cache import ComponentCache, preview_level
+from compositor import LayerCompositor
+from prefetcher import Prefetcher
+
+
+def test_warmed_lsf_composites_without_reads(dataset, monkeypatch):
+    dir_path, lsfs = dataset
+    cache = ComponentCache()
+    prefetcher = Prefetcher(cache=cache, budget_ratio=1)
+    loaders = {lsf.name: lsf for lsf in lsfs}
+
+    def level(lsf):
+        # 与GUI相同，按各lsf的画布大小与显示区域计算预览级别
+        return min(preview_level(lsf.x, 100), preview_level(lsf.y, 80))
+
+    prefetcher.warm_lsf_files(dir_path, list(loaders), loader=loaders.get, level=level)
+    reads = []
+    read = ComponentCache._read
+    monkeypatch.setattr(ComponentCache, '_read', staticmethod(lambda *args: reads.append(args) or read(*args)))
+    for lsf in lsfs:
+        assert level(lsf) > 0
+        compositor = LayerCompositor(lsf.x, lsf.y, dir_path, cache=cache, level=level(lsf))
+        canvas = compositor.compose(lsf.get_operation_blocks(min(lsf.base_images), {}, {}, 0))
+        assert canvas.shape[:2] == (lsf.y >> level(lsf), lsf.x >> level(lsf))
+    assert reads == []
@@ -0,0 +1,163 @@
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from server import CompositeServer, CompositeService, serve
+from synthesis_util import synthesis
+from synthetic_data import encode_lsf
+
+
+@contextlib.contextmanager
+def running_server(dir_path):
+    # 在后台线程的事件循环中监听随机端口，给出(CompositeServer, 端口)
+    service = CompositeService(dir_path, use_catalog=False)
+    composite_server = CompositeServer(service, workers=2)
+    ready = threading.Event()
+    state = {}
+
+    def on_ready(address):
+        state['port'] = int(address.rsplit(':', 1)[1])
+        ready.set()
+
+    async def run():
+        # asyncio.run结束时取消仍在等待的连接并关闭事件循环
+        state['loop'] = asyncio.get_running_loop()
+        state['task'] = asyncio.current_task()
+        await serve(composite_server, port=0, ready=on_ready)
+
+    def target():
+        try:
+            asyncio.run(run())
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    assert ready.wait(10)
+    try:
+        yield composite_server, state['port']
+    finally:
+        state['loop'].call_soon_threadsafe(state['task'].cancel)
+        thread.join(10)
+        composite_server.close()
+
+
+@pytest.fixture
+def server(dataset):
+    with running_server(dataset[0]) as value:
+        yield value
+
+
+def request(port, path, method='GET', headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def test_composite_matches_synthesis(dataset, server):
+    dir_path, lsfs = dataset
+    _, port = server
+    lsf = lsfs[0]
+    status, _, body = request(port, f'/lsf/{lsf.name}')
+    assert status == 200
+    info = json.loads(body)
+    assert info['bases'] == [1, 2]
+    status, headers, body = request(port, f'/composite/{lsf.name}?base=2&fd=1-3,2-2&fe=1-1&hl=1')
+    assert status == 200
+    assert headers['Content-Type'] == 'image/png'
+    blocks = lsf.get_operation_blocks(2, {1: 3, 2: 2}, {1: 1}, 1)
+    expected = synthesis(lsf.x, lsf.y, blocks, dir_path)
+    assert np.array_equal(cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_UNCHANGED), expected)
+    status, _, body = request(port, f'/composite/{lsf.name}?base=2&fd=1-3,2-2&fe=1-1&hl=1&format=raw')
+    assert status == 200
+    assert np.array_equal(np.load(io.BytesIO(body)), expected)
+
+
+def test_missing_keys_are_not_found(dataset, server):
+    _, port = server
+    name = dataset[1][0].name
+    for query in ('base=9', 'fd=1-9', 'fd=7-1', 'fe=1-5', 'hl=3'):
+        status, _, body = request(port, f'/composite/{name}?{query}')
+        assert status == 404, query
+        assert 'error' in json.loads(body)
+    assert request(port, f'/composite/{name}?fe=1-0&hl=0')[0] == 200
+    assert request(port, f'/composite/{name}?base=x')[0] == 400
+    assert request(port, '/composite/EV_NONE')[0] == 404
+
+
+def test_lsf_endpoints_run_in_pool(dataset, server):
+    # 列出与读取lsf文件不在事件循环的线程中进行
+    composite_server, port = server
+    service = composite_server.service
+    threads = []
+    for name in ('list_lsf', 'describe', 'prepare'):
+        method = getattr(service, name)
+
+        def traced(*args, method=method):
+            threads.append(threading.current_thread().name)
+            return method(*args)
+
+        setattr(service, name, traced)
+    name = dataset[1][0].name
+    assert request(port, '/lsf')[0] == 200
+    assert request(port, f'/lsf/{name}')[0] == 200
+    assert request(port, f'/composite/{name}', 'HEAD')[0] == 200
+    assert len(threads) == 3
+    assert all(thread.startswith('ThreadPoolExecutor') for thread in threads)
+
+
+def test_lsf_without_base_images(tmp_path):
+    # 只有人脸差分的lsf文件：省略底片时没有可用的默认值
+    (tmp_path / 'EV_X.lsf').write_bytes(encode_lsf(64, 48, [('EV_X_F1_1', 0, 0, 10, 1, 0)]))
+    with running_server(str(tmp_path)) as (_, port):
+        status, _, body = request(port, '/lsf/EV_X')
+        assert status == 200 and json.loads(body)['bases'] == []
+        for query in ('', '?base=1'):
+            status, _, body = request(port, '/composite/EV_X' + query)
+            assert status == 404, query
+            assert 'error' in json.loads(body)
+
+
+def test_etag_and_head_do_not_compose(dataset, server):
+    composite_server, port = server
+    counters = composite_server.service.counters
+    path = f'/composite/{dataset[1][1].name}?base=1&fd=1-2'
+    status, headers, body = request(port, path, 'HEAD')
+    assert status == 200 and body == b''
+    assert 'Content-Length' not in headers
+    assert counters['composed'] == 0
+    status, headers, body = request(port, path)
+    assert status == 200 and counters['composed'] == 1
+    etag = headers['ETag']
+    status, head_headers, _ = request(port, path, 'HEAD')
+    assert head_headers['ETag'] == etag
+    assert int(head_headers['Content-Length']) == len(body)
+    status, _, body = request(port, path, headers={'If-None-Match': etag})
+    assert status == 304 and body == b''
+    assert counters['composed'] == 1 and counters['not_modified'] == 1
+
+
+def test_concurrent_requests_are_coalesced(dataset, server):
+    composite_server, port = server
+    path = f'/composite/{dataset[1][1].name}?base=2&fd=1-1,2-3&format=qoi'
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(request(port, path)[0])) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 4
+    counters = composite_server.service.counters
+    assert counters['composed'] == 1
+    assert counters['coalesced'] + counters['memory_hits'] == 3
@@ -0,0 +1,99 @@
+import io
+import itertools
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from dedup import pixel_digest
+from exporter import ExportSettings, FORMAT_RAW, NpyRowWriter, PngRowWriter, encode_image
+from synthesis_util import BLEND_FIXED, BLEND_FLOAT, synthesis
+from tiled import export_tiled, synthesis_tiled
+
+ENGINES = (BLEND_FLOAT, BLEND_FIXED)
+
+
+def sample_variants(lsf, count=6):
+    return [variant.blocks for variant in itertools.islice(lsf.iter_variants(), 0, None, 17)][:count]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('tile_size', (64, 100, 512))
+def test_tiled_matches_synthesis(dataset, engine, tile_size):
+    dir_path, lsfs = dataset
+    for lsf in lsfs:
+        for blocks in sample_variants(lsf):
+            expected = synthesis(lsf.x, lsf.y, blocks, dir_path, engine=engine)
+            actual = synthesis_tiled(lsf.x, lsf.y, blocks, dir_path, engine=engine, tile_size=tile_size)
+            assert np.array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('settings', (ExportSettings(), ExportSettings(png_compression=6, png_strategy='filtered'),
+                                      ExportSettings(FORMAT_RAW)))
+def test_export_tiled_writes_composite(dataset, tmp_path, settings):
+    dir_path, lsfs = dataset
+    lsf = lsfs[0]
+    blocks = sample_variants(lsf)[-1]
+    expected = synthesis(lsf.x, lsf.y, blocks, dir_path)
+    path = str(tmp_path / ('out.npy' if settings.format == FORMAT_RAW else 'out.png'))
+    _, size, digest = export_tiled(path, lsf.x, lsf.y, blocks, dir_path, settings, tile_size=100)
+    assert size == os.path.getsize(path)
+    assert digest == pixel_digest(expected)
+    if settings.format == FORMAT_RAW:
+        assert np.array_equal(np.load(path), expected)
+    else:
+        assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), expected)
+
+
+def test_export_tiled_discards_rejected_output(dataset, tmp_path):
+    dir_path, lsfs = dataset
+    lsf = lsfs[0]
+    blocks = sample_variants(lsf)[0]
+    _, size, _ = export_tiled(str(tmp_path / 'out.png'), lsf.x, lsf.y, blocks, dir_path, ExportSettings(),
+                              tile_size=64, accept=lambda digest: False)
+    assert size is None
+    assert os.listdir(tmp_path) == []
+
+
+def sample_images():
+    # 随机噪声、大片相同像素与半透明边缘，以及只有一行的图片
+    rng = np.random.default_rng(3)
+    noise = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    flat = np.zeros((64, 80, 4), dtype=np.uint8)
+    flat[10:50, 20:70] = (30, 60, 90, 255)
+    flat[20:30, 30:40, 3] = rng.integers(0, 256, (10, 10), dtype=np.uint8)
+    return [noise, flat, np.zeros((1, 200, 4), dtype=np.uint8)]
+
+
+@pytest.mark.parametrize('settings', (ExportSettings(), ExportSettings(png_compression=9),
+                                      ExportSettings(png_compression=3, png_strategy='huffman')))
+@pytest.mark.parametrize('image', sample_images())
+def test_png_row_writer_decodes_to_image(image, settings):
+    # 分多次、每次不同行数写出
+    file = io.BytesIO()
+    writer = PngRowWriter(file, image.shape[1], image.shape[0], settings)
+    for start, stop in ((0, 1), (1, 20), (20, None)):
+        writer.write(image[start:stop])
+    writer.close()
+    decoded = cv2.imdecode(np.frombuffer(file.getvalue(), np.uint8), cv2.IMREAD_UNCHANGED)
+    assert np.array_equal(decoded, image)
+
+
+@pytest.mark.parametrize('image', sample_images())
+def test_npy_row_writer_matches_np_save(image):
+    file = io.BytesIO()
+    writer = NpyRowWriter(file, image.shape[1], image.shape[0])
+    writer.write(image[:7])
+    writer.write(image[7:])
+    writer.close()
+    assert file.getvalue() == encode_image(image, ExportSettings(FORMAT_RAW))
+
+
+def test_row_writers_check_height():
+    image = sample_images()[0]
+    for writer in (PngRowWriter(io.BytesIO(), image.shape[1], image.shape[0], ExportSettings()),
+                   NpyRowWriter(io.BytesIO(), image.shape[1], image.shape[0])):
+        writer.write(image[:-1])
+        with pytest.raises(ValueError):
+            writer.close()
@@ -0,0 +1,58 @@
+from lsfInfo import AXIS_FACE_EFFECT, AXIS_HOLY_LIGHT, ORDER_GRAY, ORDER_LEX, LSFFile
+from synthetic_data import TYPE_HOLY_LIGHT, encode_lsf
+
+
+def key(v):
+    return v.bi, tuple(sorted(v.fd.items())), tuple(sorted(v.fe.items())), v.hl
+
+
+def test_key_zero_is_enumerated_once(tmp_path):
+    # 特效与圣光的键0表示不添加该图层，lsf文件中ID为0的特效与圣光不产生额外的组合
+    blocks = [('Z_B1', 0, 0, 0, 1, 0), ('Z_F1_1', 0, 0, 10, 1, 0), ('Z_F1_2', 0, 0, 10, 2, 0),
+              ('Z_E1_0', 0, 0, 11, 0, 0), ('Z_E1_1', 0, 0, 11, 1, 0),
+              ('Z_H0', 0, 0, TYPE_HOLY_LIGHT, 0, 0), ('Z_H1', 0, 0, TYPE_HOLY_LIGHT, 1, 0)]
+    path = tmp_path / 'Z.lsf'
+    path.write_bytes(encode_lsf(100, 80, blocks))
+    lsf = LSFFile(str(path))
+    assert {n: keys for kind, n, keys in lsf.variant_axes() if kind == AXIS_FACE_EFFECT} == {1: [0, 1]}
+    assert [keys for kind, _, keys in lsf.variant_axes() if kind == AXIS_HOLY_LIGHT] == [[0, 1]]
+    assert lsf.count_variants() == 8
+    for order in (ORDER_GRAY, ORDER_LEX):
+        variants = list(lsf.iter_variants(order=order))
+        assert len(variants) == 8
+        assert len(set(map(key, variants))) == 8
+
+
+def changed_axes(a, b):
+    changed = [('base', 0)] if a.bi != b.bi else []
+    changed += [('fd', n) for n in a.fd if a.fd[n] != b.fd[n]]
+    changed += [('fe', n) for n in a.fe if a.fe[n] != b.fe[n]]
+    return changed + ([('hl', 0)] if a.hl != b.hl else [])
+
+
+def test_gray_code_neighbours_differ_by_one_layer(dataset):
+    for lsf in dataset[1]:
+        variants = list(lsf.iter_variants())
+        assert len(variants) == lsf.count_variants()
+        for a, b in zip(variants, variants[1:]):
+            assert len(changed_axes(a, b)) == 1
+            if a.bi == b.bi:
+                # 替换、添加或移除一个图层；底片由多个块组成，切换底片时替换全部块
+                layers_a = {(block.name, block.x, block.y) for block in a.blocks}
+                layers_b = {(block.name, block.x, block.y) for block in b.blocks}
+                assert len(layers_a ^ layers_b) in (1, 2)
+
+
+def test_iter_variants_covers_product(dataset):
+    lsf = dataset[1][0]
+    gray = list(lsf.iter_variants())
+    lex = list(lsf.iter_variants(order=ORDER_LEX))
+    assert sorted(map(key, gray)) == sorted(map(key, lex))
+    assert len(set(map(key, gray))) == len(gray)
+    # 按参数筛选的子集
+    selected = {'bi_keys': [2], 'fd_keys': {1: [1, 3]}, 'fe_keys': {1: [0]}, 'hl_keys': [1]}
+    subset = list(lsf.iter_variants(**selected))
+    assert len(subset) == lsf.count_variants(**selected) == 1 * 2 * 3 * 1 * 1
+    assert all(v.bi == 2 and v.fd[1] in (1, 3) and v.fe[1] == 0 and v.hl == 1 for v in subset)
+    for v in subset:
+        assert v.blocks == lsf.get_operation_blocks(v.bi, dict(v.fd), dict(v.fe), v.hl)
@@ -0,0 +1,91 @@
+import os
+import time
+
+import numpy as np
+
+from dedup import pixel_hasher
+from exporter import open_row_writer
+from file_util import create_temp_file
+from profiler import span
+from synthesis_util import blend_layer, place_layer
+
+# 分块大小，可通过环境变量ESCUDE_TILE_SIZE调整；峰值内存约为一行块（分块高度×画布宽度）的画布加上单个分块的混合临时数组
+DEFAULT_TILE_SIZE = int(os.environ.get('ESCUDE_TILE_SIZE', '512'))
+
+
+def place_layers(width, height, operation_blocks, dir_path, cache=None, level=0):
+    # 返回[(TrimmedLayer, 左, 上, 右, 下)]，坐标为裁掉透明边框后的像素在画布上的范围；
+    # 缺失、越界或完全透明的组件不在其中
+    layers = []
+    for block in operation_blocks:
+        placed = place_layer(width, height, block, dir_path, cache, level)
+        if placed is None:
+            continue
+        layer, x0, y0 = placed
+        op_h, op_w = layer.pixels.shape[:2]
+        if op_h == 0:
+            continue
+        layers.append((layer, x0, y0, x0 + op_w, y0 + op_h))
+    return layers
+
+
+def iter_bands(x, y, operation_blocks, dir_path, cache=None, engine=None, tile_size=DEFAULT_TILE_SIZE, level=0):
+    # 从上到下逐个给出tile_size行的画布，结果与synthesis()逐像素一致
+    # 每行内按tile_size×tile_size的分块依次混合与该分块相交的图层，浮点混合的临时数组不超过一个分块
+    # 各行复用同一个缓冲区，调用方需要在取下一行之前用完上一行
+    width, height = x >> level, y >> level
+    layers = place_layers(width, height, operation_blocks, dir_path, cache, level)
+    buffer = np.empty((min(tile_size, height), width, 4), dtype=np.uint8)
+    for top in range(0, height, tile_size):
+        bottom = min(top + tile_size, height)
+        band = buffer[:bottom - top]
+        band[:] = 0
+        # 先按行筛选，行内再按分块筛选，保持图层顺序
+        band_layers = [item for item in layers if item[2] < bottom and item[4] > top]
+        with span('tile.band'):
+            for left in range(0, width, tile_size):
+                right = min(left + tile_size, width)
+                tile = band[:, left:right]
+                for layer, x0, y0, x1, y1 in band_layers:
+                    if x0 < right and x1 > left:
+                        blend_layer(tile, layer, x0 - left, y0 - top, engine)
+        yield band
+
+
+def synthesis_tiled(x, y, operation_blocks, dir_path, cache=None, engine=None, tile_size=DEFAULT_TILE_SIZE, level=0):
+    # 拼接各行得到完整画布，用于与synthesis()比较
+    return np.concatenate([band.copy() for band in iter_bands(x, y, operation_blocks, dir_path, cache, engine,
+                                                               tile_size, level)])
+
+
+def export_tiled(path, x, y, operation_blocks, dir_path, settings, cache=None, engine=None,
+                 tile_size=DEFAULT_TILE_SIZE, accept=None):
+    # 分块合成并逐行编码写出，不保存完整画布；先写同目录下的临时文件，完成后重命名
+    # accept以像素哈希（与dedup.pixel_digest相同）调用，返回False时丢弃输出
+    # 返回(编码耗时, 文件大小, 像素哈希)，被丢弃时文件大小为None
+    hasher = pixel_hasher((y, x, 4))
+    encode_seconds = 0.0
+    fd, tmp_path = create_temp_file(os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            writer = open_row_writer(file, x, y, settings)
+            for band in iter_bands(x, y, operation_blocks, dir_path, cache, engine, tile_size):
+                hasher.update(band.data)
+                start = time.perf_counter()
+                with span('encode.rows'):
+                    writer.write(band)
+                encode_seconds += time.perf_counter() - start
+            writer.close()
+            size = file.tell()
+        digest = hasher.hexdigest()
+        if accept is not None and not accept(digest):
+            os.remove(tmp_path)
+            return encode_seconds, None, digest
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return encode_seconds, size, digest
@@ -0,0 +1,139 @@
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QSize, QEvent, pyqtSignal
+from PyQt5.QtGui import QIcon, QPen, QColor
+from PyQt5.QtWidgets import QStyledItemDelegate, QStyle
+
+GROUP_ROLE = Qt.UserRole + 1
+
+ITEM_SIZE = 150
+TITLE_HEIGHT = 20
+ARROW_SIZE = 20
+
+
+class VariantGroup:
+    # 底边栏中的一组差分：type为显示的类别名，sid为组号，data_list为可选的键，index为当前选中项
+    __slots__ = ('type', 'sid', 'data_list', 'index', 'thumbnail', 'requested')
+
+    def __init__(self, type_str, data_list, index=0, sid=0):
+        self.type = type_str
+        self.sid = sid
+        self.data_list = data_list
+        self.index = index
+        self.thumbnail = None
+        self.requested = False
+
+    @property
+    def key(self):
+        return self.data_list[self.index]
+
+
+class VariantGroupModel(QAbstractListModel):
+    # 底边栏的数据模型，缩略图只在视图第一次绘制该行时才请求加载
+    index_changed = pyqtSignal(object)
+    thumbnail_needed = pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.groups = []
+
+    def set_groups(self, groups):
+        self.beginResetModel()
+        self.groups = list(groups)
+        self.endResetModel()
+
+    def clear(self):
+        self.set_groups([])
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.groups)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        group = self.groups[index.row()]
+        if role == Qt.DisplayRole:
+            return group.type
+        if role == Qt.DecorationRole:
+            if not group.requested:
+                group.requested = True
+                self.thumbnail_needed.emit(group)
+            return group.thumbnail
+        if role == GROUP_ROLE:
+            return group
+        return None
+
+    def step(self, row, delta):
+        group = self.groups[row]
+        group.index = (group.index + delta) % len(group.data_list)
+        # 新缩略图加载完成之前继续显示旧的缩略图
+        group.requested = False
+        self._changed(row)
+        self.index_changed.emit(group)
+
+    def set_thumbnail(self, group, pixmap):
+        # 切换lsf之后才返回的旧缩略图直接丢弃
+        for row, item in enumerate(self.groups):
+            if item is group:
+                group.thumbnail = pixmap
+                self._changed(row)
+                return
+
+    def _changed(self, row):
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+
+class VariantGroupDelegate(QStyledItemDelegate):
+    # 绘制标题、缩略图、左右箭头与“当前/总数”，点击箭头时切换差分
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.left_icon = QIcon("static/BxLeftArrow.svg")
+        self.right_icon = QIcon("static/BxRightArrow.svg")
+
+    def sizeHint(self, option, index):
+        return QSize(ITEM_SIZE, ITEM_SIZE)
+
+    @staticmethod
+    def arrow_rects(rect):
+        bottom = rect.bottom() - ARROW_SIZE - 4
+        left = QRect(rect.left() + 6, bottom, ARROW_SIZE, ARROW_SIZE)
+        right = QRect(rect.right() - ARROW_SIZE - 6, bottom, ARROW_SIZE, ARROW_SIZE)
+        return left, right
+
+    def paint(self, painter, option, index):
+        group = index.data(GROUP_ROLE)
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        painter.save()
+        painter.setPen(QPen(QColor('#808080')))
+        painter.drawRect(rect)
+        title_rect = QRect(rect.left(), rect.top() + 2, rect.width(), TITLE_HEIGHT)
+        painter.drawText(title_rect, Qt.AlignCenter, group.type)
+
+        left, right = self.arrow_rects(rect)
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is not None and not pixmap.isNull():
+            image_rect = QRect(rect.left() + 2, title_rect.bottom() + 2, rect.width() - 4,
+                               left.top() - title_rect.bottom() - 4)
+            size = pixmap.size().scaled(image_rect.size(), Qt.KeepAspectRatio)
+            target = QRect(0, 0, size.width(), size.height())
+            target.moveCenter(image_rect.center())
+            painter.drawPixmap(target, pixmap)
+
+        self.left_icon.paint(painter, left)
+        self.right_icon.paint(painter, right)
+        text_rect = QRect(left.right(), left.top(), right.left() - left.right(), ARROW_SIZE)
+        painter.drawText(text_rect, Qt.AlignCenter, f"{group.index + 1}/{len(group.data_list)}")
+        if option.state & QStyle.State_MouseOver:
+            painter.setPen(QPen(QColor('#4CAF50')))
+            painter.drawRect(rect)
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            left, right = self.arrow_rects(option.rect.adjusted(2, 2, -2, -2))
+            if left.contains(event.pos()):
+                model.step(index.row(), -1)
+                return True
+            if right.contains(event.pos()):
+                model.step(index.row(), 1)
+                return True
+        return super().editorEvent(event, model, option, index)